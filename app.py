@@ -1,70 +1,108 @@
 import base64
 import hashlib
+import heapq
 import io
+import itertools
+import json
+import math
+import multiprocessing
 import os
+import random
 import re
+import sqlite3
+import tempfile
+import threading
 import time
+import traceback
 import uuid
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from dataclasses import dataclass
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field, replace
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+from typing import BinaryIO, Callable
 
-from flask import Flask, jsonify, request, send_file, render_template_string
+import click
+from flask import Flask, Response, jsonify, request, send_file, render_template_string, stream_with_context
+import httpx
 from openai import (
     APIConnectionError,
     APIStatusError,
     APITimeoutError,
     BadRequestError,
+    DefaultHttpxClient,
     OpenAI,
+    OpenAIError,
     RateLimitError,
 )
-from PIL import Image, ImageOps, UnidentifiedImageError
+from PIL import Image, ImageChops
 from werkzeug.exceptions import RequestEntityTooLarge
 
 # PDF (ReportLab)
+from reportlab.pdfbase import pdfdoc
 from reportlab.pdfgen import canvas as pdfcanvas
 from reportlab.lib.pagesizes import A4, A5
 from reportlab.lib.units import mm
-from reportlab.lib.utils import ImageReader
 
-client = OpenAI()
+from config import env_choice, env_int
+from pdf_encoding import (
+    PDF_JPEG_QUALITY,
+    PdfImageStream,
+    TracedPage,
+    encode_pdf_image,
+    encode_pdf_lineart,
+    encode_pdf_pair,
+    fit_size,
+    image_to_jpeg_bytes,
+    pil_image_from_bytes,
+    pil_image_from_file,
+    trace_coloring,
+)
 
 # -----------------------------
 # Limits / config
 # -----------------------------
-def env_int(name: str, default: int, min_value: int | None = None, max_value: int | None = None) -> int:
-    raw = os.getenv(name)
-    if raw is None:
-        return default
-    try:
-        value = int(raw)
-    except ValueError:
-        return default
-    if min_value is not None:
-        value = max(min_value, value)
-    if max_value is not None:
-        value = min(max_value, value)
-    return value
-
-
-def env_choice(name: str, default: str, allowed: set[str]) -> str:
-    value = os.getenv(name, default).strip()
-    return value if value in allowed else default
-
-
 MAX_FILES_SINGLE = 1
 BOOKLET_MIN = env_int("BOOKLET_MIN", 2, min_value=1)
 BOOKLET_MAX = env_int("BOOKLET_MAX", 10, min_value=BOOKLET_MIN, max_value=20)
-MAX_PARALLEL_WORKERS = env_int("MAX_PARALLEL_WORKERS", 2, min_value=1, max_value=BOOKLET_MAX)
+# OpenAI calls in flight at once in this worker process, across all requests (see OpenAIScheduler).
+MAX_PARALLEL_WORKERS = env_int("MAX_PARALLEL_WORKERS", 2, min_value=1, max_value=32)
+# The first pages of a booklet are queued with single-image priority, so the user sees progress early.
+BOOKLET_PRIORITY_PAGES = env_int("BOOKLET_PRIORITY_PAGES", 2, min_value=0, max_value=BOOKLET_MAX)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+# Queued calls older than this are treated as interactive, so bulk work is never starved.
+OPENAI_QUEUE_AGING_SECONDS = 60
+# Transient OpenAI failures (429, timeouts, 5xx) are retried with backoff until this many seconds
+# after the request started, so one hiccup does not throw away a whole booklet.
+OPENAI_RETRY_BUDGET_SECONDS = env_int("OPENAI_RETRY_BUDGET_SECONDS", 180, min_value=0, max_value=1800)
+OPENAI_MAX_ATTEMPTS = env_int("OPENAI_MAX_ATTEMPTS", 4, min_value=1, max_value=10)
+OPENAI_BACKOFF_BASE_SECONDS = 2.0
+OPENAI_BACKOFF_MAX_SECONDS = 30.0
+# After a 429 the concurrency limit is halved at most once per this many seconds.
+OPENAI_AIMD_COOLDOWN_SECONDS = 10.0
+JOB_WORKERS = env_int("JOB_WORKERS", 4, min_value=1, max_value=32)
+JOB_TIMEOUT_SECONDS = env_int("JOB_TIMEOUT_SECONDS", 900, min_value=60, max_value=3600)
+JOB_EVENT_POLL_SECONDS = 0.5
+# Decode/resize/encode of uploads. Pillow releases the GIL for that work, so threads scale with cores.
+PREPROCESS_WORKERS = env_int("PREPROCESS_WORKERS", os.cpu_count() or 1, min_value=1, max_value=16)
+# Processes for encoding PDF page pairs (0 = threads on PREPROCESS_EXECUTOR). Processes
+# sidestep the GIL for vector tracing, at the cost of a spawn and a pdf_encoding import
+# each; they only pay off with spare cores (see README).
+PDF_ENCODE_WORKERS = env_int("PDF_ENCODE_WORKERS", 0, min_value=0, max_value=16)
 
 # Total request size limit (Render safety)
 MAX_CONTENT_LENGTH_MB = env_int("MAX_CONTENT_LENGTH_MB", 50, min_value=1, max_value=100)
 
-# Basic abuse/cost guard. This is per Render process, so use a real shared limiter before heavy traffic.
+# Basic abuse/cost guard, counted in the shared SQLite store: one limit for all workers on a node.
 RATE_LIMIT_WINDOW_SECONDS = env_int("RATE_LIMIT_WINDOW_SECONDS", 3600, min_value=60)
 MAX_REQUESTS_PER_WINDOW = env_int("MAX_REQUESTS_PER_WINDOW", 8, min_value=1)
-REQUEST_LOG: dict[str, list[float]] = {}
 
 # OpenAI output size
 SIDE_WIDTH = 1024
@@ -78,6 +116,35 @@ ENGINE_PRESETS = {
     "standard_medium": ("gpt-image-1", "medium", "Standard / medium"),
     "standard_high": ("gpt-image-1", "high", "Standard / høy"),
 }
+# Typical seconds per call, used until enough real calls have been timed (see EngineLatencyTracker).
+ENGINE_LATENCY_PRIORS = {
+    ("gpt-image-1-mini", "medium"): 25.0,
+    ("gpt-image-1-mini", "high"): 45.0,
+    ("gpt-image-1", "medium"): 50.0,
+    ("gpt-image-1", "high"): 90.0,
+}
+# Requests must finish within this many seconds (keep it below gunicorn's --timeout). When the
+# chosen engine would not make it for the images left, pages fall back to a faster preset.
+REQUEST_DEADLINE_SECONDS = env_int("REQUEST_DEADLINE_SECONDS", 540, min_value=30, max_value=3600)
+ENGINE_DOWNGRADE = env_choice("ENGINE_DOWNGRADE", "on", {"on", "off"})
+# Hedging: when a call has run longer than this percentile of recent calls for its engine,
+# a second identical call is sent and the first to finish wins. At most OPENAI_HEDGE_MAX_PERCENT
+# of calls are hedged, and only when the OpenAI queue has a free slot.
+OPENAI_HEDGE = env_choice("OPENAI_HEDGE", "off", {"on", "off"})
+OPENAI_HEDGE_PERCENTILE = env_int("OPENAI_HEDGE_PERCENTILE", 90, min_value=50, max_value=99)
+OPENAI_HEDGE_MAX_PERCENT = env_int("OPENAI_HEDGE_MAX_PERCENT", 10, min_value=0, max_value=100)
+# HTTP transport to OpenAI. A call that has not answered within its engine's read timeout
+# fails with APITimeoutError and is retried like any other transient error.
+OPENAI_CONNECT_TIMEOUT_SECONDS = env_int("OPENAI_CONNECT_TIMEOUT_SECONDS", 10, min_value=1, max_value=60)
+OPENAI_KEEPALIVE_SECONDS = env_int("OPENAI_KEEPALIVE_SECONDS", 90, min_value=5, max_value=900)
+OPENAI_WARMUP = env_choice("OPENAI_WARMUP", "off", {"on", "off"})
+ENGINE_READ_TIMEOUTS = {
+    ("gpt-image-1-mini", "medium"): 90.0,
+    ("gpt-image-1-mini", "high"): 150.0,
+    ("gpt-image-1", "medium"): 150.0,
+    ("gpt-image-1", "high"): 240.0,
+}
+DEFAULT_READ_TIMEOUT_SECONDS = 180.0
 
 # CEWE A4 portrait content template values from CEWE FOTOBOK Maloppretter.
 CEWE_A4_CONTENT_TRIM_W = 205 * mm
@@ -85,20 +152,82 @@ CEWE_A4_CONTENT_TRIM_H = 270 * mm
 CEWE_CONTENT_BLEED = 3 * mm
 CEWE_CONTENT_SAFE = 5 * mm
 CEWE_CONTENT_MIN_PAGES = 26
+COMBO_GUTTER = 6 * mm
 
 # Input preprocessing sizes
 OPENAI_INPUT_MAX_DIM = env_int("OPENAI_INPUT_MAX_DIM", 1280, min_value=512, max_value=2048)
 PDF_IMAGE_MAX_DIM = env_int("PDF_IMAGE_MAX_DIM", 1800, min_value=512, max_value=2400)
+# Effective print resolution for photos in booklet PDFs: each photo is resampled
+# to the box it fills on the page (still capped by PDF_IMAGE_MAX_DIM). 1-bit line
+# art uses LINEART_UPSCALE times this, as bilevel edges need finer pixels.
+PDF_TARGET_DPI = env_int("PDF_TARGET_DPI", 300, min_value=72, max_value=600)
+# Upload pixel limits and the line art / tracing settings (PDF_LINEART, LINEART_*,
+# TRACE_*) live in pdf_encoding.py, which the PDF encoding processes also import.
 SINGLE_COMBO_MAX_DIM = env_int("SINGLE_COMBO_MAX_DIM", 1800, min_value=512, max_value=2400)
-MAX_IMAGE_PIXELS = env_int("MAX_IMAGE_PIXELS", 12_000_000, min_value=1_000_000, max_value=40_000_000)
-ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG", "WEBP"}
-Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+# Uploads larger than this are spooled to disk instead of kept in memory.
+UPLOAD_SPOOL_MEMORY_KB = env_int("UPLOAD_SPOOL_MEMORY_KB", 512, min_value=64, max_value=16384)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Renditions derived from each upload: (name, max width, max height, JPEG quality).
+RENDITION_SPECS = (
+    ("pdf", PDF_IMAGE_MAX_DIM, PDF_IMAGE_MAX_DIM, PDF_JPEG_QUALITY),
+    ("openai", OPENAI_INPUT_MAX_DIM, OPENAI_INPUT_MAX_DIM, 88),
+    ("combo", min(SIDE_WIDTH, SINGLE_COMBO_MAX_DIM), min(SIDE_HEIGHT, SINGLE_COMBO_MAX_DIM), 92),
+)
 
-# Cache
-CACHE_DIR = Path("/tmp/coloring_cache")
-CACHE_DIR.mkdir(parents=True, exist_ok=True)
+# Cache, previews and rate limits live in one SQLite file shared by all workers on the node.
+STORE_PATH = Path(os.getenv("STORE_PATH", "/tmp/coloring_cache/store.sqlite3"))
+GENERATION_LEASE_SECONDS = env_int("GENERATION_LEASE_SECONDS", 600, min_value=30, max_value=3600)
+CACHE_MEMORY_MB = env_int("CACHE_MEMORY_MB", 64, min_value=0, max_value=2048)
+CACHE_DISK_MB = env_int("CACHE_DISK_MB", 1024, min_value=16, max_value=100_000)
+# Optional snapshot on a persistent disk (e.g. /var/data/coloring-cache.zip) so the cache survives deploys.
+CACHE_SNAPSHOT_PATH = os.getenv("CACHE_SNAPSHOT_PATH", "").strip()
+CACHE_SNAPSHOT_INTERVAL_MINUTES = env_int("CACHE_SNAPSHOT_INTERVAL_MINUTES", 30, min_value=0, max_value=24 * 60)
+# Store leases that keep snapshot restore and export to one worker per node.
+SNAPSHOT_RESTORE_LEASE = "cache-snapshot-restore"
+SNAPSHOT_RESTORE_LEASE_SECONDS = 365 * 24 * 3600
+SNAPSHOT_EXPORT_LEASE = "cache-snapshot-export"
+# Near-duplicate lookup: re-encoded or slightly resized uploads reuse an earlier coloring.
+# Off by default: a near match can be another user's photo, so only enable it where
+# every upload comes from the same person or family.
+PERCEPTUAL_CACHE = env_choice("PERCEPTUAL_CACHE", "off", {"on", "off"})
+PERCEPTUAL_HASH_SIZE = 16  # 16x16 gradient bits = 256-bit hash
+PERCEPTUAL_HASH_MAX_DISTANCE = env_int("PERCEPTUAL_HASH_MAX_DISTANCE", 16, min_value=0, max_value=64)
+PERCEPTUAL_HASH_MIN_TEXTURE = 0.5  # share of hash cells that need a clear gradient
 PREVIEW_DIR = Path("/tmp/coloring_previews")
 PREVIEW_DIR.mkdir(parents=True, exist_ok=True)
+PREVIEW_TTL_SECONDS = 60 * 60
+
+# Shared by all requests so concurrent booklets cannot oversubscribe the CPU.
+PREPROCESS_EXECUTOR = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix="preprocess")
+
+# Started on first use when PDF_ENCODE_WORKERS > 0, see submit_pdf_encoding().
+PDF_ENCODE_POOL: ProcessPoolExecutor | None = None
+PDF_ENCODE_POOL_LOCK = threading.Lock()
+
+# Async /process jobs run here, so web workers are free while OpenAI works.
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+# Single-flight: generations currently running in this process, by cache_key.
+INFLIGHT_GENERATIONS: dict[str, Future] = {}
+INFLIGHT_LOCK = threading.Lock()
+
+# One keep-alive connection per OpenAI call slot. OpenAIScheduler never runs more than
+# MAX_PARALLEL_WORKERS calls, hedges included; warm-up pings bypass it and only fill idle
+# slots, but calls can start while they are out, so the pool has room for both at once.
+# Retries are done by _call_openai_with_retries, which can back off for the whole process
+# and re-queue, so the SDK's own retries are off.
+client = OpenAI(
+    max_retries=0,
+    timeout=httpx.Timeout(DEFAULT_READ_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS),
+    http_client=DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=2 * MAX_PARALLEL_WORKERS,
+            max_keepalive_connections=MAX_PARALLEL_WORKERS,
+            keepalive_expiry=OPENAI_KEEPALIVE_SECONDS,
+        ),
+    ),
+)
 
 # -----------------------------
 # Prompt
@@ -180,6 +309,9 @@ HTML_PAGE = """
         box-shadow: 0 18px 40px rgba(15,23,42,0.3);
         max-width: 380px; text-align: center; font-size: 0.95rem;
       }
+      .progress-list { list-style: none; margin: 0.8rem 0 0 0; padding: 0; font-size: 0.8rem; color: #374151; text-align: left; }
+      .progress-list li { padding: 0.15rem 0; }
+      .progress-list li.done { color: #047857; }
       .loader {
         width: 36px; height: 36px; border-radius: 999px; border: 3px solid #e5e7eb; border-top-color: #4f46e5;
         animation: spin 0.9s linear infinite; margin: 0 auto 0.9rem auto;
@@ -275,6 +407,17 @@ HTML_PAGE = """
               </label>
             </div>
           </div>
+
+          <div class="controls-row" style="margin-bottom: 0.5rem;">
+            <label class="control-group">
+              <input type="checkbox" name="allow_partial" id="allowPartial" value="1">
+              Lag heftet selv om enkelte bilder feiler
+            </label>
+            <label class="control-group">
+              <input type="checkbox" name="vector" id="vectorPages" value="1">
+              Vektoriserte fargeleggingsark (premium)
+            </label>
+          </div>
         </div>
 
         <div class="controls-row">
@@ -314,6 +457,7 @@ HTML_PAGE = """
         <div class="loader"></div>
         <div id="overlayText">Genererer …</div>
         <div style="font-size:0.8rem; color:#6b7280; margin-top:0.4rem;">Dette kan ta litt tid.</div>
+        <ul id="progressList" class="progress-list"></ul>
       </div>
     </div>
 
@@ -323,6 +467,7 @@ HTML_PAGE = """
           <h2 id="previewTitle" class="preview-title">Forhåndsvisning</h2>
           <button type="button" class="secondary" id="closePreviewBtn">Lukk</button>
         </div>
+        <p id="previewNote" class="error-text preview-hidden"></p>
         <div class="preview-content-wrap">
           <img id="previewImage" class="preview-image" alt="Forhåndsvisning av generert fargeleggingsark">
           <iframe id="previewFrame" class="preview-frame preview-hidden" title="Forhåndsvisning av PDF"></iframe>
@@ -338,10 +483,14 @@ HTML_PAGE = """
       const form = document.getElementById('form');
       const overlay = document.getElementById('overlay');
       const overlayText = document.getElementById('overlayText');
+      const progressList = document.getElementById('progressList');
       const errorText = document.getElementById('errorText');
       const previewModal = document.getElementById('previewModal');
       const previewImage = document.getElementById('previewImage');
       const previewFrame = document.getElementById('previewFrame');
+      const previewNote = document.getElementById('previewNote');
+      const allowPartialInput = document.getElementById('allowPartial');
+      const vectorPagesInput = document.getElementById('vectorPages');
       const closePreviewBtn = document.getElementById('closePreviewBtn');
       const retryPreviewBtn = document.getElementById('retryPreviewBtn');
       const acceptPreviewBtn = document.getElementById('acceptPreviewBtn');
@@ -372,6 +521,8 @@ HTML_PAGE = """
         bookletInput.disabled = isSingle;
         paperSelect.disabled = isSingle;
         layoutRadios.forEach(r => r.disabled = isSingle);
+        allowPartialInput.disabled = isSingle;
+        vectorPagesInput.disabled = isSingle;
 
         submitBtn.textContent = isSingle ? 'Generer fargeleggingsark' : 'Generer PDF';
         overlayText.textContent = isSingle ? 'Genererer fargeleggingsark …' : 'Genererer PDF …';
@@ -468,11 +619,74 @@ HTML_PAGE = """
         if (currentDownloadUrl) window.location.href = currentDownloadUrl;
       });
 
+      const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+      const stageLabels = {
+        preprocessed: 'klargjort',
+        queued: 'i kø hos OpenAI',
+        generating: 'tegnes …',
+        cached: 'hentet fra cache',
+        done: 'ferdig',
+        page_written: 'lagt inn i PDF-en',
+        failed: 'utelatt'
+      };
+      const progressItems = new Map();
+
+      function resetProgress() {
+        progressItems.clear();
+        progressList.innerHTML = '';
+      }
+
+      function renderProgress(event) {
+        let item = progressItems.get(event.image);
+        if (!item) {
+          item = document.createElement('li');
+          progressItems.set(event.image, item);
+          const after = [...progressItems.keys()].sort((a, b) => a - b).find((n) => n > event.image);
+          progressList.insertBefore(item, after ? progressItems.get(after) : null);
+        }
+        item.textContent = `Bilde ${event.image}: ${stageLabels[event.stage] || event.stage}`;
+        item.classList.toggle('done', ['cached', 'done', 'page_written'].includes(event.stage));
+      }
+
+      function waitForJobEvents(eventsUrl, statusUrl) {
+        return new Promise((resolve, reject) => {
+          const source = new EventSource(eventsUrl);
+          source.addEventListener('progress', (event) => renderProgress(JSON.parse(event.data)));
+          source.addEventListener('state', (event) => {
+            source.close();
+            const job = JSON.parse(event.data);
+            if (job && job.state === 'done') resolve(job.result);
+            else reject(new Error((job && job.error) || 'Genereringen feilet.'));
+          });
+          source.onerror = () => {
+            // Strømmen brøt (proxy, nettverk): fortsett med vanlig polling.
+            source.close();
+            waitForJob(statusUrl).then(resolve, reject);
+          };
+        });
+      }
+
+      async function waitForJob(statusUrl) {
+        while (true) {
+          await sleep(2000);
+          const response = await fetch(statusUrl, { headers: { 'Accept': 'application/json' } });
+          if (!response.ok) {
+            const message = await response.text();
+            throw new Error(message || 'Fant ikke jobben.');
+          }
+          const job = await response.json();
+          if (job.state === 'done') return job.result;
+          if (job.state === 'failed') throw new Error(job.error || 'Genereringen feilet.');
+        }
+      }
+
       form.addEventListener('submit', async (event) => {
         const mode = document.querySelector('input[name="mode"]:checked').value;
         console.log('Submitting mode:', mode);
         errorText.textContent = '';
 
+        resetProgress();
         overlay.classList.remove('hidden');
 
         event.preventDefault();
@@ -481,6 +695,7 @@ HTML_PAGE = """
         try {
           const formData = new FormData(form);
           formData.set('preview', '1');
+          formData.set('async', '1');
 
           const response = await fetch('/process', {
             method: 'POST',
@@ -493,8 +708,28 @@ HTML_PAGE = """
             throw new Error(message || 'Genereringen feilet.');
           }
 
-          const data = await response.json();
+          let data = await response.json();
+          if (data.job_id) {
+            data = window.EventSource && data.events_url
+              ? await waitForJobEvents(data.events_url, data.status_url)
+              : await waitForJob(data.status_url);
+          }
           currentDownloadUrl = data.download_url;
+          const dropped = data.dropped || [];
+          const downgraded = (data.engines || []).filter((e) => e.downgraded);
+          const rasterPages = (data.traces || []).filter((t) => !t.vector);
+          const notes = [];
+          if (dropped.length) {
+            notes.push('Utelatt fra heftet: ' + dropped.map((d) => `bilde ${d.image} (${d.filename}): ${d.reason}`).join('; '));
+          }
+          if (downgraded.length) {
+            notes.push('Laget med raskere motor for å bli ferdig i tide: ' + downgraded.map((e) => `bilde ${e.image} (${e.engine})`).join(', '));
+          }
+          if (rasterPages.length) {
+            notes.push('For detaljert til vektor, lagt inn som bilde: ' + rasterPages.map((t) => `bilde ${t.image}`).join(', '));
+          }
+          previewNote.textContent = notes.join(' ');
+          previewNote.classList.toggle('preview-hidden', notes.length === 0);
           if (data.kind === 'pdf') {
             previewImage.classList.add('preview-hidden');
             previewFrame.classList.remove('preview-hidden');
@@ -523,12 +758,620 @@ HTML_PAGE = """
 # -----------------------------
 # Data structures
 # -----------------------------
+@dataclass
+class SpooledUpload:
+    filename: str
+    file: BinaryIO
+    size: int
+    sha256: str
+
+    def close(self) -> None:
+        self.file.close()
+
+
 @dataclass
 class PreparedImage:
     original_filename: str
-    original_bytes: bytes
+    original_size: int
     openai_input_bytes: bytes
     pdf_bytes: bytes
+    # Only single mode uses the combo rendition; booklet uploads leave it out.
+    combo_bytes: bytes | None = None
+
+
+class SharedStore:
+    """
+    Single-file SQLite store (WAL mode) shared by all gunicorn workers on a node:
+    cached colorings, the perceptual index, preview metadata, rate-limit
+    timestamps and cross-worker generation leases.
+    Each thread gets its own connection; writes that read-then-modify run in
+    BEGIN IMMEDIATE transactions so workers cannot interleave them.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS colorings (
+            key TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS colorings_last_access ON colorings (last_access);
+        CREATE TABLE IF NOT EXISTS perceptual_index (
+            ns TEXT NOT NULL,
+            key TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            aspect REAL NOT NULL,
+            PRIMARY KEY (ns, key)
+        );
+        CREATE INDEX IF NOT EXISTS perceptual_index_key ON perceptual_index (key);
+        CREATE INDEX IF NOT EXISTS perceptual_index_ns_aspect ON perceptual_index (ns, aspect);
+        CREATE TABLE IF NOT EXISTS previews (
+            id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            suffix TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS rate_limit (
+            client TEXT NOT NULL,
+            ts REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS rate_limit_client_ts ON rate_limit (client, ts);
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            result TEXT,
+            error TEXT
+        );
+        CREATE TABLE IF NOT EXISTS job_events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, seq);
+        CREATE TABLE IF NOT EXISTS generation_leases (
+            key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._local = threading.local()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(self.SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # Colorings
+    def get_coloring(self, key: str) -> bytes | None:
+        conn = self._conn()
+        row = conn.execute("SELECT data FROM colorings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            # Best effort: a busy or full database must not turn a hit into a failure.
+            conn.execute("UPDATE colorings SET last_access = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as exc:
+            print(f"Kunne ikke oppdatere sist brukt for cache {key}.png: {exc}", flush=True)
+        return row[0]
+
+    def read_coloring(self, key: str) -> bytes | None:
+        row = self._conn().execute("SELECT data FROM colorings WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def has_coloring(self, key: str) -> bool:
+        return self._conn().execute("SELECT 1 FROM colorings WHERE key = ?", (key,)).fetchone() is not None
+
+    def put_coloring(self, key: str, data: bytes, budget_bytes: int) -> int:
+        """Stores a coloring and evicts least recently used ones over budget. Returns the eviction count."""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO colorings (key, data, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM colorings").fetchone()[0]
+            evicted = 0
+            while total > budget_bytes:
+                row = conn.execute(
+                    "SELECT key, size FROM colorings WHERE key != ? ORDER BY last_access LIMIT 1", (key,)
+                ).fetchone()
+                if row is None:
+                    break
+                conn.execute("DELETE FROM colorings WHERE key = ?", (row[0],))
+                conn.execute("DELETE FROM perceptual_index WHERE key = ?", (row[0],))
+                total -= row[1]
+                evicted += 1
+        return evicted
+
+    def coloring_keys(self) -> list[str]:
+        """All cached keys, least recently used first."""
+        return [row[0] for row in self._conn().execute("SELECT key FROM colorings ORDER BY last_access")]
+
+    def coloring_totals(self) -> tuple[int, int]:
+        return self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM colorings").fetchone()
+
+    # Perceptual index
+    def add_perceptual(self, namespace: str, key: str, phash: int, aspect: float) -> None:
+        self._conn().execute(
+            "INSERT OR REPLACE INTO perceptual_index (ns, key, hash, aspect) VALUES (?, ?, ?, ?)",
+            (namespace, key, f"{phash:x}", aspect),
+        )
+
+    def perceptual_candidates(self, namespace: str, min_aspect: float, max_aspect: float) -> list[tuple[str, str]]:
+        """(key, hex hash) for indexed keys in the aspect range that still have a cached coloring."""
+        return self._conn().execute(
+            "SELECT p.key, p.hash FROM perceptual_index p JOIN colorings c ON c.key = p.key "
+            "WHERE p.ns = ? AND p.aspect BETWEEN ? AND ?",
+            (namespace, min_aspect, max_aspect),
+        ).fetchall()
+
+    def perceptual_entries(self) -> list[tuple[str, str, str, float]]:
+        return self._conn().execute("SELECT ns, key, hash, aspect FROM perceptual_index").fetchall()
+
+    # Previews
+    def add_preview(self, preview_id: str, filename: str, suffix: str, expires_at: float) -> None:
+        self._conn().execute(
+            "INSERT INTO previews (id, filename, suffix, expires_at) VALUES (?, ?, ?, ?)",
+            (preview_id, filename, suffix, expires_at),
+        )
+
+    def get_preview(self, preview_id: str) -> tuple[str, str] | None:
+        """(filename, suffix) for a preview that has not expired."""
+        return self._conn().execute(
+            "SELECT filename, suffix FROM previews WHERE id = ? AND expires_at > ?", (preview_id, time.time())
+        ).fetchone()
+
+    def pop_expired_previews(self) -> list[tuple[str, str]]:
+        with self.transaction() as conn:
+            now = time.time()
+            rows = conn.execute("SELECT id, suffix FROM previews WHERE expires_at <= ?", (now,)).fetchall()
+            conn.execute("DELETE FROM previews WHERE expires_at <= ?", (now,))
+        return rows
+
+    # Rate limit
+    def record_request(self, client_id: str, now: float, window_seconds: int, max_requests: int) -> bool:
+        """Records a request for client_id unless it already has max_requests in the window."""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM rate_limit WHERE ts <= ?", (now - window_seconds,))
+            count = conn.execute("SELECT COUNT(*) FROM rate_limit WHERE client = ?", (client_id,)).fetchone()[0]
+            if count >= max_requests:
+                return False
+            conn.execute("INSERT INTO rate_limit (client, ts) VALUES (?, ?)", (client_id, now))
+        return True
+
+    # Async jobs
+    def create_job(self, job_id: str, now: float) -> None:
+        self._conn().execute(
+            "INSERT INTO jobs (id, state, created_at, updated_at) VALUES (?, 'queued', ?, ?)", (job_id, now, now)
+        )
+
+    def update_job(self, job_id: str, state: str, result: dict | None = None, error: str | None = None) -> None:
+        self._conn().execute(
+            "UPDATE jobs SET state = ?, updated_at = ?, result = ?, error = ? WHERE id = ?",
+            (state, time.time(), json.dumps(result) if result is not None else None, error, job_id),
+        )
+
+    def get_job(self, job_id: str) -> dict | None:
+        row = self._conn().execute(
+            "SELECT state, created_at, updated_at, result, error FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        state, created_at, updated_at, result, error = row
+        return {
+            "job_id": job_id,
+            "state": state,
+            "created_at": created_at,
+            "updated_at": updated_at,
+            "result": json.loads(result) if result else None,
+            "error": error,
+        }
+
+    def add_job_event(self, job_id: str, event: dict) -> None:
+        self._conn().execute("INSERT INTO job_events (job_id, data) VALUES (?, ?)", (job_id, json.dumps(event)))
+
+    def job_events_after(self, job_id: str, seq: int) -> list[tuple[int, dict]]:
+        rows = self._conn().execute(
+            "SELECT seq, data FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, seq)
+        ).fetchall()
+        return [(row_seq, json.loads(data)) for row_seq, data in rows]
+
+    def delete_jobs_before(self, cutoff: float) -> None:
+        with self.transaction() as conn:
+            conn.execute(
+                "DELETE FROM job_events WHERE job_id IN (SELECT id FROM jobs WHERE updated_at < ?)", (cutoff,)
+            )
+            conn.execute("DELETE FROM jobs WHERE updated_at < ?", (cutoff,))
+
+    # Generation leases
+    def acquire_lease(self, key: str, owner: str, ttl_seconds: float) -> bool:
+        """Takes the lease on key for ttl_seconds, or renews it if owner already holds it."""
+        with self.transaction() as conn:
+            now = time.time()
+            conn.execute("DELETE FROM generation_leases WHERE key = ? AND expires_at <= ?", (key, now))
+            written = conn.execute(
+                "INSERT INTO generation_leases (key, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET expires_at = excluded.expires_at WHERE owner = excluded.owner",
+                (key, owner, now + ttl_seconds),
+            ).rowcount
+        return written == 1
+
+    def release_lease(self, key: str, owner: str) -> None:
+        self._conn().execute("DELETE FROM generation_leases WHERE key = ? AND owner = ?", (key, owner))
+
+    def lease_active(self, key: str) -> bool:
+        return (
+            self._conn()
+            .execute("SELECT 1 FROM generation_leases WHERE key = ? AND expires_at > ?", (key, time.time()))
+            .fetchone()
+            is not None
+        )
+
+
+STORE = SharedStore(STORE_PATH)
+
+
+class ColoringCache:
+    """
+    Two-tier LRU cache for coloring PNGs, keyed by cache_key().
+    A small per-process in-memory tier sits in front of the shared store, which
+    all workers on the node see. Each tier has its own byte budget and evicts
+    least recently used entries first.
+    """
+
+    def __init__(self, store: SharedStore, memory_budget_bytes: int, disk_budget_bytes: int):
+        self.store = store
+        self.memory_budget_bytes = memory_budget_bytes
+        self.disk_budget_bytes = disk_budget_bytes
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        self._counters = dict.fromkeys(
+            (
+                "memory_hits",
+                "disk_hits",
+                "perceptual_hits",
+                "misses",
+                "writes",
+                "memory_evictions",
+                "disk_evictions",
+                "bytes_served",
+            ),
+            0,
+        )
+
+    def get(self, key: str, record_miss: bool = True) -> bytes | None:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                self._counters["bytes_served"] += len(data)
+                return data
+
+        try:
+            data = self.store.get_coloring(key)
+        except (OSError, sqlite3.Error) as exc:
+            print(f"Kunne ikke lese cache {key}.png: {exc}", flush=True)
+            data = None
+        with self._lock:
+            if data is not None:
+                self._counters["disk_hits"] += 1
+                self._counters["bytes_served"] += len(data)
+                self._remember(key, data)
+            elif record_miss:
+                self._counters["misses"] += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        evicted = self.store.put_coloring(key, data, self.disk_budget_bytes)
+        with self._lock:
+            self._counters["writes"] += 1
+            self._counters["disk_evictions"] += evicted
+            self._remember(key, data)
+
+    def record_perceptual_hit(self) -> None:
+        """Reclassifies the miss counted for the exact key as a perceptual hit."""
+        with self._lock:
+            self._counters["misses"] -= 1
+            self._counters["perceptual_hits"] += 1
+
+    def read_stored(self, key: str) -> bytes | None:
+        """Reads an entry from the shared store without touching recency or counters."""
+        return self.store.read_coloring(key)
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            if key in self._memory:
+                return True
+        return self.store.has_coloring(key)
+
+    def keys(self) -> list[str]:
+        return self.store.coloring_keys()
+
+    def stats(self) -> dict[str, int]:
+        disk_entries, disk_bytes = self.store.coloring_totals()
+        with self._lock:
+            return {
+                **self._counters,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": disk_entries,
+                "disk_bytes": disk_bytes,
+            }
+
+    def _remember(self, key: str, data: bytes) -> None:
+        """Adds to the memory tier. Expects self._lock to be held."""
+        if len(data) > self.memory_budget_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_budget_bytes:
+            _old_key, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._counters["memory_evictions"] += 1
+
+
+COLORING_CACHE = ColoringCache(STORE, CACHE_MEMORY_MB * 1024 * 1024, CACHE_DISK_MB * 1024 * 1024)
+
+
+class PerceptualIndex:
+    """
+    Maps perceptual hashes of OpenAI inputs to cache keys, per cache namespace
+    (detail level + engine). Stored in the shared store; index rows are removed
+    together with their coloring when it is evicted.
+    """
+
+    def __init__(self, store: SharedStore):
+        self.store = store
+
+    def add(self, namespace: str, phash: int, aspect: float, key: str) -> None:
+        self.store.add_perceptual(namespace, key, phash, round(aspect, 4))
+
+    def find(self, namespace: str, phash: int, aspect: float, max_distance: int) -> tuple[str, int] | None:
+        """Closest cached key within max_distance bits and ~2% aspect ratio, with its distance."""
+        best = None
+        # The (ns, aspect) index narrows the scan to images of nearly the same shape.
+        for key, other_hash in self.store.perceptual_candidates(namespace, aspect * 0.98, aspect * 1.02):
+            distance = (phash ^ int(other_hash, 16)).bit_count()
+            if distance <= max_distance and (best is None or distance < best[1]):
+                best = (key, distance)
+        return best
+
+    def entries(self) -> list[dict]:
+        return [
+            {"ns": namespace, "hash": phash, "aspect": aspect, "key": key}
+            for namespace, key, phash, aspect in self.store.perceptual_entries()
+        ]
+
+
+PERCEPTUAL_INDEX = PerceptualIndex(STORE)
+
+
+@dataclass(frozen=True)
+class ScheduleHint:
+    """Who an OpenAI call is for and how urgent it is; see OpenAIScheduler."""
+
+    client_id: str = ""
+    priority: int = PRIORITY_INTERACTIVE
+    # Hard stop for retries as a time.time(), usually the request deadline. Each call also
+    # gets at most OPENAI_RETRY_BUDGET_SECONDS from its own first attempt.
+    deadline: float | None = None
+    # Set when the caller no longer wants the result (see GenerationCancelled).
+    cancel: threading.Event | None = None
+    # Called by the scheduler right before the call leaves the queue for OpenAI; raising skips the call.
+    on_start: Callable[[], None] | None = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel is not None and self.cancel.is_set()
+
+
+class TransientOpenAIError(Exception):
+    """An OpenAI failure worth retrying. str() is the user-facing message if retries run out."""
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GenerationCancelled(Exception):
+    """Raised instead of a result when the batch that asked for it has been cancelled."""
+
+
+class GenerationLeaseTaken(Exception):
+    """Raised when a queued call starts and another worker holds the generation lease for its image."""
+
+
+class OpenAIScheduler:
+    """
+    Process-wide gate for OpenAI calls. Every request submits its calls here
+    instead of running them on its own threads, so the number of calls in flight
+    stays at or below limit no matter how many requests are active, and a lone
+    request can use all of it when traffic is light.
+
+    limit adapts to OpenAI (AIMD): it is halved on a 429 and grows by one after
+    limit successful calls in a row, up to max_in_flight. A Retry-After from
+    OpenAI pauses the whole queue, not just the call that got it.
+
+    Waiting calls are queued per client. When a slot frees up, the call with the
+    best priority wins, and among equal priorities the client served least
+    recently goes first, so one large booklet cannot starve other users'
+    single images.
+    """
+
+    def __init__(self, max_in_flight: int):
+        self._max_in_flight = max_in_flight
+        self._limit = max_in_flight
+        self._in_flight = 0
+        # client -> heap of (priority, seq, enqueued_at, future, fn, args, on_start)
+        self._queues: dict[str, list[tuple]] = {}
+        self._last_served: dict[str, int] = {}
+        self._seq = itertools.count()
+        self._turns = itertools.count(1)
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self._threads: list[threading.Thread] = []
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    def set_limit(self, limit: int) -> None:
+        with self._cond:
+            self._limit = max(1, min(limit, self._max_in_flight))
+            self._cond.notify_all()
+
+    def record_success(self) -> None:
+        with self._cond:
+            self._successes += 1
+            if self._limit < self._max_in_flight and self._successes >= self._limit:
+                self._limit += 1
+                self._successes = 0
+                print(f"OpenAI-grense økt til {self._limit} samtidige kall", flush=True)
+                self._cond.notify_all()
+
+    def record_rate_limited(self, retry_after: float | None = None) -> None:
+        with self._cond:
+            now = time.time()
+            self._successes = 0
+            if now - self._last_decrease >= OPENAI_AIMD_COOLDOWN_SECONDS and self._limit > 1:
+                self._limit = max(1, self._limit // 2)
+                self._last_decrease = now
+                print(f"OpenAI rate limit: grense senket til {self._limit} samtidige kall", flush=True)
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+
+    def submit(self, fn: Callable[..., bytes], *args, hint: ScheduleHint = ScheduleHint()) -> Future:
+        future: Future = Future()
+        with self._cond:
+            self._start_threads()
+            queue = self._queues.setdefault(hint.client_id, [])
+            heapq.heappush(queue, (hint.priority, next(self._seq), time.time(), future, fn, args, hint.on_start))
+            if self._in_flight >= self._limit:
+                print(
+                    f"OpenAI-kø: {self._queued()} venter fra {len(self._queues)} klienter, "
+                    f"{self._in_flight}/{self._limit} kall pågår",
+                    flush=True,
+                )
+            self._cond.notify()
+        return future
+
+    def has_idle_capacity(self) -> bool:
+        return self.idle_slots() > 0
+
+    def idle_slots(self) -> int:
+        """Call slots free right now; 0 while anything is queued or the queue is paused."""
+        with self._cond:
+            if self._queues or time.time() < self._paused_until:
+                return 0
+            return max(0, self._limit - self._in_flight)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queued": self._queued(),
+                "in_flight": self._in_flight,
+                "limit": self._limit,
+                "paused": max(0.0, round(self._paused_until - time.time(), 1)),
+            }
+
+    def _queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _rank(self, client_id: str, now: float) -> tuple[int, int, int]:
+        priority, seq, enqueued_at = self._queues[client_id][0][:3]
+        if now - enqueued_at > OPENAI_QUEUE_AGING_SECONDS:
+            priority = PRIORITY_INTERACTIVE
+        return priority, self._last_served.get(client_id, 0), seq
+
+    def _start_threads(self) -> None:
+        # Started on first use, so importing the module (CLI commands, tests) spawns nothing.
+        while len(self._threads) < self._max_in_flight:
+            thread = threading.Thread(target=self._work, name=f"openai-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_call(self) -> tuple[Future, Callable[..., bytes], tuple, Callable[[], None] | None]:
+        with self._cond:
+            while True:
+                now = time.time()
+                if now < self._paused_until:
+                    self._cond.wait(self._paused_until - now)
+                elif not self._queues or self._in_flight >= self._limit:
+                    self._cond.wait()
+                else:
+                    break
+            client_id = min(self._queues, key=lambda c: self._rank(c, now))
+            queue = self._queues[client_id]
+            _priority, _seq, _enqueued_at, future, fn, args, on_start = heapq.heappop(queue)
+            if not queue:
+                del self._queues[client_id]
+            self._last_served[client_id] = next(self._turns)
+            if len(self._last_served) > 1000:
+                self._last_served = {c: turn for c, turn in self._last_served.items() if c in self._queues}
+            self._in_flight += 1
+            return future, fn, args, on_start
+
+    def _work(self) -> None:
+        while True:
+            future, fn, args, on_start = self._next_call()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        if on_start is not None:
+                            on_start()
+                        future.set_result(fn(*args))
+                    except BaseException as exc:
+                        future.set_exception(exc)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify()
+
+
+OPENAI_SCHEDULER = OpenAIScheduler(MAX_PARALLEL_WORKERS)
+
+
+@dataclass
+class GeneratedOutput:
+    content: bytes
+    filename: str
+    kind: str  # "image" (PNG) or "pdf"
+    # Images left out of a partial booklet: {"image": 1-based index, "filename", "reason"}.
+    dropped: list[dict] = field(default_factory=list)
+    # Engine each page actually used, see engine_report().
+    engines: list[dict] = field(default_factory=list)
+    # Per-page tracing report for vector booklets, see trace_report().
+    traces: list[dict] = field(default_factory=list)
 
 
 @dataclass(frozen=True)
@@ -538,9 +1381,135 @@ class GenerationSettings:
     label: str
 
 
+class EngineLatencyTracker:
+    """
+    Recent OpenAI call durations per (model, quality), in this process.
+    estimate() is a high percentile of the last samples, or the prior from
+    ENGINE_LATENCY_PRIORS until min_samples calls have been timed.
+    """
+
+    def __init__(self, window: int = 50, min_samples: int = 3):
+        self._samples: dict[tuple[str, str], deque[float]] = {}
+        self._window = window
+        self._min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def record(self, settings: GenerationSettings, seconds: float) -> None:
+        with self._lock:
+            key = (settings.model, settings.quality)
+            self._samples.setdefault(key, deque(maxlen=self._window)).append(seconds)
+
+    def estimate(self, settings: GenerationSettings, percentile: float = 0.75) -> float:
+        key = (settings.model, settings.quality)
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < self._min_samples:
+            return ENGINE_LATENCY_PRIORS.get(key, 60.0)
+        return samples[min(len(samples) - 1, int(percentile * len(samples)))]
+
+
+ENGINE_LATENCY = EngineLatencyTracker()
+
+
+class HedgeStats:
+    """Counts hedged OpenAI calls and who won, and enforces the hedge-rate cap."""
+
+    def __init__(self, max_fraction: float):
+        self._max_fraction = max_fraction
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+
+    def record_call(self) -> None:
+        with self._lock:
+            self.calls += 1
+
+    def try_hedge(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self._max_fraction * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def record_winner(self, role: str) -> None:
+        with self._lock:
+            if role == "hedge":
+                self.hedge_wins += 1
+            else:
+                self.primary_wins += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "primary_wins": self.primary_wins,
+            }
+
+
+HEDGE_STATS = HedgeStats(OPENAI_HEDGE_MAX_PERCENT / 100)
+
+
 # -----------------------------
 # Helpers
 # -----------------------------
+def choose_engine(
+    prepared: PreparedImage,
+    detail_level: str,
+    requested: GenerationSettings,
+    deadline: float | None,
+    waves: int = 1,
+) -> GenerationSettings:
+    """
+    The requested engine, unless waves more rounds of OpenAI calls at its
+    estimated latency would overrun deadline. Then the best of the faster
+    ENGINE_PRESETS that still fits, or the fastest one if none do. A result
+    already cached for the requested engine is always used, and so is the
+    requested engine when there is no deadline (async jobs).
+    """
+    if ENGINE_DOWNGRADE == "off" or deadline is None:
+        return requested
+    remaining = deadline - time.time()
+    if waves * ENGINE_LATENCY.estimate(requested) <= remaining:
+        return requested
+    # Existence check only: the lookup (and its hit/miss count) happens in generate_coloring_bytes().
+    if COLORING_CACHE.contains(cache_key(prepared.openai_input_bytes, detail_level, requested)):
+        return requested
+
+    requested_estimate = ENGINE_LATENCY.estimate(requested)
+    faster = sorted(
+        (
+            settings
+            for settings in map(generation_settings_from_preset, ENGINE_PRESETS)
+            if ENGINE_LATENCY.estimate(settings) < requested_estimate
+        ),
+        key=ENGINE_LATENCY.estimate,
+        reverse=True,
+    )
+    if not faster:
+        return requested
+    chosen = next((s for s in faster if waves * ENGINE_LATENCY.estimate(s) <= remaining), faster[-1])
+    print(
+        f"Frist: {remaining:.0f} sek igjen, {waves} runde(r) med {requested.label} "
+        f"(~{requested_estimate:.0f} sek) rekkes ikke, bruker {chosen.label} for '{prepared.original_filename}'",
+        flush=True,
+    )
+    return chosen
+
+
+def engine_report(idx: int, requested: GenerationSettings, used: GenerationSettings) -> dict:
+    return {
+        "image": idx + 1,
+        "engine": used.label,
+        "model": used.model,
+        "quality": used.quality,
+        "downgraded": used != requested,
+    }
+
+
 def generation_settings_from_preset(preset: str | None) -> GenerationSettings:
     if preset in ENGINE_PRESETS:
         model, quality, label = ENGINE_PRESETS[preset]
@@ -569,79 +1538,180 @@ def sanitize_stem(filename: str) -> str:
     return stem or "bilde"
 
 
+def client_identity() -> str:
+    return request.headers.get("X-Forwarded-For", request.remote_addr or "unknown").split(",")[0].strip()
+
+
 def validate_rate_limit() -> None:
-    now = time.time()
-    remote_addr = request.headers.get("X-Forwarded-For", request.remote_addr or "unknown").split(",")[0].strip()
-    window_start = now - RATE_LIMIT_WINDOW_SECONDS
-    recent = [ts for ts in REQUEST_LOG.get(remote_addr, []) if ts > window_start]
-    if len(recent) >= MAX_REQUESTS_PER_WINDOW:
+    if not STORE.record_request(client_identity(), time.time(), RATE_LIMIT_WINDOW_SECONDS, MAX_REQUESTS_PER_WINDOW):
         raise ValueError("For mange genereringer på kort tid. Vent litt før du prøver igjen.")
-    recent.append(now)
-    REQUEST_LOG[remote_addr] = recent
 
 
-def pil_image_from_bytes(image_bytes: bytes) -> Image.Image:
-    try:
-        raw = Image.open(io.BytesIO(image_bytes))
-    except (UnidentifiedImageError, OSError) as exc:
-        raise ValueError("Ugyldig bildefil. Last opp JPG, PNG eller WebP.") from exc
+def derive_renditions(
+    base_img: Image.Image,
+    specs: tuple[tuple[str, int, int, int], ...] = RENDITION_SPECS,
+) -> dict[str, Image.Image]:
+    """
+    Builds a resolution pyramid from one decoded image.
+    Each rendition is resampled from the smallest level already built that
+    still covers it, so only the first step works on the big decode.
+    Renditions that need no resize share the parent image object.
+    """
+    targets = {name: fit_size(base_img.size, (box_w, box_h)) for name, box_w, box_h, _quality in specs}
+    levels: list[Image.Image] = [base_img]
+    renditions: dict[str, Image.Image] = {}
+
+    for name in sorted(targets, key=lambda n: targets[n][0] * targets[n][1], reverse=True):
+        target_w, target_h = targets[name]
+        parent = min(
+            (level for level in levels if level.width >= target_w and level.height >= target_h),
+            key=lambda level: level.width * level.height,
+        )
+        if parent.size == (target_w, target_h):
+            renditions[name] = parent
+            continue
+        derived = parent.resize((target_w, target_h), Image.LANCZOS)
+        levels.append(derived)
+        renditions[name] = derived
 
-    try:
-        with raw:
-            if raw.format not in ALLOWED_IMAGE_FORMATS:
-                raise ValueError("Ugyldig bildeformat. Last opp JPG, PNG eller WebP.")
-            width, height = raw.size
-            if width <= 0 or height <= 0 or width * height > MAX_IMAGE_PIXELS:
-                raise ValueError("Bildet er for stort. Prøv et mindre bilde.")
-            img = ImageOps.exif_transpose(raw)
-            return img.convert("RGB")
-    except Image.DecompressionBombError as exc:
-        raise ValueError("Bildet er for stort. Prøv et mindre bilde.") from exc
-    except OSError as exc:
-        raise ValueError("Ugyldig bildefil. Last opp JPG, PNG eller WebP.") from exc
-
-
-def image_to_jpeg_bytes(img: Image.Image, quality: int = 88) -> bytes:
-    buf = io.BytesIO()
-    img.save(buf, format="JPEG", quality=quality, optimize=True)
-    return buf.getvalue()
-
-
-def prepare_image_variants(image_bytes: bytes, filename: str) -> PreparedImage:
+    return renditions
+
+
+def spool_upload(stream: BinaryIO, filename: str, detach: bool = False) -> SpooledUpload | None:
+    """
+    Hashes and sizes an upload stream in chunks. Werkzeug already spools large
+    uploads to disk, so a seekable stream is used in place. With detach (async
+    jobs, which outlive the request that owns the stream) or an unseekable
+    stream, it is copied into a spooled temp file of its own (memory up to
+    UPLOAD_SPOOL_MEMORY_KB, disk beyond that) on the way.
+    Returns None for empty uploads.
+    """
+    in_place = not detach and stream.seekable()
+    spool = stream if in_place else tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MEMORY_KB * 1024)
+    digest = hashlib.sha256()
+    size = 0
+    while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+        digest.update(chunk)
+        if not in_place:
+            spool.write(chunk)
+        size += len(chunk)
+    if size == 0:
+        spool.close()
+        return None
+    spool.seek(0)
+    return SpooledUpload(filename=filename or "bilde", file=spool, size=size, sha256=digest.hexdigest())
+
+
+def rendition_specs(
+    pdf_box: tuple[int, int] | None = None, combo: bool = True
+) -> tuple[tuple[str, int, int, int], ...]:
+    """
+    RENDITION_SPECS with the pdf rendition fitted to pdf_box (pixels), never
+    above PDF_IMAGE_MAX_DIM, and without the combo rendition unless combo.
     """
-    Prepares two reusable variants:
-    - openai_input_bytes: JPEG, auto-rotated, RGB, max 1600 px
-    - pdf_bytes: JPEG, auto-rotated, RGB, max 2200 px
+    specs = []
+    for name, box_w, box_h, quality in RENDITION_SPECS:
+        if name == "combo" and not combo:
+            continue
+        if name == "pdf" and pdf_box is not None:
+            box_w, box_h = min(box_w, pdf_box[0]), min(box_h, pdf_box[1])
+        specs.append((name, box_w, box_h, quality))
+    return tuple(specs)
+
+
+def prepare_image_variants(
+    image_source: bytes | SpooledUpload,
+    filename: str,
+    pdf_box: tuple[int, int] | None = None,
+    combo: bool = True,
+) -> PreparedImage:
+    """
+    Prepares the reusable renditions from RENDITION_SPECS (auto-rotated RGB JPEGs):
+    - pdf_bytes: max PDF_IMAGE_MAX_DIM, or fitted to pdf_box (see BookletPdfBuilder.image_pixels)
+    - openai_input_bytes: max OPENAI_INPUT_MAX_DIM
+    - combo_bytes: fitted to one half of the single-mode combo image; None unless combo
+    The original upload is not kept.
     """
     start = time.time()
-    base_img = pil_image_from_bytes(image_bytes)
-
-    openai_img = base_img.copy()
-    if max(openai_img.size) > OPENAI_INPUT_MAX_DIM:
-        openai_img.thumbnail((OPENAI_INPUT_MAX_DIM, OPENAI_INPUT_MAX_DIM), Image.LANCZOS)
-    openai_input_bytes = image_to_jpeg_bytes(openai_img, quality=88)
-    openai_img.close()
+    specs = rendition_specs(pdf_box, combo)
+    max_dim = max(max(box_w, box_h) for _name, box_w, box_h, _quality in specs)
+    if isinstance(image_source, SpooledUpload):
+        original_size = image_source.size
+        base_img = pil_image_from_file(image_source.file, max_dim=max_dim)
+    else:
+        original_size = len(image_source)
+        base_img = pil_image_from_bytes(image_source, max_dim=max_dim)
 
-    pdf_img = base_img.copy()
-    if max(pdf_img.size) > PDF_IMAGE_MAX_DIM:
-        pdf_img.thumbnail((PDF_IMAGE_MAX_DIM, PDF_IMAGE_MAX_DIM), Image.LANCZOS)
-    pdf_bytes = image_to_jpeg_bytes(pdf_img, quality=90)
-    pdf_img.close()
-    base_img.close()
+    renditions = derive_renditions(base_img, specs)
+    encoded = {
+        name: image_to_jpeg_bytes(renditions[name], quality=quality) for name, _box_w, _box_h, quality in specs
+    }
+    for img in {id(img): img for img in [base_img, *renditions.values()]}.values():
+        img.close()
 
     print(
-        f"Preprocess '{filename}': orig={len(image_bytes)/1024:.0f}KB, "
-        f"openai={len(openai_input_bytes)/1024:.0f}KB, pdf={len(pdf_bytes)/1024:.0f}KB "
-        f"på {time.time() - start:.1f} sek",
+        f"Preprocess '{filename}': orig={original_size/1024:.0f}KB, "
+        f"openai={len(encoded['openai'])/1024:.0f}KB, pdf={len(encoded['pdf'])/1024:.0f}KB"
+        + (f", combo={len(encoded['combo'])/1024:.0f}KB" if combo else "")
+        + f" på {time.time() - start:.1f} sek",
         flush=True,
     )
 
     return PreparedImage(
         original_filename=filename,
-        original_bytes=image_bytes,
-        openai_input_bytes=openai_input_bytes,
-        pdf_bytes=pdf_bytes,
+        original_size=original_size,
+        openai_input_bytes=encoded["openai"],
+        pdf_bytes=encoded["pdf"],
+        combo_bytes=encoded.get("combo"),
+    )
+
+
+def _prepare_upload(upload: SpooledUpload, pdf_box: tuple[int, int] | None = None) -> PreparedImage:
+    try:
+        return prepare_image_variants(upload, upload.filename, pdf_box, combo=False)
+    except ValueError as e:
+        raise ValueError(f"{upload.filename}: {e}") from e
+    finally:
+        upload.close()
+
+
+def prepare_images_async(uploads: list[SpooledUpload], pdf_box: tuple[int, int] | None = None) -> list[Future]:
+    """
+    Submits uploads to PREPROCESS_EXECUTOR. Futures are returned in input order.
+    Byte-identical uploads share one future. Each spool is closed once preprocessed.
+    These are booklet pages, so no combo rendition is made; pdf_box sizes the
+    pdf rendition, see prepare_image_variants().
+    """
+    by_hash: dict[str, Future] = {}
+    futures = []
+    for upload in uploads:
+        future = by_hash.get(upload.sha256)
+        if future is None:
+            future = PREPROCESS_EXECUTOR.submit(_prepare_upload, upload, pdf_box)
+            future.add_done_callback(lambda f, u=upload: u.close() if f.cancelled() else None)
+            by_hash[upload.sha256] = future
+        else:
+            upload.close()
+        futures.append(future)
+    return futures
+
+
+def prepare_images_parallel(uploads: list[SpooledUpload]) -> list[PreparedImage]:
+    """Preprocesses uploads on PREPROCESS_EXECUTOR and returns them in input order."""
+    start = time.time()
+    futures = prepare_images_async(uploads)
+    try:
+        prepared_images = [future.result() for future in futures]
+    finally:
+        for future in futures:
+            future.cancel()
+
+    print(
+        f"Preprosessering av {len(prepared_images)} bilder ferdig på {time.time() - start:.1f} sek "
+        f"(workers={PREPROCESS_WORKERS})",
+        flush=True,
     )
+    return prepared_images
 
 
 def cache_key(image_bytes: bytes, detail_level: str, settings: GenerationSettings) -> str:
@@ -655,13 +1725,58 @@ def cache_key(image_bytes: bytes, detail_level: str, settings: GenerationSetting
     return h.hexdigest()
 
 
+def cache_namespace(detail_level: str, settings: GenerationSettings) -> str:
+    """Everything in cache_key except the image, for perceptual lookups."""
+    return cache_key(b"", detail_level, settings)
+
+
+def perceptual_hash(image_bytes: bytes) -> tuple[int, float] | None:
+    """
+    Gradient hash (dHash) of the normalized OpenAI input plus its aspect ratio.
+    The JPEG is decoded at reduced scale in grayscale and box-averaged down to
+    17x16; each bit says whether brightness rises left to right. All pixel work
+    runs as whole-image Pillow operations.
+    Returns None for low-texture images, where most bits would be noise or zero
+    and unrelated photos could collide.
+    """
+    n = PERCEPTUAL_HASH_SIZE
+    with Image.open(io.BytesIO(image_bytes)) as raw:
+        aspect = raw.width / raw.height
+        raw.draft("L", (n * 8, n * 8))
+        gray = raw.convert("L").resize((n + 1, n), Image.BOX)
+    left, right = gray.crop((0, 0, n, n)), gray.crop((1, 0, n + 1, n))
+    decisive = ImageChops.difference(right, left).point(lambda v: 255 if v > 2 else 0).histogram()[255]
+    if decisive < n * n * PERCEPTUAL_HASH_MIN_TEXTURE:
+        return None
+    bits = ImageChops.subtract(right, left).point(lambda v: 255 if v else 0).convert("1")
+    return int.from_bytes(bits.tobytes(), "big"), aspect
+
+
 def get_cached_coloring(image_bytes: bytes, detail_level: str, settings: GenerationSettings) -> bytes | None:
     key = cache_key(image_bytes, detail_level, settings)
-    path = CACHE_DIR / f"{key}.png"
-    if path.exists():
-        print(f"Cache hit: {path.name}", flush=True)
-        return path.read_bytes()
-    return None
+    cached = COLORING_CACHE.get(key)
+    if cached is not None:
+        print(f"Cache hit: {key}.png", flush=True)
+        return cached
+
+    if PERCEPTUAL_CACHE != "on":
+        return None
+    signature = perceptual_hash(image_bytes)
+    if signature is None:
+        return None
+    try:
+        match = PERCEPTUAL_INDEX.find(cache_namespace(detail_level, settings), *signature, PERCEPTUAL_HASH_MAX_DISTANCE)
+    except (OSError, sqlite3.Error) as exc:
+        print(f"Kunne ikke søke i perseptuell cache: {exc}", flush=True)
+        return None
+    if match is None:
+        return None
+    similar_key, distance = match
+    cached = COLORING_CACHE.get(similar_key, record_miss=False)
+    if cached is not None:
+        COLORING_CACHE.record_perceptual_hit()
+        print(f"Perseptuell cache hit: {similar_key}.png (avstand {distance})", flush=True)
+    return cached
 
 
 def set_cached_coloring(
@@ -671,12 +1786,152 @@ def set_cached_coloring(
     coloring_bytes: bytes,
 ) -> None:
     key = cache_key(image_bytes, detail_level, settings)
-    path = CACHE_DIR / f"{key}.png"
-    path.write_bytes(coloring_bytes)
+    try:
+        COLORING_CACHE.put(key, coloring_bytes)
+        signature = perceptual_hash(image_bytes) if PERCEPTUAL_CACHE == "on" else None
+        if signature is not None:
+            PERCEPTUAL_INDEX.add(cache_namespace(detail_level, settings), *signature, key)
+    except (OSError, sqlite3.Error) as exc:
+        print(f"Kunne ikke skrive cache {key}.png: {exc}", flush=True)
+
 
+def export_cache_snapshot(path: Path) -> int:
+    """
+    Writes the disk cache and perceptual index to one zip archive, oldest entry
+    first so an import rebuilds the same LRU order. PNGs are stored without
+    recompression. The archive is written to a temp file and renamed into place.
+    Returns the number of colorings written.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    exported: set[str] = set()
+    try:
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_STORED) as archive:
+            for key in COLORING_CACHE.keys():
+                data = COLORING_CACHE.read_stored(key)
+                if data is not None:
+                    archive.writestr(f"colorings/{key}.png", data)
+                    exported.add(key)
+            index_lines = [json.dumps(entry) for entry in PERCEPTUAL_INDEX.entries() if entry["key"] in exported]
+            archive.writestr("perceptual-index.jsonl", "".join(f"{line}\n" for line in index_lines))
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return len(exported)
+
+
+def import_cache_snapshot(path: Path) -> int:
+    """Loads a snapshot from export_cache_snapshot(). Entries already in the cache are kept as they are."""
+    imported = 0
+    with zipfile.ZipFile(path) as archive:
+        for name in archive.namelist():
+            match = re.fullmatch(r"colorings/([a-f0-9]{64})\.png", name)
+            if match is None or COLORING_CACHE.contains(match.group(1)):
+                continue
+            COLORING_CACHE.put(match.group(1), archive.read(name))
+            imported += 1
+        try:
+            index_lines = archive.read("perceptual-index.jsonl").decode("utf-8").splitlines()
+        except KeyError:
+            index_lines = []
+    for line in index_lines:
+        try:
+            entry = json.loads(line)
+            namespace, key = entry["ns"], entry["key"]
+            if COLORING_CACHE.contains(key):
+                PERCEPTUAL_INDEX.add(namespace, int(entry["hash"], 16), float(entry["aspect"]), key)
+        except (ValueError, KeyError, TypeError):
+            continue
+    return imported
+
+
+def _restore_cache_snapshot_in_background(path: Path, owner: str) -> None:
+    start = time.time()
+    try:
+        # The store outlives worker restarts, so one worker restores it once.
+        if not STORE.acquire_lease(SNAPSHOT_RESTORE_LEASE, owner, SNAPSHOT_RESTORE_LEASE_SECONDS):
+            return
+        imported = import_cache_snapshot(path)
+    except Exception as exc:
+        print(f"Kunne ikke lese cache-snapshot {path}: {exc!r}", flush=True)
+        return
+    print(f"Cache-snapshot lest inn: {imported} fargelegginger på {time.time() - start:.1f} sek", flush=True)
+
+
+def snapshot_cache_once(path: Path, owner: str, interval_seconds: int) -> None:
+    """Exports a snapshot unless another worker on the node already did in this interval. Never raises."""
+    try:
+        # The lease runs out just before the next round, so each round one worker wins.
+        if not STORE.acquire_lease(SNAPSHOT_EXPORT_LEASE, owner, interval_seconds * 0.9):
+            return
+        exported = export_cache_snapshot(path)
+        print(f"Cache-snapshot skrevet: {exported} fargelegginger til {path}", flush=True)
+    except Exception as exc:
+        print(f"Kunne ikke skrive cache-snapshot {path}: {exc!r}", flush=True)
 
-def cleanup_old_previews(max_age_seconds: int = 60 * 60) -> None:
-    cutoff = time.time() - max_age_seconds
+
+def _snapshot_cache_periodically(path: Path, interval_seconds: int, owner: str) -> None:
+    while True:
+        time.sleep(interval_seconds)
+        snapshot_cache_once(path, owner, interval_seconds)
+
+
+def start_background_tasks() -> None:
+    """
+    Starts per-process background work. Runs once at import of a serving process:
+    never in pool child processes or flask CLI commands. Every worker starts the
+    snapshot threads, but store leases let only one of them restore or export.
+    """
+    if CACHE_SNAPSHOT_PATH:
+        path = Path(CACHE_SNAPSHOT_PATH)
+        owner = uuid.uuid4().hex
+        if path.exists():
+            threading.Thread(
+                target=_restore_cache_snapshot_in_background, args=(path, owner), name="cache-restore", daemon=True
+            ).start()
+        if CACHE_SNAPSHOT_INTERVAL_MINUTES:
+            threading.Thread(
+                target=_snapshot_cache_periodically,
+                args=(path, CACHE_SNAPSHOT_INTERVAL_MINUTES * 60, owner),
+                name="cache-snapshot",
+                daemon=True,
+            ).start()
+    if OPENAI_WARMUP == "on":
+        threading.Thread(
+            target=_keep_openai_connections_warm,
+            args=(max(5, OPENAI_KEEPALIVE_SECONDS - 5),),
+            name="openai-warmup",
+            daemon=True,
+        ).start()
+
+
+def log_cache_stats() -> None:
+    stats = COLORING_CACHE.stats()
+    lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+    hit_rate = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+    print(
+        f"Cache: treff={hit_rate:.0%} (minne={stats['memory_hits']}, disk={stats['disk_hits']}, "
+        f"herav perseptuell={stats['perceptual_hits']}, "
+        f"bom={stats['misses']}), evictions minne/disk={stats['memory_evictions']}/{stats['disk_evictions']}, "
+        f"minne={stats['memory_bytes']/1024/1024:.1f}MB/{stats['memory_entries']}, "
+        f"disk={stats['disk_bytes']/1024/1024:.1f}MB/{stats['disk_entries']}",
+        flush=True,
+    )
+    if OPENAI_HEDGE == "on":
+        hedge = HEDGE_STATS.snapshot()
+        hedge_rate = hedge["hedges"] / hedge["calls"] if hedge["calls"] else 0.0
+        print(
+            f"Hedging: {hedge['hedges']} av {hedge['calls']} kall ({hedge_rate:.0%}), "
+            f"reserve vant {hedge['hedge_wins']}, original vant {hedge['primary_wins']}",
+            flush=True,
+        )
+
+
+def cleanup_old_previews() -> None:
+    for preview_id, suffix in STORE.pop_expired_previews():
+        (PREVIEW_DIR / f"{preview_id}.{suffix}").unlink(missing_ok=True)
+    # Files without a live row (crashed writes, older releases) are swept by age.
+    cutoff = time.time() - PREVIEW_TTL_SECONDS
     for path in PREVIEW_DIR.glob("*"):
         try:
             if path.stat().st_mtime < cutoff:
@@ -690,34 +1945,63 @@ def save_preview_file(content: bytes, filename: str, suffix: str) -> str:
         raise ValueError("Ugyldig forhåndsvisningstype.")
     cleanup_old_previews()
     preview_id = uuid.uuid4().hex
-    (PREVIEW_DIR / f"{preview_id}.{suffix}").write_bytes(content)
-    (PREVIEW_DIR / f"{preview_id}.txt").write_text(filename, encoding="utf-8")
+    path = PREVIEW_DIR / f"{preview_id}.{suffix}"
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, path)
+    STORE.add_preview(preview_id, filename, suffix, time.time() + PREVIEW_TTL_SECONDS)
     return preview_id
 
 
-def preview_path(preview_id: str) -> Path:
+def _preview_file(preview_id: str, suffix: str, expired_message: str) -> Path:
     if not re.fullmatch(r"[a-f0-9]{32}", preview_id or ""):
         raise ValueError("Ugyldig forhåndsvisning.")
-    path = PREVIEW_DIR / f"{preview_id}.png"
-    if not path.exists():
-        raise ValueError("Forhåndsvisningen er utløpt. Generer bildet på nytt.")
+    meta = STORE.get_preview(preview_id)
+    path = PREVIEW_DIR / f"{preview_id}.{suffix}"
+    if meta is None or meta[1] != suffix or not path.exists():
+        raise ValueError(expired_message)
     return path
 
 
+def preview_path(preview_id: str) -> Path:
+    return _preview_file(preview_id, "png", "Forhåndsvisningen er utløpt. Generer bildet på nytt.")
+
+
 def preview_filename(preview_id: str) -> str:
-    path = PREVIEW_DIR / f"{preview_id}.txt"
-    if not path.exists():
+    meta = STORE.get_preview(preview_id)
+    if meta is None:
         return "fargeleggingsark-combo.png"
-    return path.read_text(encoding="utf-8").strip() or "fargeleggingsark-combo.png"
+    return meta[0].strip() or "fargeleggingsark-combo.png"
 
 
 def pdf_preview_path(preview_id: str) -> Path:
-    if not re.fullmatch(r"[a-f0-9]{32}", preview_id or ""):
-        raise ValueError("Ugyldig forhåndsvisning.")
-    path = PREVIEW_DIR / f"{preview_id}.pdf"
-    if not path.exists():
-        raise ValueError("Forhåndsvisningen er utløpt. Generer heftet på nytt.")
-    return path
+    return _preview_file(preview_id, "pdf", "Forhåndsvisningen er utløpt. Generer heftet på nytt.")
+
+
+def memory_usage_mb() -> tuple[float, float] | None:
+    """Current and peak RSS of this process in MB, read from /proc (Linux/Render only)."""
+    try:
+        status = Path("/proc/self/status").read_text(encoding="utf-8")
+    except OSError:
+        return None
+    values = dict(re.findall(r"^(VmRSS|VmHWM):\s+(\d+) kB", status, re.MULTILINE))
+    if "VmRSS" not in values or "VmHWM" not in values:
+        return None
+    return int(values["VmRSS"]) / 1024, int(values["VmHWM"]) / 1024
+
+
+def log_memory_usage(label: str, since_rss: float | None = None) -> float | None:
+    """
+    Logs current RSS and the peak of the whole process (VmHWM, which never goes
+    down), plus the RSS change since since_rss if given. Returns the current RSS.
+    """
+    usage = memory_usage_mb()
+    if usage is None:
+        return None
+    rss, peak = usage
+    delta = f", endring={rss - since_rss:+.0f}MB" if since_rss is not None else ""
+    print(f"Minne {label}: rss={rss:.0f}MB{delta}, prosess-topp={peak:.0f}MB", flush=True)
+    return rss
 
 
 def log_openai_usage(result) -> None:
@@ -740,12 +2024,312 @@ def log_openai_usage(result) -> None:
     )
 
 
-def generate_coloring_bytes(prepared: PreparedImage, detail_level: str, settings: GenerationSettings) -> bytes:
-    """Calls OpenAI image API and returns PNG bytes for the coloring image."""
+def generate_coloring_bytes(
+    prepared: PreparedImage,
+    detail_level: str,
+    settings: GenerationSettings,
+    on_stage: Callable[[str], None] | None = None,
+    hint: ScheduleHint = ScheduleHint(),
+) -> bytes:
+    """
+    Returns PNG bytes for the coloring image, from cache or OpenAI.
+    Concurrent callers for the same cache_key share one OpenAI call (single-flight).
+    on_stage is told "cached" on a cache hit; otherwise "queued" when the call is
+    handed to OPENAI_SCHEDULER and "generating" once the scheduler starts it.
+    hint places the OpenAI call in OPENAI_SCHEDULER's queue.
+    """
     cached = get_cached_coloring(prepared.openai_input_bytes, detail_level, settings)
     if cached is not None:
+        if on_stage is not None:
+            on_stage("cached")
         return cached
 
+    if on_stage is not None:
+        on_stage("queued")
+        outer_start = hint.on_start
+
+        def report_start() -> None:
+            if outer_start is not None:
+                outer_start()
+            on_stage("generating")
+
+        hint = replace(hint, on_start=report_start)
+
+    key = cache_key(prepared.openai_input_bytes, detail_level, settings)
+    while True:
+        with INFLIGHT_LOCK:
+            shared = INFLIGHT_GENERATIONS.get(key)
+            is_leader = shared is None
+            if is_leader:
+                shared = Future()
+                INFLIGHT_GENERATIONS[key] = shared
+        if is_leader:
+            break
+
+        print(f"Venter på pågående generering av samme bilde ('{prepared.original_filename}')", flush=True)
+        try:
+            return _wait_unless_cancelled(shared, hint)
+        except GenerationCancelled:
+            if hint.cancelled:
+                raise
+            # The leader's batch was cancelled, not ours: take over.
+
+    try:
+        # A leader that finished just before we took over has already filled the cache.
+        # The miss was counted by the lookup above, so this re-check records none.
+        coloring_bytes = COLORING_CACHE.get(key, record_miss=False)
+        if coloring_bytes is None:
+            coloring_bytes = _generate_with_lease(key, prepared, detail_level, settings, hint)
+    except BaseException as exc:
+        shared.set_exception(exc)
+        raise
+    else:
+        shared.set_result(coloring_bytes)
+        return coloring_bytes
+    finally:
+        with INFLIGHT_LOCK:
+            INFLIGHT_GENERATIONS.pop(key, None)
+
+
+def _generate_with_lease(
+    key: str,
+    prepared: PreparedImage,
+    detail_level: str,
+    settings: GenerationSettings,
+    hint: ScheduleHint = ScheduleHint(),
+) -> bytes:
+    """
+    Cross-worker single-flight: only the worker holding the lease for key calls
+    OpenAI. Others poll the shared cache until the result shows up, or take over
+    if the lease is released or expires without one.
+    The lease is taken before the call is queued and renewed each time it leaves
+    the scheduler queue, so GENERATION_LEASE_SECONDS counts from the actual call.
+    If the lease ran out while queued and another worker took it, this one waits.
+    """
+    owner = uuid.uuid4().hex
+
+    def renew_lease() -> None:
+        if not STORE.acquire_lease(key, owner, GENERATION_LEASE_SECONDS):
+            raise GenerationLeaseTaken()
+        if hint.on_start is not None:
+            hint.on_start()
+
+    while True:
+        if STORE.acquire_lease(key, owner, GENERATION_LEASE_SECONDS):
+            try:
+                return _call_openai_with_retries(
+                    prepared, detail_level, settings, replace(hint, on_start=renew_lease)
+                )
+            except GenerationLeaseTaken:
+                pass
+            finally:
+                STORE.release_lease(key, owner)
+
+        print(f"En annen worker genererer samme bilde ('{prepared.original_filename}'), venter", flush=True)
+        while STORE.lease_active(key):
+            _sleep_unless_cancelled(1, hint)
+            cached = COLORING_CACHE.get(key, record_miss=False)
+            if cached is not None:
+                return cached
+        cached = COLORING_CACHE.get(key, record_miss=False)
+        if cached is not None:
+            return cached
+
+
+def _call_openai_with_retries(
+    prepared: PreparedImage, detail_level: str, settings: GenerationSettings, hint: ScheduleHint
+) -> bytes:
+    """
+    Queues the OpenAI call on OPENAI_SCHEDULER and re-queues transient failures
+    with jittered backoff for up to OPENAI_RETRY_BUDGET_SECONDS from this call's
+    first attempt (never past hint.deadline), up to OPENAI_MAX_ATTEMPTS.
+    The slot is released while backing off, so other calls keep flowing.
+    Raises GenerationCancelled as soon as hint is cancelled.
+    """
+    deadline = time.time() + OPENAI_RETRY_BUDGET_SECONDS
+    if hint.deadline is not None:
+        deadline = min(deadline, hint.deadline)
+    attempt = 0
+    while True:
+        try:
+            return _await_openai_call(
+                lambda: OPENAI_SCHEDULER.submit(_call_openai_coloring, prepared, detail_level, settings, hint=hint),
+                settings,
+                hint,
+                prepared.original_filename,
+            )
+        except TransientOpenAIError as exc:
+            attempt += 1
+            delay = _backoff_seconds(attempt, exc.retry_after)
+            if attempt >= OPENAI_MAX_ATTEMPTS or time.time() + delay > deadline:
+                print(
+                    f"Gir opp '{prepared.original_filename}' etter {attempt} forsøk: {exc.__cause__!r}",
+                    flush=True,
+                )
+                raise ValueError(str(exc)) from exc
+            print(
+                f"Midlertidig OpenAI-feil for '{prepared.original_filename}' ({exc.__cause__!r}), "
+                f"nytt forsøk {attempt + 1} om {delay:.1f} sek",
+                flush=True,
+            )
+            _sleep_unless_cancelled(delay, hint)
+
+
+def _await_openai_call(
+    submit: Callable[[], Future], settings: GenerationSettings, hint: ScheduleHint, filename: str
+) -> bytes:
+    """
+    Runs submit() and waits for its result. With OPENAI_HEDGE on, a call still
+    running after the OPENAI_HEDGE_PERCENTILE latency for settings gets a second,
+    identical call (within the HEDGE_STATS cap and only if the scheduler has a free
+    slot); the first success wins and the other is cancelled or, if already at
+    OpenAI, left to finish into the cache.
+    """
+    primary = submit()
+    if OPENAI_HEDGE == "off":
+        return _wait_unless_cancelled(primary, hint)
+
+    HEDGE_STATS.record_call()
+    hedge_after = ENGINE_LATENCY.estimate(settings, OPENAI_HEDGE_PERCENTILE / 100)
+    started = None
+    while True:
+        try:
+            return primary.result(timeout=0.25)
+        except FutureTimeoutError:
+            if hint.cancelled:
+                primary.cancel()
+                raise GenerationCancelled()
+            if started is None and primary.running():
+                # Latency is timed from when the call reaches OpenAI, not from when it was queued.
+                started = time.time()
+            if (
+                started is not None
+                and time.time() - started >= hedge_after
+                and OPENAI_SCHEDULER.has_idle_capacity()
+                and HEDGE_STATS.try_hedge()
+            ):
+                break
+
+    print(f"Kall for '{filename}' har gått i {time.time() - started:.0f} sek, sender et ekstra (hedge)", flush=True)
+    racing = {primary: "primary", submit(): "hedge"}
+    errors: list[BaseException] = []
+    while racing:
+        done, _ = wait(racing, timeout=0.25, return_when=FIRST_COMPLETED)
+        if hint.cancelled:
+            for future in racing:
+                future.cancel()
+            raise GenerationCancelled()
+        for future in done:
+            role = racing.pop(future)
+            if future.exception() is not None:
+                errors.append(future.exception())
+                continue
+            for other in racing:
+                other.cancel()
+            HEDGE_STATS.record_winner(role)
+            print(f"Hedge for '{filename}': {role} vant, {HEDGE_STATS.snapshot()}", flush=True)
+            return future.result()
+    raise errors[0]
+
+
+def _sleep_unless_cancelled(seconds: float, hint: ScheduleHint) -> None:
+    if hint.cancel is None:
+        time.sleep(seconds)
+    elif hint.cancel.wait(seconds):
+        raise GenerationCancelled()
+
+
+def _wait_unless_cancelled(future: Future, hint: ScheduleHint) -> bytes:
+    """future.result(), but gives up (and unqueues future if it has not started) once hint is cancelled."""
+    if hint.cancel is None:
+        return future.result()
+    while True:
+        try:
+            return future.result(timeout=0.25)
+        except FutureTimeoutError:
+            if hint.cancelled:
+                future.cancel()
+                raise GenerationCancelled()
+
+
+def openai_timeout(settings: GenerationSettings) -> httpx.Timeout:
+    """Connect fails fast; read waits as long as the engine can reasonably need."""
+    read = ENGINE_READ_TIMEOUTS.get((settings.model, settings.quality), DEFAULT_READ_TIMEOUT_SECONDS)
+    return httpx.Timeout(read, connect=OPENAI_CONNECT_TIMEOUT_SECONDS)
+
+
+def warm_openai_connections(slots: int = MAX_PARALLEL_WORKERS) -> None:
+    """
+    Opens the pooled TLS connections to OpenAI before real calls need them, with
+    one cheap request per slot in parallel so each gets its own connection.
+    """
+    start = time.time()
+
+    def ping(_slot: int) -> None:
+        client.models.retrieve(OPENAI_IMAGE_MODEL, timeout=OPENAI_CONNECT_TIMEOUT_SECONDS * 2)
+
+    with ThreadPoolExecutor(max_workers=slots, thread_name_prefix="openai-warmup") as executor:
+        errors = [f.exception() for f in [executor.submit(ping, n) for n in range(slots)]]
+    failed = [e for e in errors if e is not None]
+    if failed:
+        print(f"OpenAI warm-up feilet for {len(failed)} av {len(errors)} forbindelser: {failed[0]!r}", flush=True)
+    else:
+        print(f"OpenAI warm-up: {len(errors)} forbindelser klare på {time.time() - start:.1f} sek", flush=True)
+
+
+def _keep_openai_connections_warm(interval_seconds: float) -> None:
+    # Re-warming just before keep-alive expiry means the first call after a quiet spell skips the handshake.
+    # Busy slots already have a live connection, so only the idle ones are pinged.
+    while True:
+        slots = OPENAI_SCHEDULER.idle_slots()
+        if slots:
+            warm_openai_connections(slots)
+        time.sleep(interval_seconds)
+
+
+def _parse_reset_duration(value: str) -> float | None:
+    """Parses OpenAI's x-ratelimit-reset-* values such as "20ms", "1s" or "6m0s"."""
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value or "")
+    if not parts:
+        return None
+    unit_seconds = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * unit_seconds[unit] for number, unit in parts)
+
+
+def retry_after_seconds(headers) -> float | None:
+    """Seconds OpenAI asks us to wait, from Retry-After(-Ms) or exhausted x-ratelimit-* headers."""
+    if headers is None:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        if headers.get("retry-after"):
+            value = headers["retry-after"]
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+
+    waits = [
+        _parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+        for kind in ("requests", "tokens")
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0"
+    ]
+    waits = [w for w in waits if w is not None]
+    return max(waits) if waits else None
+
+
+def _backoff_seconds(attempt: int, retry_after: float | None) -> float:
+    """Full-jitter exponential backoff; a server-given Retry-After wins, plus a little jitter."""
+    if retry_after is not None:
+        return retry_after + random.uniform(0, 1)
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX_SECONDS, OPENAI_BACKOFF_BASE_SECONDS * 2**attempt))
+
+
+def _call_openai_coloring(prepared: PreparedImage, detail_level: str, settings: GenerationSettings) -> bytes:
+    """Calls OpenAI image API, caches and returns PNG bytes for the coloring image."""
     prompt = build_prompt(detail_level)
 
     buf = io.BytesIO(prepared.openai_input_bytes)
@@ -760,6 +2344,7 @@ def generate_coloring_bytes(prepared: PreparedImage, detail_level: str, settings
             size=IMAGE_SIZE_STR,
             output_format="png",
             quality=settings.quality,
+            timeout=openai_timeout(settings),
         )
     except BadRequestError as e:
         error_text = str(e)
@@ -769,13 +2354,26 @@ def generate_coloring_bytes(prepared: PreparedImage, detail_level: str, settings
             raise ValueError(
                 "OpenAI-kontoen har nådd billing-grensen. Øk grensen i OpenAI eller bruk Mini / medium og prøv igjen."
             ) from e
-        raise
+        raise ValueError("OpenAI avviste bildet. Prøv et annet bilde.") from e
     except RateLimitError as exc:
-        raise ValueError("OpenAI har midlertidig rate limit. Prøv igjen om litt.") from exc
+        if "insufficient_quota" in str(exc):
+            raise ValueError("OpenAI-kontoen er tom for kvote. Fyll på kreditt i OpenAI og prøv igjen.") from exc
+        retry_after = retry_after_seconds(exc.response.headers)
+        OPENAI_SCHEDULER.record_rate_limited(retry_after)
+        raise TransientOpenAIError("OpenAI har midlertidig rate limit. Prøv igjen om litt.", retry_after) from exc
     except (APITimeoutError, APIConnectionError) as exc:
-        raise ValueError("Kunne ikke nå OpenAI akkurat nå. Prøv igjen om litt.") from exc
+        raise TransientOpenAIError("Kunne ikke nå OpenAI akkurat nå. Prøv igjen om litt.") from exc
     except APIStatusError as exc:
-        raise ValueError("OpenAI svarte med en midlertidig feil. Prøv igjen om litt.") from exc
+        if exc.status_code in (408, 409) or exc.status_code >= 500:
+            raise TransientOpenAIError(
+                "OpenAI svarte med en midlertidig feil. Prøv igjen om litt.", retry_after_seconds(exc.response.headers)
+            ) from exc
+        raise ValueError("OpenAI avviste forespørselen. Prøv igjen om litt.") from exc
+    except OpenAIError as exc:
+        # Anything else from the SDK (e.g. a response it could not parse) fails this image only.
+        raise ValueError("Uventet svar fra OpenAI. Prøv igjen om litt.") from exc
+
+    OPENAI_SCHEDULER.record_success()
 
     elapsed = time.time() - start
     print(
@@ -784,6 +2382,7 @@ def generate_coloring_bytes(prepared: PreparedImage, detail_level: str, settings
         flush=True,
     )
     log_openai_usage(result)
+    ENGINE_LATENCY.record(settings, elapsed)
 
     image_base64 = result.data[0].b64_json
     coloring_bytes = base64.b64decode(image_base64)
@@ -792,60 +2391,188 @@ def generate_coloring_bytes(prepared: PreparedImage, detail_level: str, settings
 
 
 def generate_coloring_batch_parallel(
-    prepared_images: list[PreparedImage],
+    prepared_images: list[PreparedImage | Future],
     detail: str,
     settings: GenerationSettings,
+    on_result: Callable[[int, bytes], None] | None = None,
+    on_progress: Callable[[int, str], None] | None = None,
+    client_id: str = "",
+    on_failure: Callable[[int, ValueError], None] | None = None,
+    on_engine: Callable[[int, GenerationSettings], None] | None = None,
+    deadline: float | None = None,
 ) -> list[bytes]:
-    """Generate coloring images in parallel and preserve original order."""
+    """
+    Generate coloring images in parallel and preserve original order.
+    Entries may be futures from prepare_images_async(); each image is sent to
+    OpenAI as soon as its own preprocessing is done, while later images are
+    still being decoded. on_result(idx, coloring_bytes) is called as each
+    image finishes, in completion order. on_progress(idx, stage) reports
+    "preprocessed", "queued", "generating", "cached", "done" and "failed".
+    OpenAI calls are queued for client_id; the first BOOKLET_PRIORITY_PAGES images
+    get single-image priority, the rest bulk priority.
+
+    Without on_failure, the first failing image cancels everything still queued
+    or backing off and its error is raised right away. With on_failure, a failing
+    image is reported as on_failure(idx, error) and the rest carry on; only if
+    every image fails is the first error raised. Returns the successful results.
+
+    Each image runs on choose_engine(): settings, or a faster preset if the
+    images still left would not finish by deadline (a time.time(), see
+    request_deadline()). on_engine(idx, used_settings) tells which one.
+    """
     batch_start = time.time()
+    cancel = threading.Event()
     results: list[bytes | None] = [None] * len(prepared_images)
+    failures: list[ValueError] = []
 
-    max_workers = min(MAX_PARALLEL_WORKERS, len(prepared_images))
+    # These threads only orchestrate (cache lookups, waiting on futures); the OpenAI calls
+    # themselves are capped process-wide by OPENAI_SCHEDULER.
+    max_workers = max(1, len(prepared_images))
     print(
-        f"Starter parallell OpenAI-generering: {len(prepared_images)} bilder, workers={max_workers}",
+        f"Starter parallell OpenAI-generering: {len(prepared_images)} bilder, "
+        f"OpenAI-kø: {OPENAI_SCHEDULER.stats()}",
         flush=True,
     )
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_idx = {
-            executor.submit(generate_coloring_bytes, prepared, detail, settings): idx
-            for idx, prepared in enumerate(prepared_images)
-        }
-
-        for future in as_completed(future_to_idx):
-            idx = future_to_idx[future]
-            try:
-                results[idx] = future.result()
-                print(f"Parallelt bilde {idx + 1} ferdig", flush=True)
-            except ValueError as e:
-                if "moderation_blocked" in str(e):
-                    raise ValueError(f"moderation_blocked_{idx + 1}")
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    # One entry per distinct future; byte-identical uploads share a preprocessing future,
+    # and uploads that preprocess to the same cache_key share a generation future.
+    pending: dict[Future, tuple[str, list[int]]] = {}
+    generation_by_key: dict[str, Future] = {}
+    engine_by_future: dict[Future, GenerationSettings] = {}
+
+    def report(idxs: list[int], stage: str) -> None:
+        if on_progress is not None:
+            for idx in list(idxs):
+                on_progress(idx, stage)
+
+    def fail(idxs: list[int], error: ValueError) -> None:
+        if "moderation_blocked" in str(error):
+            error = ValueError(f"moderation_blocked_{idxs[0] + 1}")
+        if on_failure is None:
+            raise error
+        for idx in idxs:
+            print(f"Parallelt bilde {idx + 1} droppet: {error}", flush=True)
+            failures.append(error)
+            report([idx], "failed")
+            on_failure(idx, error)
+
+    def finish_generation(future: Future, idxs: list[int]) -> None:
+        try:
+            coloring_bytes = future.result()
+        except ValueError as e:
+            fail(idxs, e)
+            return
+        except GenerationCancelled:
+            if cancel.is_set():
                 raise
+            # Cancelled by someone else's batch, not ours: this image failed, the rest go on.
+            fail(idxs, ValueError("Genereringen av bildet ble avbrutt. Prøv igjen."))
+            return
+        for idx in idxs:
+            results[idx] = coloring_bytes
+            print(f"Parallelt bilde {idx + 1} ferdig", flush=True)
+            report([idx], "done")
+            if on_result is not None:
+                on_result(idx, coloring_bytes)
+
+    def record_engine(future: Future, idxs: list[int]) -> None:
+        if on_engine is not None:
+            for idx in idxs:
+                on_engine(idx, engine_by_future[future])
+
+    def submit_generation(prepared: PreparedImage, idxs: list[int]) -> None:
+        key = cache_key(prepared.openai_input_bytes, detail, settings)
+        future = generation_by_key.get(key)
+        if future is None:
+            unfinished = sum(r is None for r in results) - len(failures)
+            waves = math.ceil(unfinished / OPENAI_SCHEDULER.limit)
+            engine = choose_engine(prepared, detail, settings, deadline, waves)
+            priority = PRIORITY_INTERACTIVE if min(idxs) < BOOKLET_PRIORITY_PAGES else PRIORITY_BULK
+            future = executor.submit(
+                generate_coloring_bytes,
+                prepared,
+                detail,
+                engine,
+                lambda stage: report(idxs, stage),
+                hint=ScheduleHint(client_id, priority, deadline, cancel),
+            )
+            generation_by_key[key] = future
+            engine_by_future[future] = engine
+            pending[future] = ("generate", idxs)
+            record_engine(future, idxs)
+        elif future in pending:
+            print(f"Parallelt bilde {idxs[0] + 1} er likt et annet bilde i heftet", flush=True)
+            # Later stages of the shared generation are reported for idxs too.
+            pending[future][1].extend(idxs)
+            record_engine(future, idxs)
+        else:
+            record_engine(future, idxs)
+            finish_generation(future, idxs)
 
+    try:
+        for idx, item in enumerate(prepared_images):
+            if isinstance(item, PreparedImage):
+                report([idx], "preprocessed")
+                submit_generation(item, [idx])
+            elif item in pending:
+                pending[item][1].append(idx)
+            else:
+                pending[item] = ("prepare", [idx])
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, idxs = pending.pop(future)
+                if stage == "prepare":
+                    try:
+                        prepared = future.result()
+                    except ValueError as e:
+                        fail(idxs, e)
+                        continue
+                    print(
+                        f"Parallelt bilde {idxs[0] + 1} preprosessert etter {time.time() - batch_start:.1f} sek",
+                        flush=True,
+                    )
+                    report(idxs, "preprocessed")
+                    submit_generation(prepared, idxs)
+                else:
+                    finish_generation(future, idxs)
+    except BaseException:
+        if pending:
+            print(f"Avbryter {len(pending)} gjenstående bilder i batchen", flush=True)
+        # Queued and backing-off OpenAI calls are dropped; a call already at OpenAI
+        # still finishes in the background and lands in the cache.
+        cancel.set()
+        for future in pending:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if failures and len(failures) == len(prepared_images):
+        raise failures[0]
     print(f"Parallell batch ferdig på {time.time() - batch_start:.1f} sek", flush=True)
     return [r for r in results if r is not None]
 
 
-def combine_side_by_side_bytes(original_pdf_bytes: bytes, coloring_bytes: bytes) -> bytes:
+def combine_side_by_side_bytes(original_combo_bytes: bytes, coloring_bytes: bytes) -> bytes:
     """
     Single mode PNG output:
     builds a combined PNG with original left + coloring right.
-    Uses preprocessed original bytes for lower memory usage.
+    Uses the combo rendition, which is already fitted to one half.
     """
-    orig = pil_image_from_bytes(original_pdf_bytes)
+    orig = pil_image_from_bytes(original_combo_bytes)
     col = pil_image_from_bytes(coloring_bytes)
 
     canvas_img = Image.new("RGB", (SIDE_WIDTH * 2, SIDE_HEIGHT), color=(255, 255, 255))
 
     def place_in_box(img: Image.Image, box_left: int):
-        img_copy = img.copy()
-        if max(img_copy.size) > SINGLE_COMBO_MAX_DIM:
-            img_copy.thumbnail((SINGLE_COMBO_MAX_DIM, SINGLE_COMBO_MAX_DIM), Image.LANCZOS)
-        img_copy.thumbnail((SIDE_WIDTH, SIDE_HEIGHT), Image.LANCZOS)
-        x_offset = box_left + (SIDE_WIDTH - img_copy.width) // 2
-        y_offset = (SIDE_HEIGHT - img_copy.height) // 2
-        canvas_img.paste(img_copy, (x_offset, y_offset))
-        img_copy.close()
+        if img.width > SIDE_WIDTH or img.height > SIDE_HEIGHT:
+            img.thumbnail((SIDE_WIDTH, SIDE_HEIGHT), Image.LANCZOS)
+        x_offset = box_left + (SIDE_WIDTH - img.width) // 2
+        y_offset = (SIDE_HEIGHT - img.height) // 2
+        canvas_img.paste(img, (x_offset, y_offset))
 
     place_in_box(orig, box_left=0)
     place_in_box(col, box_left=SIDE_WIDTH)
@@ -861,18 +2588,80 @@ def combine_side_by_side_bytes(original_pdf_bytes: bytes, coloring_bytes: bytes)
     return out_buf.getvalue()
 
 
-def pil_to_imagereader(img: Image.Image) -> ImageReader:
+def trace_report(idx: int, page: TracedPage, vector: bool) -> dict:
+    """Fidelity and size of a traced page; vector is False when the raster line art was used instead."""
+    return {
+        "image": idx + 1,
+        "vector": vector,
+        "paths": page.paths,
+        "fidelity": round(page.fidelity, 4),
+        "bytes": len(zlib.compress(page.code.encode("ascii"))),
+        "seconds": round(page.seconds, 2),
+    }
+
+
+class _PdfImageXObject(pdfdoc.PDFImageXObject):
+    """PDFImageXObject that can also write /DecodeParms, which CCITTFaxDecode streams need."""
+
+    decode_parms: tuple[tuple[str, int], ...] = ()
+
+    def format(self, document):
+        if not self.decode_parms:
+            return super().format(document)
+        stream = pdfdoc.PDFStream(content=self.streamContent)
+        stream.dictionary["Type"] = pdfdoc.PDFName("XObject")
+        stream.dictionary["Subtype"] = pdfdoc.PDFName("Image")
+        stream.dictionary["Width"] = self.width
+        stream.dictionary["Height"] = self.height
+        stream.dictionary["BitsPerComponent"] = self.bitsPerComponent
+        stream.dictionary["ColorSpace"] = pdfdoc.PDFName(self.colorSpace)
+        stream.dictionary["Filter"] = pdfdoc.PDFArray([pdfdoc.PDFName(f) for f in self._filters])
+        stream.dictionary["DecodeParms"] = pdfdoc.PDFArray([pdfdoc.PDFDictionary(dict(self.decode_parms))])
+        return stream.format(document)
+
+
+def _draw_image_stream(c, image: PdfImageStream, x: float, y: float, width: float, height: float):
     """
-    Fast path: use ImageReader directly on PIL image.
-    Fallback: convert to JPEG bytes if environment is picky.
+    Same as canvas.drawImage, but for a stream that is already compressed, so the
+    canvas does no decoding or compression of its own. Identical streams are
+    embedded once.
+    ReportLab has no public API for this, so it mirrors canvas.drawImage's use of
+    _doc, _code and _formsinuse. reportlab is pinned in requirements.txt for that.
     """
-    try:
-        return ImageReader(img)
-    except Exception:
-        buf = io.BytesIO()
-        img.convert("RGB").save(buf, format="JPEG", quality=90, optimize=True)
-        buf.seek(0)
-        return ImageReader(buf)
+    reg_name = c._doc.getXObjectName(image.name)
+    if c._doc.idToObject.get(reg_name) is None:
+        xobj = _PdfImageXObject(image.name)
+        xobj.decode_parms = image.decode_parms
+        xobj.width = image.width
+        xobj.height = image.height
+        xobj.colorSpace = image.color_space
+        xobj.bitsPerComponent = image.bits_per_component
+        xobj._filters = image.filters
+        xobj.streamContent = image.data
+        xobj.mask = None
+        c._setXObjects(xobj)
+        c._doc.Reference(xobj, reg_name)
+        c._doc.addForm(image.name, xobj)
+
+    c._currentPageHasImages = 1
+    c.saveState()
+    c.translate(x, y)
+    c.scale(width, height)
+    c._code.append(f"/{reg_name} Do")
+    c.restoreState()
+    c._formsinuse.append(image.name)
+
+
+def _draw_traced_page(c, page: TracedPage, x: float, y: float, width: float, height: float):
+    """Paints a traced coloring page into the given box, flipping its y-down pixel units."""
+    if not page.code:
+        return
+    c.saveState()
+    c.translate(x, y + height)
+    c.scale(width / page.width, -height / page.height)
+    c.setFillGray(0)
+    c._code.append(page.code)
+    c.restoreState()
 
 
 def _pdf_page_geometry(paper: str):
@@ -894,24 +2683,19 @@ def _pdf_page_geometry(paper: str):
     return pagesize, page_w, page_h, (x0, y0, usable_w, usable_h)
 
 
-def _draw_fit(c, pil_img: Image.Image, x0: float, y0: float, usable_w: float, usable_h: float):
-    iw, ih = pil_img.size
-    scale = min(usable_w / iw, usable_h / ih)
-    tw = iw * scale
-    th = ih * scale
-    dx = x0 + (usable_w - tw) / 2
-    dy = y0 + (usable_h - th) / 2
-    c.drawImage(pil_to_imagereader(pil_img), dx, dy, width=tw, height=th, mask="auto")
-
-
-def _draw_fit_in_box(c, pil_img: Image.Image, box_x: float, box_y: float, box_w: float, box_h: float):
-    iw, ih = pil_img.size
+def _draw_fit_in_box(
+    c, image: PdfImageStream | TracedPage, box_x: float, box_y: float, box_w: float, box_h: float
+):
+    iw, ih = image.width, image.height
     scale = min(box_w / iw, box_h / ih)
     tw = iw * scale
     th = ih * scale
     dx = box_x + (box_w - tw) / 2
     dy = box_y + (box_h - th) / 2
-    c.drawImage(pil_to_imagereader(pil_img), dx, dy, width=tw, height=th, mask="auto")
+    if isinstance(image, TracedPage):
+        _draw_traced_page(c, image, dx, dy, tw, th)
+    else:
+        _draw_image_stream(c, image, dx, dy, tw, th)
 
 
 def _set_cewe_pdf_boxes(c):
@@ -942,46 +2726,215 @@ def _set_cewe_pdf_boxes(c):
             pass
 
 
-def build_pdf_combo_direct_from_pairs(
-    original_pdf_bytes_list: list[bytes],
-    coloring_bytes_list: list[bytes],
-    paper: str,
-) -> bytes:
+def _pdf_encode_pool(broken: ProcessPoolExecutor | None = None) -> ProcessPoolExecutor:
+    """The shared PDF encoding pool, started on first use or to replace broken."""
+    global PDF_ENCODE_POOL
+    with PDF_ENCODE_POOL_LOCK:
+        if PDF_ENCODE_POOL is None or PDF_ENCODE_POOL is broken:
+            if broken is not None:
+                print("En PDF-kodeprosess stoppet uventet, starter nye prosesser", flush=True)
+                broken.shutdown(wait=False, cancel_futures=True)
+            PDF_ENCODE_POOL = ProcessPoolExecutor(
+                max_workers=PDF_ENCODE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+            print(f"Startet {PDF_ENCODE_WORKERS} prosesser for PDF-koding", flush=True)
+        return PDF_ENCODE_POOL
+
+
+def submit_pdf_encoding(*args) -> Future:
     """
-    Combo mode, optimized:
-    Draw original directly into left half and coloring directly into right half.
-    No intermediate combined PNG.
+    Starts encode_pdf_pair(*args) on PREPROCESS_EXECUTOR, or with PDF_ENCODE_WORKERS
+    on a process pool shared by all booklets. The pool uses spawn, since forking a
+    threaded web worker can copy held locks into the children. Under gunicorn the
+    children import only pdf_encoding; under `python app.py` spawn re-imports this
+    module as their __main__ too (see the parent_process() check at the bottom).
+    A worker that dies (e.g. OOM-killed) breaks the whole pool: it is replaced and
+    the pair is encoded once more on the new pool.
     """
-    pagesize, _page_w, _page_h, (x0, y0, usable_w, usable_h) = _pdf_page_geometry(paper)
+    if PDF_ENCODE_WORKERS == 0:
+        return PREPROCESS_EXECUTOR.submit(encode_pdf_pair, *args)
 
-    gutter = 6 * mm
-    half_w = (usable_w - gutter) / 2
-    left_x = x0
-    right_x = x0 + half_w + gutter
+    outcome: Future = Future()
+    outcome.set_running_or_notify_cancel()
 
-    out = io.BytesIO()
-    c = pdfcanvas.Canvas(out, pagesize=pagesize)
-    c.setTitle("Fargeleggingshefte (Kombosider)")
-    c.setAuthor("Fargeleggingsgenerator")
+    def attempt(retries_left: int, broken: ProcessPoolExecutor | None = None) -> None:
+        pool = _pdf_encode_pool(broken)
+        try:
+            future = pool.submit(encode_pdf_pair, *args)
+        except BrokenProcessPool as exc:
+            settle(pool, retries_left, exc, None)
+        else:
+            future.add_done_callback(lambda f: settle(pool, retries_left, f.exception(), f))
 
-    for idx, (original_pdf_bytes, coloring_bytes) in enumerate(zip(original_pdf_bytes_list, coloring_bytes_list), start=1):
-        page_start = time.time()
+    def settle(pool: ProcessPoolExecutor, retries_left: int, exc: BaseException | None, future: Future | None) -> None:
+        if isinstance(exc, BrokenProcessPool) and retries_left:
+            attempt(retries_left - 1, broken=pool)
+        elif exc is not None:
+            outcome.set_exception(exc)
+        else:
+            outcome.set_result(future.result())
 
-        orig = pil_image_from_bytes(original_pdf_bytes)
-        col = pil_image_from_bytes(coloring_bytes)
+    attempt(1)
+    return outcome
 
-        _draw_fit_in_box(c, orig, left_x, y0, half_w, usable_h)
-        _draw_fit_in_box(c, col, right_x, y0, half_w, usable_h)
-        c.showPage()
 
-        orig.close()
-        col.close()
+class BookletPdfBuilder:
+    """
+    Builds a booklet PDF while colorings are still arriving.
+    add_pair() encodes a pair's images with submit_pdf_encoding() right away, and
+    pages are written to the canvas in order as soon as every earlier pair is in.
+    finish() only has to write what is left and save.
+
+    Layouts:
+    - combo: original left and coloring right on one page
+    - album: original page, then coloring page
+    - cewe: CEWE FOTOBOK A4 portrait content test export. Uses CEWE template
+      values (205 x 270 mm trim, 3 mm bleed, 5 mm safe area), the album story
+      rhythm, and pads to 26 pages because CEWE's PDF photobook content
+      templates start there.
+
+    With vector=True, coloring pages are traced into vector outlines (see
+    trace_coloring()); traces holds a trace_report() per page.
+    """
 
-        print(f"Komboside {idx} direkte i PDF på {time.time() - page_start:.1f} sek", flush=True)
+    def __init__(
+        self,
+        layout: str,
+        paper: str = "A4",
+        on_page: Callable[[int], None] | None = None,
+        vector: bool = False,
+    ):
+        self.layout = layout if layout in ("combo", "album", "cewe") else "album"
+        if self.layout == "cewe":
+            pagesize = (
+                CEWE_A4_CONTENT_TRIM_W + 2 * CEWE_CONTENT_BLEED,
+                CEWE_A4_CONTENT_TRIM_H + 2 * CEWE_CONTENT_BLEED,
+            )
+            self._box = (
+                CEWE_CONTENT_BLEED + CEWE_CONTENT_SAFE,
+                CEWE_CONTENT_BLEED + CEWE_CONTENT_SAFE,
+                CEWE_A4_CONTENT_TRIM_W - 2 * CEWE_CONTENT_SAFE,
+                CEWE_A4_CONTENT_TRIM_H - 2 * CEWE_CONTENT_SAFE,
+            )
+            title = "Fargeleggingshefte (CEWE A4 innhold)"
+        else:
+            pagesize, _page_w, _page_h, self._box = _pdf_page_geometry(paper)
+            title = "Fargeleggingshefte (Kombosider)" if self.layout == "combo" else "Fargeleggingshefte (Album)"
+
+        # Pixels a photo needs to fill its box at PDF_TARGET_DPI.
+        image_w, image_h = self._box[2:]
+        if self.layout == "combo":
+            image_w = (image_w - COMBO_GUTTER) / 2
+        self.image_pixels = (math.ceil(image_w / 72 * PDF_TARGET_DPI), math.ceil(image_h / 72 * PDF_TARGET_DPI))
+
+        self._out = io.BytesIO()
+        self._canvas = pdfcanvas.Canvas(self._out, pagesize=pagesize)
+        self._canvas.setTitle(title)
+        self._canvas.setAuthor("Fargeleggingsgenerator")
+        self._lock = threading.Lock()
+        self._pending: dict[int, Future] = {}
+        self._written: set[int] = set()
+        self._next_idx = 0
+        self._pages = 0
+        self._on_page = on_page
+        self._vector = vector
+        self.traces: dict[int, dict] = {}
+
+    def add_pair(self, idx: int, original_pdf_bytes: bytes, coloring_bytes: bytes) -> None:
+        """Queues page pair idx (0-based). Safe to call from any thread, in any order."""
+        future = submit_pdf_encoding(original_pdf_bytes, coloring_bytes, self.image_pixels, self._vector)
+        with self._lock:
+            self._pending[idx] = future
+        future.add_done_callback(lambda _f: self._write_ready())
+
+    def _write_ready(self) -> None:
+        with self._lock:
+            while (
+                self._next_idx in self._pending
+                and self._pending[self._next_idx].done()
+                and self._pending[self._next_idx].exception() is None
+            ):
+                self._write_pair(self._next_idx)
+                self._next_idx += 1
+
+    def _write_pair(self, idx: int) -> None:
+        orig, col, encode_seconds, traced = self._pending.pop(idx).result()
+        page_start = time.time()
+        c = self._canvas
+        box_x, box_y, box_w, box_h = self._box
+
+        if self.layout == "combo":
+            half_w = (box_w - COMBO_GUTTER) / 2
+            _draw_fit_in_box(c, orig, box_x, box_y, half_w, box_h)
+            _draw_fit_in_box(c, col, box_x + half_w + COMBO_GUTTER, box_y, half_w, box_h)
+            self._show_page()
+            label = "Komboside"
+        else:
+            for image in (orig, col):
+                if self.layout == "cewe":
+                    _set_cewe_pdf_boxes(c)
+                _draw_fit_in_box(c, image, box_x, box_y, box_w, box_h)
+                self._show_page()
+            label = "CEWE-sidepar" if self.layout == "cewe" else "Bildepar"
+
+        self._written.add(idx)
+        if traced is not None:
+            report = self.traces[idx] = trace_report(idx, traced, vector=col is traced)
+            print(
+                f"Side {idx + 1} sporet: {report['paths']} konturer, {report['fidelity']:.1%} samsvar, "
+                f"{report['bytes'] / 1024:.0f} KB på {report['seconds']:.1f} sek"
+                + ("" if report["vector"] else " - for lavt samsvar, bruker rasterbilde"),
+                flush=True,
+            )
+        print(
+            f"{label} {idx + 1} skrevet til PDF på {time.time() - page_start:.2f} sek "
+            f"(forhåndskodet på {encode_seconds:.1f} sek)",
+            flush=True,
+        )
+        if self._on_page is not None:
+            self._on_page(idx)
+
+    def _show_page(self) -> None:
+        self._canvas.showPage()
+        self._pages += 1
+
+    def finish(self) -> bytes:
+        """Writes any remaining pairs in index order (skipping missing ones) and returns the PDF."""
+        with self._lock:
+            futures = list(self._pending.values())
+        for future in futures:
+            future.exception()
+
+        with self._lock:
+            for idx in sorted(self._pending):
+                self._write_pair(idx)
+            if self.layout == "cewe":
+                while self._pages < CEWE_CONTENT_MIN_PAGES:
+                    _set_cewe_pdf_boxes(self._canvas)
+                    self._show_page()
+            self._canvas.save()
+        return self._out.getvalue()
+
+
+def _build_pdf_from_pairs(
+    layout: str,
+    original_pdf_bytes_list: list[bytes],
+    coloring_bytes_list: list[bytes],
+    paper: str = "A4",
+) -> bytes:
+    builder = BookletPdfBuilder(layout, paper)
+    for idx, (original_pdf_bytes, coloring_bytes) in enumerate(zip(original_pdf_bytes_list, coloring_bytes_list)):
+        builder.add_pair(idx, original_pdf_bytes, coloring_bytes)
+    return builder.finish()
 
-    c.save()
-    out.seek(0)
-    return out.getvalue()
+
+def build_pdf_combo_direct_from_pairs(
+    original_pdf_bytes_list: list[bytes],
+    coloring_bytes_list: list[bytes],
+    paper: str,
+) -> bytes:
+    """Combo mode: original in the left half and coloring in the right half of each page."""
+    return _build_pdf_from_pairs("combo", original_pdf_bytes_list, coloring_bytes_list, paper)
 
 
 def build_pdf_album_from_pairs(
@@ -990,83 +2943,18 @@ def build_pdf_album_from_pairs(
     paper: str,
 ) -> bytes:
     """Album mode: page 1 original, page 2 coloring."""
-    pagesize, _page_w, _page_h, (x0, y0, usable_w, usable_h) = _pdf_page_geometry(paper)
-
-    out = io.BytesIO()
-    c = pdfcanvas.Canvas(out, pagesize=pagesize)
-    c.setTitle("Fargeleggingshefte (Album)")
-    c.setAuthor("Fargeleggingsgenerator")
-
-    for idx, (original_pdf_bytes, coloring_bytes) in enumerate(zip(original_pdf_bytes_list, coloring_bytes_list), start=1):
-        pair_start = time.time()
-
-        orig = pil_image_from_bytes(original_pdf_bytes)
-        _draw_fit(c, orig, x0, y0, usable_w, usable_h)
-        c.showPage()
-        orig.close()
-
-        col = pil_image_from_bytes(coloring_bytes)
-        _draw_fit(c, col, x0, y0, usable_w, usable_h)
-        c.showPage()
-        col.close()
-
-        print(f"Bildepar {idx} ferdig på {time.time() - pair_start:.1f} sek", flush=True)
-
-    c.save()
-    out.seek(0)
-    return out.getvalue()
+    return _build_pdf_from_pairs("album", original_pdf_bytes_list, coloring_bytes_list, paper)
 
 
 def build_pdf_cewe_a4_content(
     original_pdf_bytes_list: list[bytes],
     coloring_bytes_list: list[bytes],
 ) -> bytes:
-    """
-    CEWE FOTOBOK A4 portrait content test export.
-    Uses CEWE template values: 205 x 270 mm trim, 3 mm bleed, 5 mm safe area.
-    Uses the same story rhythm as album mode: original page, then coloring page.
-    Pads to 26 pages because CEWE's PDF photobook content templates start there.
-    """
-    page_w = CEWE_A4_CONTENT_TRIM_W + 2 * CEWE_CONTENT_BLEED
-    page_h = CEWE_A4_CONTENT_TRIM_H + 2 * CEWE_CONTENT_BLEED
-    pagesize = (page_w, page_h)
-
-    safe_x = CEWE_CONTENT_BLEED + CEWE_CONTENT_SAFE
-    safe_y = CEWE_CONTENT_BLEED + CEWE_CONTENT_SAFE
-    safe_w = CEWE_A4_CONTENT_TRIM_W - 2 * CEWE_CONTENT_SAFE
-    safe_h = CEWE_A4_CONTENT_TRIM_H - 2 * CEWE_CONTENT_SAFE
-    page_images: list[tuple[str, bytes]] = []
-    for idx, (original_pdf_bytes, coloring_bytes) in enumerate(
-        zip(original_pdf_bytes_list, coloring_bytes_list),
-        start=1,
-    ):
-        page_images.append((f"original {idx}", original_pdf_bytes))
-        page_images.append((f"fargelegging {idx}", coloring_bytes))
-
-    page_count = max(CEWE_CONTENT_MIN_PAGES, len(page_images))
-
-    out = io.BytesIO()
-    c = pdfcanvas.Canvas(out, pagesize=pagesize)
-    c.setTitle("Fargeleggingshefte (CEWE A4 innhold)")
-    c.setAuthor("Fargeleggingsgenerator")
+    """CEWE FOTOBOK A4 portrait content test export, padded to 26 pages."""
+    return _build_pdf_from_pairs("cewe", original_pdf_bytes_list, coloring_bytes_list)
 
-    for idx in range(page_count):
-        _set_cewe_pdf_boxes(c)
-        if idx < len(page_images):
-            page_start = time.time()
-            label, image_bytes = page_images[idx]
-            img = pil_image_from_bytes(image_bytes)
-            _draw_fit_in_box(c, img, safe_x, safe_y, safe_w, safe_h)
-            img.close()
-            print(f"CEWE-side {idx + 1} ({label}) ferdig på {time.time() - page_start:.1f} sek", flush=True)
-        c.showPage()
 
-    c.save()
-    out.seek(0)
-    return out.getvalue()
-
-
-def handle_single_mode(detail: str, settings: GenerationSettings, single_files):
+def spool_single_upload(single_files, detach: bool = False) -> SpooledUpload:
     if not single_files or single_files[0].filename == "":
         raise ValueError("Ingen filer lastet opp.")
 
@@ -1076,114 +2964,324 @@ def handle_single_mode(detail: str, settings: GenerationSettings, single_files):
         )
 
     file = single_files[0]
-    original_bytes = file.read()
-    if not original_bytes:
+    upload = spool_upload(file.stream, file.filename or "bilde", detach)
+    if upload is None:
+        raise ValueError("Ingen gyldige bilder.")
+    return upload
+
+
+def spool_booklet_uploads(booklet_files, detach: bool = False) -> list[SpooledUpload]:
+    if len(booklet_files) < BOOKLET_MIN or len(booklet_files) > BOOKLET_MAX:
+        raise ValueError(f"Last opp {BOOKLET_MIN}–{BOOKLET_MAX} bilder (du lastet opp {len(booklet_files)}).")
+
+    uploads: list[SpooledUpload] = []
+    for file in booklet_files:
+        upload = spool_upload(file.stream, file.filename, detach)
+        if upload is not None:
+            uploads.append(upload)
+
+    if len(uploads) < BOOKLET_MIN:
+        for upload in uploads:
+            upload.close()
         raise ValueError("Ingen gyldige bilder.")
+    return uploads
 
-    filename = file.filename or "bilde"
-    prepared = prepare_image_variants(original_bytes, filename)
+
+def generate_single_output(
+    upload: SpooledUpload,
+    detail: str,
+    settings: GenerationSettings,
+    on_progress: Callable[[int, str], None] | None = None,
+    client_id: str = "",
+    deadline: float | None = None,
+) -> GeneratedOutput:
+    report = on_progress or (lambda idx, stage: None)
+    try:
+        prepared = prepare_image_variants(upload, upload.filename)
+    finally:
+        upload.close()
+    report(0, "preprocessed")
+    engine = choose_engine(prepared, detail, settings, deadline)
 
     try:
-        coloring_bytes = generate_coloring_bytes(prepared, detail, settings)
+        coloring_bytes = generate_coloring_bytes(
+            prepared,
+            detail,
+            engine,
+            lambda stage: report(0, stage),
+            hint=ScheduleHint(client_id, PRIORITY_INTERACTIVE, deadline),
+        )
     except ValueError as e:
         if "moderation_blocked" in str(e):
-            return (
+            raise ValueError(
                 "Bildet ditt ble stoppet av sikkerhetssystemet til OpenAI. "
-                "Prøv et annet bilde (mer klær, nøytral setting, ingen sensitive situasjoner).",
-                400,
-            )
+                "Prøv et annet bilde (mer klær, nøytral setting, ingen sensitive situasjoner)."
+            ) from e
         raise
 
-    combined_png = combine_side_by_side_bytes(prepared.pdf_bytes, coloring_bytes)
-    stem = sanitize_stem(filename)
-    name = f"{stem}-combo.png"
-
-    wants_preview = request.form.get("preview") == "1" or "application/json" in request.headers.get("Accept", "")
-    if wants_preview:
-        preview_id = save_preview_file(combined_png, name, "png")
-        return jsonify(
-            {
-                "preview_url": f"/preview/{preview_id}",
-                "download_url": f"/download/{preview_id}",
-                "filename": name,
-                "kind": "image",
-            }
-        )
-
-    return send_file(
-        io.BytesIO(combined_png),
-        mimetype="image/png",
-        as_attachment=True,
-        download_name=name,
+    report(0, "done")
+    combined_png = combine_side_by_side_bytes(prepared.combo_bytes, coloring_bytes)
+    return GeneratedOutput(
+        content=combined_png,
+        filename=f"{sanitize_stem(upload.filename)}-combo.png",
+        kind="image",
+        engines=[engine_report(0, settings, engine)],
     )
 
 
-def handle_booklet_mode(detail: str, settings: GenerationSettings, booklet_files):
-    paper = request.form.get("paper", "A4")
-    layout = request.form.get("layout", "album")
-
-    if len(booklet_files) < BOOKLET_MIN or len(booklet_files) > BOOKLET_MAX:
-        raise ValueError(f"Last opp {BOOKLET_MIN}–{BOOKLET_MAX} bilder (du lastet opp {len(booklet_files)}).")
+def generate_booklet_output(
+    uploads: list[SpooledUpload],
+    detail: str,
+    settings: GenerationSettings,
+    paper: str,
+    layout: str,
+    on_progress: Callable[[int, str], None] | None = None,
+    client_id: str = "",
+    allow_partial: bool = False,
+    vector: bool = False,
+    deadline: float | None = None,
+) -> GeneratedOutput:
+    """
+    Builds the booklet PDF. With allow_partial, images that fail (moderation,
+    unreadable file, OpenAI giving up) are left out and listed in
+    GeneratedOutput.dropped instead of failing the whole booklet, as long as
+    at least BOOKLET_MIN pages remain.
+    With vector, coloring pages are traced into vector outlines and
+    GeneratedOutput.traces reports fidelity and size per page.
+    deadline is passed on to generate_coloring_batch_parallel().
+    """
+    print(
+        "PDF request:",
+        {"paper": paper, "layout": layout, "count": len(uploads), "allow_partial": allow_partial, "vector": vector},
+        flush=True,
+    )
+    start_rss = log_memory_usage("etter opplasting")
+
+    # Preprocessing and generation overlap: image 1 goes to OpenAI while image 2 is still decoding,
+    # and each finished pair is compressed into the PDF while the remaining calls are pending.
+    builder = BookletPdfBuilder(
+        layout,
+        paper,
+        on_page=(lambda idx: on_progress(idx, "page_written")) if on_progress else None,
+        vector=vector,
+    )
+    # Photos are resampled once, straight to what their box on the page needs.
+    prepared_futures = prepare_images_async(uploads, builder.image_pixels)
 
-    originals_with_names: list[tuple[str, bytes]] = []
-    for file in booklet_files:
-        original_bytes = file.read()
-        if original_bytes:
-            originals_with_names.append((file.filename or "bilde", original_bytes))
+    dropped: list[dict] = []
+    engines: dict[int, dict] = {}
 
-    if len(originals_with_names) < BOOKLET_MIN:
-        raise ValueError("Ingen gyldige bilder.")
+    def add_to_pdf(idx: int, coloring_bytes: bytes) -> None:
+        builder.add_pair(idx, prepared_futures[idx].result().pdf_bytes, coloring_bytes)
 
-    print("PDF request:", {"paper": paper, "layout": layout, "count": len(originals_with_names)}, flush=True)
+    def drop(idx: int, error: ValueError) -> None:
+        if "moderation_blocked" in str(error):
+            reason = "Stoppet av sikkerhetssystemet til OpenAI."
+        else:
+            reason = str(error)
+        dropped.append({"image": idx + 1, "filename": uploads[idx].filename, "reason": reason})
+        kept = len(uploads) - len(dropped)
+        if kept < BOOKLET_MIN:
+            # Raising here also cancels the pages still waiting for OpenAI.
+            raise ValueError(
+                f"For mange bilder feilet: bare {kept} av {len(uploads)} kan brukes, og et hefte trenger minst "
+                f"{BOOKLET_MIN}. Bilde {idx + 1} ({uploads[idx].filename}): {reason}"
+            )
 
-    prepared_images = [prepare_image_variants(image_bytes, filename) for filename, image_bytes in originals_with_names]
+    def record_engine(idx: int, used: GenerationSettings) -> None:
+        engines[idx] = engine_report(idx, settings, used)
 
     try:
-        coloring_bytes_list = generate_coloring_batch_parallel(prepared_images, detail, settings)
+        generate_coloring_batch_parallel(
+            prepared_futures,
+            detail,
+            settings,
+            on_result=add_to_pdf,
+            on_progress=on_progress,
+            client_id=client_id,
+            on_failure=drop if allow_partial else None,
+            on_engine=record_engine,
+            deadline=deadline,
+        )
     except ValueError as e:
         if "moderation_blocked_" in str(e):
-            return "Et av bildene ble stoppet av sikkerhetssystemet til OpenAI. Fjern det bildet og prøv igjen.", 400
+            raise ValueError(
+                "Et av bildene ble stoppet av sikkerhetssystemet til OpenAI. Fjern det bildet og prøv igjen."
+            ) from e
         raise
 
-    original_pdf_bytes_list = [prepared.pdf_bytes for prepared in prepared_images]
-
     pdf_start = time.time()
-    if layout == "cewe":
-        pdf_bytes = build_pdf_cewe_a4_content(original_pdf_bytes_list, coloring_bytes_list)
+    pdf_bytes = builder.finish()
+    if builder.layout == "cewe":
         title = "cewe-a4-innhold"
         paper = "CEWE"
-    elif layout == "combo":
-        pdf_bytes = build_pdf_combo_direct_from_pairs(original_pdf_bytes_list, coloring_bytes_list, paper=paper)
-        title = "combo"
     else:
-        pdf_bytes = build_pdf_album_from_pairs(original_pdf_bytes_list, coloring_bytes_list, paper=paper)
-        title = "album"
+        title = builder.layout
 
     print(f"PDF generert på {time.time() - pdf_start:.1f} sek", flush=True)
+    log_memory_usage("etter PDF", start_rss)
 
     stamp = datetime.now().strftime("%Y%m%d-%H%M")
-    filename = f"fargeleggingshefte-{title}-{paper}-{stamp}.pdf"
+    dropped_images = {d["image"] for d in dropped}
+    return GeneratedOutput(
+        content=pdf_bytes,
+        filename=f"fargeleggingshefte-{title}-{paper}-{stamp}.pdf",
+        kind="pdf",
+        dropped=sorted(dropped, key=lambda d: d["image"]),
+        engines=[engines[idx] for idx in sorted(engines) if idx + 1 not in dropped_images],
+        traces=[builder.traces[idx] for idx in sorted(builder.traces)],
+    )
 
+
+def save_output_preview(output: GeneratedOutput) -> dict:
+    if output.kind == "pdf":
+        preview_id = save_preview_file(output.content, output.filename, "pdf")
+        preview_url, download_url = f"/preview-pdf/{preview_id}", f"/download-pdf/{preview_id}"
+    else:
+        preview_id = save_preview_file(output.content, output.filename, "png")
+        preview_url, download_url = f"/preview/{preview_id}", f"/download/{preview_id}"
+    return {
+        "preview_url": preview_url,
+        "download_url": download_url,
+        "filename": output.filename,
+        "kind": output.kind,
+        "dropped": output.dropped,
+        "engines": output.engines,
+        "traces": output.traces,
+    }
+
+
+def output_response(output: GeneratedOutput):
     wants_preview = request.form.get("preview") == "1" or "application/json" in request.headers.get("Accept", "")
     if wants_preview:
-        preview_id = save_preview_file(pdf_bytes, filename, "pdf")
-        return jsonify(
-            {
-                "preview_url": f"/preview-pdf/{preview_id}",
-                "download_url": f"/download-pdf/{preview_id}",
-                "filename": filename,
-                "kind": "pdf",
-            }
-        )
+        return jsonify(save_output_preview(output))
 
-    return send_file(
-        io.BytesIO(pdf_bytes),
-        mimetype="application/pdf",
+    response = send_file(
+        io.BytesIO(output.content),
+        mimetype="application/pdf" if output.kind == "pdf" else "image/png",
         as_attachment=True,
-        download_name=filename,
+        download_name=output.filename,
+    )
+    if output.dropped:
+        response.headers["X-Dropped-Images"] = ",".join(str(d["image"]) for d in output.dropped)
+    if output.engines:
+        response.headers["X-Engines"] = ",".join(f'{e["image"]}={e["model"]}/{e["quality"]}' for e in output.engines)
+    if output.traces:
+        response.headers["X-Trace-Fidelity"] = ",".join(
+            f'{t["image"]}={t["fidelity"]:.3f}' + ("" if t["vector"] else "/raster") for t in output.traces
+        )
+    return response
+
+
+def request_deadline(request_start: float) -> float:
+    """
+    When a synchronous /process request has to be answered, counted from when it
+    arrived so upload and preprocessing time are included. Async jobs have no
+    gunicorn timeout to beat and run without a deadline.
+    """
+    return request_start + REQUEST_DEADLINE_SECONDS
+
+
+def handle_single_mode(detail: str, settings: GenerationSettings, single_files, deadline: float):
+    upload = spool_single_upload(single_files)
+    return output_response(
+        generate_single_output(upload, detail, settings, client_id=client_identity(), deadline=deadline)
     )
 
 
+def handle_booklet_mode(detail: str, settings: GenerationSettings, booklet_files, deadline: float):
+    paper = request.form.get("paper", "A4")
+    layout = request.form.get("layout", "album")
+    allow_partial = request.form.get("allow_partial") == "1"
+    vector = request.form.get("vector") == "1"
+    uploads = spool_booklet_uploads(booklet_files)
+    return output_response(
+        generate_booklet_output(
+            uploads,
+            detail,
+            settings,
+            paper,
+            layout,
+            client_id=client_identity(),
+            allow_partial=allow_partial,
+            vector=vector,
+            deadline=deadline,
+        )
+    )
+
+
+# -----------------------------
+# Async jobs
+# -----------------------------
+def submit_job(work: Callable[[Callable[[int, str], None]], GeneratedOutput]) -> str:
+    """
+    Runs work on JOB_EXECUTOR and tracks it in the shared store, so any worker can report its state.
+    work gets a progress callback (idx, stage) whose events are streamed by /jobs/<id>/events.
+    """
+    cleanup_old_jobs()
+    job_id = uuid.uuid4().hex
+    STORE.create_job(job_id, time.time())
+    JOB_EXECUTOR.submit(_run_job, job_id, work)
+    return job_id
+
+
+def _run_job(job_id: str, work: Callable[[Callable[[int, str], None]], GeneratedOutput]) -> None:
+    job_start = time.time()
+    STORE.update_job(job_id, "running")
+
+    def report(idx: int, stage: str) -> None:
+        STORE.add_job_event(job_id, {"image": idx + 1, "stage": stage, "elapsed": round(time.time() - job_start, 1)})
+
+    try:
+        result = save_output_preview(work(report))
+    except ValueError as e:
+        STORE.update_job(job_id, "failed", error=str(e))
+    except Exception:
+        traceback.print_exc()
+        STORE.update_job(job_id, "failed", error="Noe gikk galt under genereringen. Prøv igjen.")
+    else:
+        STORE.update_job(job_id, "done", result=result)
+    print(f"Jobb {job_id} tok {time.time() - job_start:.1f} sek", flush=True)
+    log_cache_stats()
+
+
+def job_status(job_id: str) -> dict | None:
+    job = STORE.get_job(job_id)
+    if job is None:
+        return None
+    if job["state"] in ("queued", "running") and time.time() - job["updated_at"] > JOB_TIMEOUT_SECONDS:
+        # The worker that owned the job is gone (restart, deploy) or stuck.
+        job["state"] = "failed"
+        job["error"] = "Genereringen ble avbrutt. Prøv igjen."
+    return job
+
+
+def job_event_stream(job_id: str, last_seq: int = 0):
+    """
+    Yields Server-Sent Events for a job: one "progress" event per stored stage
+    event, then a final "state" event with the job status once it is done or failed.
+    Events are read from the shared store, so the job may run on another worker.
+    """
+    last_keepalive = time.time()
+    while True:
+        job = job_status(job_id)
+        for seq, event in STORE.job_events_after(job_id, last_seq):
+            last_seq = seq
+            yield f"id: {seq}\nevent: progress\ndata: {json.dumps(event)}\n\n"
+        if job is None or job["state"] in ("done", "failed"):
+            yield f"event: state\ndata: {json.dumps(job)}\n\n"
+            return
+        if time.time() - last_keepalive > 15:
+            # Comment line; keeps proxies from closing an idle stream.
+            last_keepalive = time.time()
+            yield ": keepalive\n\n"
+        time.sleep(JOB_EVENT_POLL_SECONDS)
+
+
+def cleanup_old_jobs() -> None:
+    STORE.delete_jobs_before(time.time() - PREVIEW_TTL_SECONDS)
+
+
 # -----------------------------
 # Flask app
 # -----------------------------
@@ -1280,18 +3378,122 @@ def process():
     try:
         validate_rate_limit()
 
+        if request.form.get("async") == "1" and mode in ("single", "booklet"):
+            client_id = client_identity()
+            if mode == "single":
+                upload = spool_single_upload(single_files, detach=True)
+                job_id = submit_job(lambda report: generate_single_output(upload, detail, settings, report, client_id))
+            else:
+                paper = request.form.get("paper", "A4")
+                layout = request.form.get("layout", "album")
+                allow_partial = request.form.get("allow_partial") == "1"
+                vector = request.form.get("vector") == "1"
+                uploads = spool_booklet_uploads(booklet_files, detach=True)
+                job_id = submit_job(
+                    lambda report: generate_booklet_output(
+                        uploads, detail, settings, paper, layout, report, client_id, allow_partial, vector
+                    )
+                )
+            print(f"Jobb {job_id} startet ({mode})", flush=True)
+            return jsonify(
+                {"job_id": job_id, "status_url": f"/jobs/{job_id}", "events_url": f"/jobs/{job_id}/events"}
+            ), 202
+
         if mode == "single":
-            response = handle_single_mode(detail, settings, single_files)
+            response = handle_single_mode(detail, settings, single_files, request_deadline(request_start))
         elif mode == "booklet":
-            response = handle_booklet_mode(detail, settings, booklet_files)
+            response = handle_booklet_mode(detail, settings, booklet_files, request_deadline(request_start))
         else:
             return "Ugyldig valg.", 400
 
         print(f"Hele request tok {time.time() - request_start:.1f} sek", flush=True)
+        log_cache_stats()
         return response
 
     except ValueError as e:
         return str(e), 400
+    except (OpenAIError, GenerationCancelled) as e:
+        print(f"Generering feilet: {e!r}", flush=True)
+        return "Noe gikk galt under genereringen. Prøv igjen.", 400
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_state(job_id: str):
+    if not re.fullmatch(r"[a-f0-9]{32}", job_id or ""):
+        return "Ugyldig jobb.", 404
+    job = job_status(job_id)
+    if job is None:
+        return "Jobben finnes ikke eller er utløpt.", 404
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id: str):
+    if not re.fullmatch(r"[a-f0-9]{32}", job_id or "") or job_status(job_id) is None:
+        return "Jobben finnes ikke eller er utløpt.", 404
+    last_seq = request.headers.get("Last-Event-ID", "0")
+    return Response(
+        stream_with_context(job_event_stream(job_id, int(last_seq) if last_seq.isdigit() else 0)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.cli.command("cache-export")
+@click.argument("path", required=False)
+def cache_export_command(path: str | None):
+    """Write the coloring cache to a snapshot archive (default: CACHE_SNAPSHOT_PATH)."""
+    target = path or CACHE_SNAPSHOT_PATH
+    if not target:
+        raise click.UsageError("Oppgi en sti eller sett CACHE_SNAPSHOT_PATH.")
+    exported = export_cache_snapshot(Path(target))
+    click.echo(f"Skrev {exported} fargelegginger til {target}")
+
+
+@app.cli.command("cache-import")
+@click.argument("path", required=False)
+def cache_import_command(path: str | None):
+    """Load a snapshot archive into the coloring cache (default: CACHE_SNAPSHOT_PATH)."""
+    source = path or CACHE_SNAPSHOT_PATH
+    if not source:
+        raise click.UsageError("Oppgi en sti eller sett CACHE_SNAPSHOT_PATH.")
+    imported = import_cache_snapshot(Path(source))
+    click.echo(f"Leste inn {imported} fargelegginger fra {source}")
+
+
+@app.cli.command("trace-benchmark")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+def trace_benchmark_command(paths: tuple[str, ...]):
+    """Trace coloring pages and compare time, size and fidelity with the raster PDF streams."""
+    totals = {"rgb": 0, "lineart": 0, "vector": 0, "seconds": 0.0}
+    for path in paths:
+        image_bytes = Path(path).read_bytes()
+        start = time.time()
+        rgb = encode_pdf_image(image_bytes)
+        rgb_seconds = time.time() - start
+        start = time.time()
+        lineart = encode_pdf_lineart(image_bytes)
+        lineart_seconds = time.time() - start
+        report = trace_report(0, trace_coloring(image_bytes), vector=True)
+        totals["rgb"] += len(rgb.data)
+        totals["lineart"] += len(lineart.data)
+        totals["vector"] += report["bytes"]
+        totals["seconds"] += report["seconds"]
+        click.echo(
+            f"{Path(path).name}: vektor {report['bytes'] / 1024:.0f} KB, {report['paths']} konturer, "
+            f"{report['fidelity']:.1%} samsvar, {report['seconds']:.2f} sek | "
+            f"strek {len(lineart.data) / 1024:.0f} KB, {lineart_seconds:.2f} sek | "
+            f"RGB {len(rgb.data) / 1024:.0f} KB, {rgb_seconds:.2f} sek"
+        )
+    click.echo(
+        f"Totalt {len(paths)} sider: vektor {totals['vector'] / 1024:.0f} KB på {totals['seconds']:.1f} sek, "
+        f"strek {totals['lineart'] / 1024:.0f} KB, RGB {totals['rgb'] / 1024:.0f} KB"
+    )
+
+
+# flask CLI commands (e.g. cache-import) import the app inside a click context.
+if multiprocessing.parent_process() is None and click.get_current_context(silent=True) is None:
+    start_background_tasks()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,22 @@
+"""Helpers for reading settings from the environment, shared by app.py and pdf_encoding.py."""
+import os
+
+
+def env_int(name: str, default: int, min_value: int | None = None, max_value: int | None = None) -> int:
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        return default
+    if min_value is not None:
+        value = max(min_value, value)
+    if max_value is not None:
+        value = min(max_value, value)
+    return value
+
+
+def env_choice(name: str, default: str, allowed: set[str]) -> str:
+    value = os.getenv(name, default).strip()
+    return value if value in allowed else default
@@ -0,0 +1,472 @@
+"""
+Image decoding and PDF page encoding: photo streams, 1-bit line art and vector
+tracing of coloring pages.
+
+Importing this module has no side effects beyond reading its settings from the
+environment (no store, executors or OpenAI client). Under gunicorn the
+PDF_ENCODE_WORKERS processes that app.py spawns therefore load only this and
+config.py. Under `python app.py` spawn also re-imports app.py in each of them,
+as the main module; app.py keeps its background tasks to the parent process.
+"""
+import hashlib
+import io
+import math
+import time
+import zlib
+from dataclasses import dataclass
+from typing import BinaryIO
+
+import numpy as np
+from PIL import Image, ImageChops, ImageFilter, ImageOps, UnidentifiedImageError, features
+
+from config import env_choice, env_int
+
+MAX_IMAGE_PIXELS = env_int("MAX_IMAGE_PIXELS", 12_000_000, min_value=1_000_000, max_value=40_000_000)
+ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG", "WEBP"}
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+# JPEG quality of the pdf rendition, also used when a photo is resampled for its page box.
+PDF_JPEG_QUALITY = 90
+# Coloring pages are embedded as 1-bit line art instead of RGB ("off" restores RGB).
+PDF_LINEART = env_choice("PDF_LINEART", "on", {"on", "off"})
+# Gray level (0-255) below which a pixel becomes a black line.
+LINEART_THRESHOLD = env_int("LINEART_THRESHOLD", 160, min_value=32, max_value=240)
+# Line art is upsampled before thresholding so anti-aliased edges become smooth
+# 1-bit edges instead of stairs; at 1 bit per pixel that still costs far less than RGB.
+LINEART_UPSCALE = 2
+# Vector tracing (premium "vector" booklets): outlines are simplified to within
+# TRACE_TOLERANCE px, specks under TRACE_MIN_AREA px² are dropped, and turns
+# sharper than TRACE_CORNER_DEGREES stay corners instead of curves. Pages whose
+# traced outline matches the bitmap worse than TRACE_MIN_FIDELITY percent (IoU)
+# fall back to the raster line art.
+TRACE_TOLERANCE = 0.75
+TRACE_MIN_AREA = 6
+TRACE_CORNER_DEGREES = 65
+TRACE_MIN_FIDELITY = env_int("TRACE_MIN_FIDELITY", 90, min_value=50, max_value=100)
+
+
+@dataclass(frozen=True)
+class PdfImageStream:
+    """Compressed image data ready to embed as a PDF image XObject."""
+    name: str
+    width: int
+    height: int
+    color_space: str
+    bits_per_component: int
+    filters: tuple[str, ...]
+    data: bytes
+    # /DecodeParms for the (single) filter, e.g. (("K", -1), ("Columns", 2048)) for CCITT G4.
+    decode_parms: tuple[tuple[str, int], ...] = ()
+
+
+@dataclass(frozen=True)
+class TracedPage:
+    """A coloring page traced into filled outlines, ready to paint as PDF path operators."""
+    width: int
+    height: int
+    # Path construction operators in pixel units (y down), ending with a fill.
+    code: str
+    paths: int
+    fidelity: float  # IoU between the traced outlines and the thresholded bitmap
+    seconds: float
+
+
+def _draft_size(size: tuple[int, int], max_dim: int) -> tuple[int, int]:
+    """Smallest size with the same aspect whose longest side still covers max_dim."""
+    width, height = size
+    scale = max_dim / max(width, height)
+    return max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale))
+
+
+def _reduce_to_cover(img: Image.Image, max_dim: int) -> Image.Image:
+    """Cheap integer box reduction that keeps the longest side >= max_dim."""
+    factor = max(img.size) // max_dim
+    if factor < 2:
+        return img
+    reduced = img.reduce(factor)
+    img.close()
+    return reduced
+
+
+def pil_image_from_bytes(image_bytes: bytes, max_dim: int | None = None) -> Image.Image:
+    return pil_image_from_file(io.BytesIO(image_bytes), max_dim=max_dim)
+
+
+def pil_image_from_file(fp: BinaryIO, max_dim: int | None = None) -> Image.Image:
+    """
+    Decodes and validates an upload as an auto-rotated RGB image.
+    With max_dim, decoding stops at the smallest resolution that still covers
+    max_dim: JPEG uses DCT scaling (draft), other formats get an integer
+    reduce() before the caller's final LANCZOS resize.
+    """
+    try:
+        fp.seek(0)
+        raw = Image.open(fp)
+    except (UnidentifiedImageError, OSError) as exc:
+        raise ValueError("Ugyldig bildefil. Last opp JPG, PNG eller WebP.") from exc
+
+    try:
+        with raw:
+            if raw.format not in ALLOWED_IMAGE_FORMATS:
+                raise ValueError("Ugyldig bildeformat. Last opp JPG, PNG eller WebP.")
+            width, height = raw.size
+            if width <= 0 or height <= 0 or width * height > MAX_IMAGE_PIXELS:
+                raise ValueError("Bildet er for stort. Prøv et mindre bilde.")
+            if max_dim and raw.format == "JPEG" and max(width, height) > max_dim:
+                raw.draft(None, _draft_size(raw.size, max_dim))
+            ImageOps.exif_transpose(raw, in_place=True)
+            img = raw.convert("RGB")
+    except Image.DecompressionBombError as exc:
+        raise ValueError("Bildet er for stort. Prøv et mindre bilde.") from exc
+    except OSError as exc:
+        raise ValueError("Ugyldig bildefil. Last opp JPG, PNG eller WebP.") from exc
+
+    if max_dim:
+        img = _reduce_to_cover(img, max_dim)
+    return img
+
+
+def image_to_jpeg_bytes(img: Image.Image, quality: int = 88) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
+
+
+def fit_size(size: tuple[int, int], box: tuple[int, int]) -> tuple[int, int]:
+    """Size that fits inside box with the same aspect ratio. Never upscales."""
+    width, height = size
+    box_w, box_h = box
+    if width <= box_w and height <= box_h:
+        return width, height
+    scale = min(box_w / width, box_h / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def encode_pdf_image(image_bytes: bytes, max_size: tuple[int, int] | None = None) -> PdfImageStream:
+    """
+    Decodes an image and compresses it into a ready-to-embed Flate RGB stream,
+    downsampled to fit max_size (pixels) if given.
+    """
+    img = pil_image_from_bytes(image_bytes)
+    if max_size and fit_size(img.size, max_size) != img.size:
+        resized = img.resize(fit_size(img.size, max_size), Image.LANCZOS)
+        img.close()
+        img = resized
+    try:
+        data = zlib.compress(img.tobytes())
+        return PdfImageStream(
+            name=hashlib.md5(data, usedforsecurity=False).hexdigest(),
+            width=img.width,
+            height=img.height,
+            color_space="DeviceRGB",
+            bits_per_component=8,
+            filters=("FlateDecode",),
+            data=data,
+        )
+    finally:
+        img.close()
+
+
+def encode_pdf_jpeg(jpeg_bytes: bytes, max_size: tuple[int, int] | None = None) -> PdfImageStream:
+    """
+    Embeds a JPEG as is (DCTDecode), reading only its header. Photo pages then
+    skip a decode and recompression, and keep the quality of the prepared JPEG.
+    Anything PDF cannot show unchanged (not JPEG, CMYK, EXIF rotation, too
+    large) goes through encode_pdf_image() instead. A JPEG larger than
+    max_size (pixels) is resampled to fit and re-encoded once.
+    """
+    try:
+        with Image.open(io.BytesIO(jpeg_bytes)) as img:
+            fmt, mode, (width, height) = img.format, img.mode, img.size
+            orientation = img.getexif().get(0x0112, 1) if fmt == "JPEG" else 1
+    except (UnidentifiedImageError, OSError):
+        return encode_pdf_image(jpeg_bytes)
+
+    color_space = {"RGB": "DeviceRGB", "L": "DeviceGray"}.get(mode)
+    if fmt != "JPEG" or color_space is None or orientation != 1 or width * height > MAX_IMAGE_PIXELS:
+        return encode_pdf_image(jpeg_bytes, max_size)
+    if max_size and fit_size((width, height), max_size) != (width, height):
+        img = pil_image_from_bytes(jpeg_bytes, max_dim=max(max_size))
+        try:
+            with img.resize(fit_size(img.size, max_size), Image.LANCZOS) as resized:
+                return encode_pdf_jpeg(image_to_jpeg_bytes(resized, quality=PDF_JPEG_QUALITY))
+        finally:
+            img.close()
+    return PdfImageStream(
+        name=hashlib.md5(jpeg_bytes, usedforsecurity=False).hexdigest(),
+        width=width,
+        height=height,
+        color_space=color_space,
+        bits_per_component=8,
+        filters=("DCTDecode",),
+        data=jpeg_bytes,
+    )
+
+
+def _ccitt_g4(bilevel: Image.Image) -> bytes | None:
+    """Raw CCITT Group 4 data for a mode "1" image (1 = black), via Pillow's libtiff; None if unavailable."""
+    if not features.check("libtiff"):
+        return None
+    buf = io.BytesIO()
+    # One strip, so the TIFF holds a single G4 stream that PDF can use as is.
+    bilevel.save(buf, format="TIFF", compression="group4", tiffinfo={278: bilevel.height})
+    with Image.open(buf) as tiff:
+        offsets, counts = tiff.tag_v2.get(273), tiff.tag_v2.get(279)
+    if not offsets or len(offsets) != 1:
+        return None
+    return buf.getvalue()[offsets[0] : offsets[0] + counts[0]]
+
+
+def encode_pdf_lineart(image_bytes: bytes, max_size: tuple[int, int] | None = None) -> PdfImageStream:
+    """
+    Encodes a coloring page as a 1-bit DeviceGray stream: grayscale,
+    despeckled, upsampled by LINEART_UPSCALE and thresholded at
+    LINEART_THRESHOLD, all with Pillow's C routines. Compressed with CCITT G4
+    (Flate if Pillow lacks libtiff), line art takes a fraction of the RGB
+    stream from encode_pdf_image().
+    max_size is the photo box in pixels; the bitmap is fitted to
+    LINEART_UPSCALE times that instead of always doubling.
+    """
+    img = pil_image_from_bytes(image_bytes)
+    try:
+        gray = img.convert("L").filter(ImageFilter.MedianFilter(3))
+        target = (gray.width * LINEART_UPSCALE, gray.height * LINEART_UPSCALE)
+        if max_size:
+            target = fit_size(target, (max_size[0] * LINEART_UPSCALE, max_size[1] * LINEART_UPSCALE))
+        if target != gray.size:
+            gray = gray.resize(target, Image.Resampling.BICUBIC)
+        # Mode "1" with 1 = line; the G4 encoder codes 1 bits as black runs.
+        ink = gray.point(lambda v: 255 if v < LINEART_THRESHOLD else 0, mode="1")
+        data = _ccitt_g4(ink)
+        if data is not None:
+            filters = ("CCITTFaxDecode",)
+            decode_parms = (("K", -1), ("Columns", ink.width), ("Rows", ink.height))
+        else:
+            # Raw DeviceGray at 1 bit wants 1 = white.
+            data = zlib.compress(ImageChops.invert(ink).tobytes())
+            filters = ("FlateDecode",)
+            decode_parms = ()
+        return PdfImageStream(
+            name=hashlib.md5(data, usedforsecurity=False).hexdigest(),
+            width=ink.width,
+            height=ink.height,
+            color_space="DeviceGray",
+            bits_per_component=1,
+            filters=filters,
+            data=data,
+            decode_parms=decode_parms,
+        )
+    finally:
+        img.close()
+
+
+def encode_pdf_coloring(image_bytes: bytes, max_size: tuple[int, int] | None = None) -> PdfImageStream:
+    """The stream every PDF layout uses for a coloring page, sized for a max_size (pixels) photo box."""
+    if PDF_LINEART == "on":
+        return encode_pdf_lineart(image_bytes, max_size)
+    return encode_pdf_image(image_bytes, max_size)
+
+
+# Unit steps for edge directions 0..3: +x, +y (down), -x, -y.
+_TRACE_STEPS = np.array([(1, 0), (0, 1), (-1, 0), (0, -1)])
+
+
+def coloring_ink_mask(image_bytes: bytes) -> np.ndarray:
+    """Boolean ink mask (True = line) of a coloring page, despeckled and thresholded like encode_pdf_lineart()."""
+    img = pil_image_from_bytes(image_bytes)
+    try:
+        gray = img.convert("L").filter(ImageFilter.MedianFilter(3))
+        return np.asarray(gray) < LINEART_THRESHOLD
+    finally:
+        img.close()
+
+
+def _boundary_edges(ink: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Every unit pixel edge between ink and paper as (start x, start y, direction),
+    directed so the ink is on its right (y down). Outer outlines and holes then
+    run in opposite directions, so a nonzero fill paints them correctly.
+    """
+    padded = np.pad(ink, 1)
+    above, below = padded[:-1, 1:-1], padded[1:, 1:-1]
+    left, right = padded[1:-1, :-1], padded[1:-1, 1:]
+    xs, ys, dirs = [], [], []
+    for mask, dx, dy, direction in (
+        (below & ~above, 0, 0, 0),
+        (left & ~right, 0, 0, 1),
+        (above & ~below, 1, 0, 2),
+        (right & ~left, 0, 1, 3),
+    ):
+        y, x = np.nonzero(mask)
+        xs.append(x + dx)
+        ys.append(y + dy)
+        dirs.append(np.full(len(x), direction))
+    return np.concatenate(xs), np.concatenate(ys), np.concatenate(dirs)
+
+
+def _link_edges(x: np.ndarray, y: np.ndarray, d: np.ndarray, width: int) -> np.ndarray:
+    """Index of the edge that follows each edge around its outline."""
+    stride = width + 1
+    start = y * stride + x
+    end = (y + _TRACE_STEPS[d, 1]) * stride + x + _TRACE_STEPS[d, 0]
+    order = np.argsort(start, kind="stable")
+    first = np.searchsorted(start[order], end)
+    first_edge = order[first]
+    second_edge = order[np.minimum(first + 1, len(order) - 1)]
+    saddle = (first + 1 < len(order)) & (start[second_edge] == end)
+    # Where two outlines touch diagonally, turn left so diagonal strokes stay one shape.
+    take_second = saddle & (d[first_edge] != (d + 3) % 4)
+    return np.where(take_second, second_edge, first_edge)
+
+
+def _outline_loops(nxt: np.ndarray) -> list[np.ndarray]:
+    """Splits the edge successor permutation into its cycles."""
+    following = nxt.tolist()
+    seen = bytearray(len(following))
+    loops = []
+    for begin in range(len(following)):
+        if seen[begin]:
+            continue
+        loop = []
+        edge = begin
+        while not seen[edge]:
+            seen[edge] = 1
+            loop.append(edge)
+            edge = following[edge]
+        loops.append(np.array(loop))
+    return loops
+
+
+def _simplify_closed(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Ramer-Douglas-Peucker on a closed polygon, with NumPy distance scans."""
+    ring = np.vstack([points, points[:1]])
+    keep = np.zeros(len(ring), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(ring) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        chord = ring[j] - ring[i]
+        offsets = ring[i + 1 : j] - ring[i]
+        length = math.hypot(chord[0], chord[1])
+        if length:
+            dist = np.abs(chord[0] * offsets[:, 1] - chord[1] * offsets[:, 0]) / length
+        else:
+            dist = np.hypot(offsets[:, 0], offsets[:, 1])
+        k = int(np.argmax(dist))
+        if dist[k] > tolerance:
+            keep[i + 1 + k] = True
+            stack.append((i, i + 1 + k))
+            stack.append((i + 1 + k, j))
+    return ring[keep][:-1]
+
+
+def _fit_outline(points: np.ndarray) -> tuple[str, np.ndarray]:
+    """
+    Fits a closed polygon with a Catmull-Rom spline through its vertices, as one
+    cubic Bézier per side. Vertices that turn sharper than TRACE_CORNER_DEGREES
+    get no tangent, so they stay corners.
+    Returns the path operators and a flattened outline for fidelity checks.
+    """
+    prev, nxt = np.roll(points, 1, axis=0), np.roll(points, -1, axis=0)
+    incoming, outgoing = points - prev, nxt - points
+    cos_turn = np.einsum("ij,ij->i", incoming, outgoing) / np.maximum(
+        np.hypot(*incoming.T) * np.hypot(*outgoing.T), 1e-9
+    )
+    corner = cos_turn < math.cos(math.radians(TRACE_CORNER_DEGREES))
+    tangent = np.where(corner[:, None], 0.0, (nxt - prev) / 6)
+    ctrl1 = points + tangent
+    ctrl2 = nxt - np.roll(tangent, -1, axis=0)
+
+    numbers = np.round(np.hstack([ctrl1, ctrl2, nxt]), 1).tolist()
+    ops = ["%g %g m" % tuple(numbers[-1][4:6])]
+    ops.extend("%g %g %g %g %g %g c" % tuple(side) for side in numbers)
+    ops.append("h")
+
+    samples = [points]
+    for t in (1 / 3, 2 / 3):
+        u = 1 - t
+        samples.append(u**3 * points + 3 * u * u * t * ctrl1 + 3 * u * t * t * ctrl2 + t**3 * nxt)
+    flat = np.stack(samples, axis=1).reshape(-1, 2)
+    return " ".join(ops), flat
+
+
+def _outline_fidelity(ink: np.ndarray, outlines: list[np.ndarray]) -> float:
+    """IoU between ink and the outlines, scan-converted with even-odd parity at pixel centres."""
+    height, width = ink.shape
+    if not outlines:
+        return 1.0 if not ink.any() else 0.0
+    start = np.concatenate(outlines)
+    end = np.concatenate([np.roll(outline, -1, axis=0) for outline in outlines])
+    # Rows whose centre (row + 0.5) lies in [min y, max y) of each side.
+    first = np.clip(np.ceil(np.minimum(start[:, 1], end[:, 1]) - 0.5), 0, height).astype(int)
+    stop = np.clip(np.ceil(np.maximum(start[:, 1], end[:, 1]) - 0.5), 0, height).astype(int)
+    counts = stop - first
+    side = np.repeat(np.arange(len(start)), counts)
+    rows = first[side] + np.arange(len(side)) - np.repeat(np.cumsum(counts) - counts, counts)
+    t = (rows + 0.5 - start[side, 1]) / (end[side, 1] - start[side, 1])
+    crossing = start[side, 0] + t * (end[side, 0] - start[side, 0])
+    cols = np.clip(np.ceil(crossing - 0.5), 0, width).astype(int)
+    toggles = np.zeros((height, width + 1), dtype=np.uint8)
+    np.bitwise_xor.at(toggles, (rows, cols), 1)
+    traced = np.bitwise_xor.accumulate(toggles, axis=1)[:, :width].astype(bool)
+    union = np.count_nonzero(ink | traced)
+    return np.count_nonzero(ink & traced) / union if union else 1.0
+
+
+def trace_coloring(image_bytes: bytes) -> TracedPage:
+    """
+    Traces a coloring page into filled vector outlines: pixel boundaries from
+    the ink mask are linked into closed loops, staircases are smoothed through
+    their side midpoints, simplified within TRACE_TOLERANCE and fitted with
+    Bézier curves. The result prints sharp at any page size.
+    """
+    start_time = time.time()
+    ink = coloring_ink_mask(image_bytes)
+    height, width = ink.shape
+    x, y, d = _boundary_edges(ink)
+    paths, outlines = [], []
+    if len(d):
+        for loop in _outline_loops(_link_edges(x, y, d, width)):
+            directions = d[loop]
+            turns = directions != np.roll(directions, 1)
+            corners = np.column_stack([x[loop][turns], y[loop][turns]]).astype(float)
+            xs, ys = corners[:, 0], corners[:, 1]
+            area = 0.5 * abs(np.dot(xs, np.roll(ys, -1)) - np.dot(ys, np.roll(xs, -1)))
+            if area < TRACE_MIN_AREA:
+                continue
+            points = _simplify_closed((corners + np.roll(corners, -1, axis=0)) / 2, TRACE_TOLERANCE)
+            if len(points) < 3:
+                continue
+            code, flat = _fit_outline(points)
+            paths.append(code)
+            outlines.append(flat)
+    return TracedPage(
+        width=width,
+        height=height,
+        code="\n".join(paths) + "\nf" if paths else "",
+        paths=len(paths),
+        fidelity=float(_outline_fidelity(ink, outlines)),
+        seconds=time.time() - start_time,
+    )
+
+
+def encode_pdf_pair(
+    original_pdf_bytes: bytes,
+    coloring_bytes: bytes,
+    image_pixels: tuple[int, int] | None = None,
+    vector: bool = False,
+) -> tuple[PdfImageStream, PdfImageStream | TracedPage, float, TracedPage | None]:
+    """
+    All the expensive work for one page pair: returns the original's stream,
+    the coloring's stream or traced outlines, the seconds spent and the trace
+    (if any). Top level and pickle-friendly so it can run in app's PDF encoding processes.
+    """
+    start = time.time()
+    original = encode_pdf_jpeg(original_pdf_bytes, image_pixels)
+    traced = trace_coloring(coloring_bytes) if vector else None
+    if traced is not None and traced.fidelity >= TRACE_MIN_FIDELITY / 100:
+        coloring = traced
+    else:
+        coloring = encode_pdf_coloring(coloring_bytes, image_pixels)
+    return original, coloring, time.time() - start, traced
@@ -0,0 +1,46 @@
+"""Shared test fixtures: sample images and a throwaway SharedStore."""
+import io
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from PIL import Image
+
+import app
+
+
+def image_bytes(size=(40, 30), color=(0, 0, 0), fmt="JPEG") -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def jpeg_bytes(size=(40, 30), color=(0, 0, 0)) -> bytes:
+    return image_bytes(size, color)
+
+
+def resized_jpeg(img: Image.Image, size: tuple[int, int], quality: int) -> bytes:
+    buf = io.BytesIO()
+    img.resize(size).save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def use_temp_store(test: unittest.TestCase) -> "app.SharedStore":
+    """
+    Points app.STORE, COLORING_CACHE and PERCEPTUAL_INDEX at a fresh store in a
+    temporary directory for the rest of test, so leases, cache entries and jobs
+    never land in the configured STORE_PATH.
+    """
+    tmp = tempfile.TemporaryDirectory()
+    test.addCleanup(tmp.cleanup)
+    store = app.SharedStore(Path(tmp.name) / "store.sqlite3")
+    for name, value in (
+        ("STORE", store),
+        ("COLORING_CACHE", app.ColoringCache(store, 1 << 20, 1 << 20)),
+        ("PERCEPTUAL_INDEX", app.PerceptualIndex(store)),
+    ):
+        patcher = mock.patch.object(app, name, value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    return store
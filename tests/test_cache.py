@@ -0,0 +1,272 @@
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+from PIL import Image, ImageDraw
+
+import app
+from helpers import resized_jpeg
+
+
+class ColoringCacheTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.store = app.SharedStore(Path(self._tmp.name) / "store.sqlite3")
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def make_cache(self, memory_budget=100, disk_budget=100):
+        return app.ColoringCache(self.store, memory_budget, disk_budget)
+
+    def test_put_then_get_is_served_from_memory(self):
+        cache = self.make_cache()
+        cache.put("a", b"x" * 10)
+
+        self.assertEqual(cache.get("a"), b"x" * 10)
+        self.assertIsNone(cache.get("b"))
+
+        stats = cache.stats()
+        self.assertEqual((stats["memory_hits"], stats["disk_hits"], stats["misses"]), (1, 0, 1))
+        self.assertEqual((stats["disk_entries"], stats["disk_bytes"]), (1, 10))
+
+    def test_disk_tier_evicts_least_recently_used(self):
+        cache = self.make_cache(memory_budget=0, disk_budget=25)
+        cache.put("a", b"1" * 10)
+        cache.put("b", b"2" * 10)
+        self.assertEqual(cache.get("a"), b"1" * 10)
+
+        cache.put("c", b"3" * 10)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"1" * 10)
+        self.assertEqual(cache.stats()["disk_evictions"], 1)
+
+    def test_memory_tier_has_its_own_budget(self):
+        cache = self.make_cache(memory_budget=15, disk_budget=100)
+        cache.put("a", b"1" * 10)
+        cache.put("b", b"2" * 10)
+
+        self.assertEqual(cache.get("a"), b"1" * 10)
+
+        stats = cache.stats()
+        self.assertEqual(stats["disk_hits"], 1)
+        self.assertLessEqual(stats["memory_bytes"], 15)
+
+    def test_workers_share_the_store(self):
+        first_worker = self.make_cache()
+        second_worker = app.ColoringCache(app.SharedStore(self.store.path), 100, 100)
+
+        first_worker.put("a", b"coloring")
+
+        self.assertEqual(second_worker.get("a"), b"coloring")
+        self.assertEqual(second_worker.stats()["disk_hits"], 1)
+
+    def test_locked_database_degrades_to_a_miss(self):
+        cache = self.make_cache(memory_budget=0)
+        cache.put("a", b"x" * 10)
+        locked = sqlite3.OperationalError("database is locked")
+
+        with mock.patch.object(self.store, "get_coloring", side_effect=locked):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("a"), b"x" * 10)
+
+    def test_failed_cache_write_is_logged_not_raised(self):
+        settings = app.generation_settings_from_preset("standard_high")
+        full = sqlite3.OperationalError("database or disk is full")
+
+        with mock.patch.object(app, "COLORING_CACHE", self.make_cache()), mock.patch.object(
+            self.store, "put_coloring", side_effect=full
+        ):
+            app.set_cached_coloring(b"input", "normal", settings, b"coloring")
+
+
+class SharedStoreTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.store = app.SharedStore(Path(self._tmp.name) / "store.sqlite3")
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_previews_expire(self):
+        self.store.add_preview("a" * 32, "hefte.pdf", "pdf", time.time() + 60)
+        self.store.add_preview("b" * 32, "gammel.png", "png", time.time() - 1)
+
+        self.assertEqual(self.store.get_preview("a" * 32), ("hefte.pdf", "pdf"))
+        self.assertIsNone(self.store.get_preview("b" * 32))
+        self.assertEqual(self.store.pop_expired_previews(), [("b" * 32, "png")])
+
+    def test_rate_limit_counts_per_client_within_window(self):
+        now = time.time()
+        self.assertTrue(self.store.record_request("1.2.3.4", now - 100, 60, 1))
+        self.assertTrue(self.store.record_request("1.2.3.4", now, 60, 1))
+        self.assertFalse(self.store.record_request("1.2.3.4", now, 60, 1))
+        self.assertTrue(self.store.record_request("5.6.7.8", now, 60, 1))
+
+    def test_generation_lease_is_exclusive_until_released_or_expired(self):
+        self.assertTrue(self.store.acquire_lease("key", "worker-1", 60))
+        self.assertFalse(self.store.acquire_lease("key", "worker-2", 60))
+        self.store.release_lease("key", "worker-1")
+        self.assertTrue(self.store.acquire_lease("key", "worker-2", -1))
+        self.assertFalse(self.store.lease_active("key"))
+        self.assertTrue(self.store.acquire_lease("key", "worker-3", 60))
+
+    def test_lease_holder_can_renew(self):
+        self.assertTrue(self.store.acquire_lease("key", "worker-1", 0.05))
+        self.assertTrue(self.store.acquire_lease("key", "worker-1", 60))
+        time.sleep(0.1)
+        self.assertFalse(self.store.acquire_lease("key", "worker-2", 60))
+
+
+class PerceptualCacheTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        store = app.SharedStore(Path(self._tmp.name) / "store.sqlite3")
+        self.cache = app.ColoringCache(store, 1000, 1000)
+        self.index = app.PerceptualIndex(store)
+        self.photo = Image.linear_gradient("L").rotate(90).resize((320, 240)).convert("RGB")
+        ImageDraw.Draw(self.photo).ellipse((60, 40, 200, 180), fill=(20, 40, 200))
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_reencoded_upload_matches_original(self):
+        original = app.perceptual_hash(resized_jpeg(self.photo, (320, 240), 90))
+        reencoded = app.perceptual_hash(resized_jpeg(self.photo, (250, 188), 55))
+        self.cache.put("key", b"coloring")
+        self.index.add("ns", *original, "key")
+
+        match = self.index.find("ns", *reencoded, max_distance=16)
+
+        self.assertIsNotNone(match)
+        self.assertEqual(match[0], "key")
+        self.assertIsNone(self.index.find("other-ns", *reencoded, max_distance=16))
+
+    def test_different_photo_does_not_match(self):
+        flipped = self.photo.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+        self.cache.put("key", b"coloring")
+        self.index.add("ns", *app.perceptual_hash(resized_jpeg(self.photo, (320, 240), 90)), "key")
+
+        self.assertIsNone(self.index.find("ns", *app.perceptual_hash(resized_jpeg(flipped, (320, 240), 90)), 16))
+
+    def test_flat_images_get_no_perceptual_hash(self):
+        flat = Image.new("RGB", (320, 240), (30, 60, 90))
+
+        self.assertIsNone(app.perceptual_hash(resized_jpeg(flat, (320, 240), 90)))
+
+    def test_only_similar_aspect_ratios_are_candidates(self):
+        self.cache.put("wide", b"x")
+        self.index.add("ns", 0b1010, 1.5, "wide")
+
+        self.assertEqual(self.index.find("ns", 0b1010, 1.52, 0), ("wide", 0))
+        self.assertIsNone(self.index.find("ns", 0b1010, 1.6, 0))
+
+    def test_near_matches_are_off_by_default(self):
+        self.assertEqual(app.PERCEPTUAL_CACHE, "off")
+        phash, aspect = app.perceptual_hash(resized_jpeg(self.photo, (320, 240), 90))
+        settings = app.generation_settings_from_preset("standard_high")
+        self.cache.put("other", b"someone else's coloring")
+        self.index.add(app.cache_namespace("normal", settings), phash, aspect, "other")
+
+        with mock.patch.object(app, "COLORING_CACHE", self.cache), mock.patch.object(app, "PERCEPTUAL_INDEX", self.index):
+            found = app.get_cached_coloring(resized_jpeg(self.photo, (320, 240), 80), "normal", settings)
+
+        self.assertIsNone(found)
+
+    def test_locked_perceptual_index_falls_through_to_generation(self):
+        settings = app.generation_settings_from_preset("standard_high")
+        locked = sqlite3.OperationalError("database is locked")
+
+        with mock.patch.object(app, "PERCEPTUAL_CACHE", "on"), mock.patch.object(
+            app, "COLORING_CACHE", self.cache
+        ), mock.patch.object(self.index, "find", side_effect=locked), mock.patch.object(
+            app, "PERCEPTUAL_INDEX", self.index
+        ):
+            found = app.get_cached_coloring(resized_jpeg(self.photo, (320, 240), 80), "normal", settings)
+
+        self.assertIsNone(found)
+
+    def test_index_entries_go_away_with_evicted_colorings(self):
+        phash, aspect = app.perceptual_hash(resized_jpeg(self.photo, (320, 240), 90))
+        self.cache.put("gone", b"x" * 600)
+        self.index.add("ns", phash, aspect, "gone")
+
+        self.cache.put("kept", b"y" * 600)
+        self.index.add("ns", phash ^ 1, aspect, "kept")
+
+        self.assertEqual(self.index.find("ns", phash, aspect, 16), ("kept", 1))
+        self.assertEqual([entry["key"] for entry in self.index.entries()], ["kept"])
+
+
+class CacheSnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp.name)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def use_cache(self, name):
+        store = app.SharedStore(self.root / name / "store.sqlite3")
+        cache = app.ColoringCache(store, 1000, 1000)
+        index = app.PerceptualIndex(store)
+        patches = [mock.patch.object(app, "COLORING_CACHE", cache), mock.patch.object(app, "PERCEPTUAL_INDEX", index)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        return cache, index
+
+    def test_snapshot_round_trip_restores_cache_and_index(self):
+        key = "a" * 64
+        cache, index = self.use_cache("before")
+        cache.put(key, b"coloring")
+        index.add("ns", 0b1011, 1.5, key)
+        snapshot = self.root / "persistent" / "cache.zip"
+
+        result = app.app.test_cli_runner().invoke(args=["cache-export", str(snapshot)])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        cache, index = self.use_cache("after")
+        self.assertEqual(app.import_cache_snapshot(snapshot), 1)
+
+        self.assertEqual(cache.get(key), b"coloring")
+        self.assertEqual(index.find("ns", 0b1011, 1.5, 0), (key, 0))
+        self.assertEqual(app.import_cache_snapshot(snapshot), 0)
+
+    def test_one_worker_exports_each_interval_and_errors_are_logged(self):
+        store = app.SharedStore(self.root / "store.sqlite3")
+        snapshot = self.root / "cache.zip"
+
+        with mock.patch.object(app, "STORE", store), mock.patch.object(
+            app, "export_cache_snapshot", return_value=0
+        ) as export:
+            app.snapshot_cache_once(snapshot, "worker-1", 60)
+            app.snapshot_cache_once(snapshot, "worker-2", 60)
+            self.assertEqual(export.call_count, 1)
+
+            export.side_effect = sqlite3.DatabaseError("database disk image is malformed")
+            with mock.patch.object(store, "acquire_lease", return_value=True), mock.patch("builtins.print") as printed:
+                app.snapshot_cache_once(snapshot, "worker-1", 60)
+        self.assertIn("Kunne ikke skrive cache-snapshot", printed.call_args[0][0])
+
+    def test_snapshot_is_restored_by_one_worker(self):
+        store = app.SharedStore(self.root / "store.sqlite3")
+
+        with mock.patch.object(app, "STORE", store), mock.patch.object(
+            app, "import_cache_snapshot", return_value=0
+        ) as restore:
+            app._restore_cache_snapshot_in_background(self.root / "cache.zip", "worker-1")
+            app._restore_cache_snapshot_in_background(self.root / "cache.zip", "worker-2")
+
+        self.assertEqual(restore.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
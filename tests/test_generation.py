@@ -0,0 +1,625 @@
+import io
+import os
+import threading
+import time
+import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
+from unittest import mock
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import httpx
+from openai import BadRequestError, OpenAIError, RateLimitError
+
+import app
+from helpers import jpeg_bytes, use_temp_store
+
+
+def fake_generate(prepared, detail, settings, on_stage=None, hint=None):
+    return prepared.original_filename.encode("utf-8")
+
+
+class BatchGenerationTests(unittest.TestCase):
+    def setUp(self):
+        self.settings = app.generation_settings_from_preset("mini_medium")
+
+    def test_batch_accepts_preprocessing_futures_and_keeps_order(self):
+        slow = Future()
+        fast = Future()
+        fast.set_result(app.prepare_image_variants(jpeg_bytes(color=(0, 0, 255)), "b.jpg"))
+        submitted = []
+
+        def record(prepared, detail, settings, on_stage=None, hint=None):
+            submitted.append(prepared.original_filename)
+            if not slow.done():
+                slow.set_result(app.prepare_image_variants(jpeg_bytes(), "a.jpg"))
+            return fake_generate(prepared, detail, settings)
+
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=record):
+            results = app.generate_coloring_batch_parallel([slow, fast], "normal", self.settings)
+
+        self.assertEqual(submitted[0], "b.jpg")
+        self.assertEqual(results, [b"a.jpg", b"b.jpg"])
+
+    def test_preprocessing_error_propagates_with_filename(self):
+        futures = app.prepare_images_async(
+            [app.spool_upload(io.BytesIO(jpeg_bytes()), "ok.jpg"), app.spool_upload(io.BytesIO(b"nope"), "bad.jpg")]
+        )
+
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=fake_generate):
+            with self.assertRaisesRegex(ValueError, "^bad.jpg: "):
+                app.generate_coloring_batch_parallel(futures, "normal", self.settings)
+
+    def test_identical_uploads_share_one_generation(self):
+        data = jpeg_bytes()
+        futures = app.prepare_images_async(
+            [app.spool_upload(io.BytesIO(data), "a.jpg"), app.spool_upload(io.BytesIO(data), "kopi.jpg")]
+        )
+
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=fake_generate) as generate:
+            results = app.generate_coloring_batch_parallel(futures, "normal", self.settings)
+
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(results, [b"a.jpg", b"a.jpg"])
+
+    def test_same_cache_key_in_batch_is_generated_once(self):
+        first = app.prepare_image_variants(jpeg_bytes(), "a.jpg")
+        second = app.prepare_image_variants(jpeg_bytes(), "b.jpg")
+
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=fake_generate) as generate:
+            results = app.generate_coloring_batch_parallel([first, second], "normal", self.settings)
+
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(results, [b"a.jpg", b"a.jpg"])
+
+    def test_pages_waiting_for_a_scheduler_slot_report_queued(self):
+        use_temp_store(self)
+        prepared = [app.prepare_image_variants(jpeg_bytes(color=(n * 80, 5, 5)), f"{n}.jpg") for n in range(3)]
+        release = threading.Event()
+        stages: dict[int, list[str]] = {0: [], 1: [], 2: []}
+
+        def slow_call(prepared, detail, settings):
+            release.wait(5)
+            return prepared.original_filename.encode("utf-8")
+
+        with mock.patch.object(app, "OPENAI_SCHEDULER", app.OpenAIScheduler(max_in_flight=1)), mock.patch.object(
+            app, "ENGINE_DOWNGRADE", "off"
+        ), mock.patch.object(app, "_call_openai_coloring", side_effect=slow_call):
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                batch = executor.submit(
+                    app.generate_coloring_batch_parallel,
+                    prepared,
+                    "normal",
+                    self.settings,
+                    on_progress=lambda idx, stage: stages[idx].append(stage),
+                )
+                time.sleep(0.3)
+                snapshot = {idx: list(seen) for idx, seen in stages.items()}
+                release.set()
+                results = batch.result(5)
+
+        self.assertEqual(sorted(results), [b"0.jpg", b"1.jpg", b"2.jpg"])
+        started = [idx for idx, seen in snapshot.items() if "generating" in seen]
+        self.assertEqual(len(started), 1)
+        for idx, seen in snapshot.items():
+            if idx not in started:
+                self.assertEqual(seen[-1], "queued")
+        self.assertTrue(all(seen[-2:] == ["generating", "done"] for seen in stages.values()))
+
+
+class FailureHandlingTests(unittest.TestCase):
+    def setUp(self):
+        self.settings = app.generation_settings_from_preset("mini_medium")
+        self.prepared = [
+            app.prepare_image_variants(jpeg_bytes(color=(n * 60, 20, 20)), name)
+            for n, name in enumerate(["ok.jpg", "blocked.jpg", "slow.jpg"])
+        ]
+
+    def generate(self, prepared, detail, settings, on_stage=None, hint=None):
+        if prepared.original_filename == "blocked.jpg":
+            raise ValueError("moderation_blocked")
+        if prepared.original_filename == "slow.jpg":
+            if hint.cancel.wait(5):
+                raise app.GenerationCancelled()
+        return prepared.original_filename.encode("utf-8")
+
+    def test_first_error_cancels_the_rest_without_waiting(self):
+        hints = []
+
+        def generate(prepared, detail, settings, on_stage=None, hint=None):
+            hints.append(hint)
+            return self.generate(prepared, detail, settings, on_stage, hint)
+
+        start = time.time()
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=generate):
+            with self.assertRaisesRegex(ValueError, "^moderation_blocked_2$"):
+                app.generate_coloring_batch_parallel(self.prepared, "normal", self.settings)
+
+        self.assertLess(time.time() - start, 2)
+        self.assertTrue(all(hint.cancelled for hint in hints))
+
+    def test_partial_batch_reports_failures_and_keeps_the_rest(self):
+        self.prepared[2] = app.prepare_image_variants(jpeg_bytes(color=(0, 200, 0)), "fine.jpg")
+        dropped = []
+
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=self.generate):
+            results = app.generate_coloring_batch_parallel(
+                self.prepared, "normal", self.settings, on_failure=lambda idx, error: dropped.append((idx, str(error)))
+            )
+
+        self.assertEqual(results, [b"ok.jpg", b"fine.jpg"])
+        self.assertEqual(dropped, [(1, "moderation_blocked_2")])
+
+    def test_partial_batch_drops_an_image_cancelled_by_another_batch(self):
+        def generate(prepared, detail, settings, on_stage=None, hint=None):
+            if prepared.original_filename == "slow.jpg":
+                raise app.GenerationCancelled()
+            return self.generate(prepared, detail, settings, on_stage, hint)
+
+        dropped = []
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=generate):
+            results = app.generate_coloring_batch_parallel(
+                self.prepared, "normal", self.settings, on_failure=lambda idx, error: dropped.append(idx)
+            )
+
+        self.assertEqual(results, [b"ok.jpg"])
+        self.assertEqual(sorted(dropped), [1, 2])
+
+    def test_partial_batch_raises_when_every_image_fails(self):
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=ValueError("OpenAI er nede")):
+            with self.assertRaisesRegex(ValueError, "OpenAI er nede"):
+                app.generate_coloring_batch_parallel(
+                    self.prepared, "normal", self.settings, on_failure=lambda idx, error: None
+                )
+
+    def test_cancelled_hint_unqueues_openai_call(self):
+        scheduler = app.OpenAIScheduler(max_in_flight=1)
+        release = threading.Event()
+        scheduler.submit(lambda: release.wait(5))
+        cancel = threading.Event()
+        calls = []
+
+        with mock.patch.object(app, "OPENAI_SCHEDULER", scheduler), mock.patch.object(
+            app, "_call_openai_coloring", side_effect=lambda *args: calls.append(args)
+        ):
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                waiting = executor.submit(
+                    app._call_openai_with_retries,
+                    self.prepared[0],
+                    "normal",
+                    self.settings,
+                    app.ScheduleHint(cancel=cancel),
+                )
+                time.sleep(0.1)
+                cancel.set()
+                with self.assertRaises(app.GenerationCancelled):
+                    waiting.result(5)
+            release.set()
+            scheduler.submit(lambda: None).result(5)
+
+        self.assertEqual(calls, [])
+
+
+class EngineDowngradeTests(unittest.TestCase):
+    def setUp(self):
+        self.requested = app.generation_settings_from_preset("standard_high")
+        self.fast = app.generation_settings_from_preset("mini_medium")
+        self.prepared = app.prepare_image_variants(jpeg_bytes(color=(5, 60, 5)), "a.jpg")
+        patcher = mock.patch.object(app, "ENGINE_LATENCY", app.EngineLatencyTracker())
+        self.tracker = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(app.COLORING_CACHE, "contains", return_value=False)
+        self.cached = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_estimate_uses_prior_until_enough_samples(self):
+        self.assertEqual(self.tracker.estimate(self.requested), 90.0)
+        for seconds in (10, 20, 30, 40):
+            self.tracker.record(self.requested, seconds)
+        self.assertEqual(self.tracker.estimate(self.requested), 40)
+
+    def test_keeps_requested_engine_when_it_fits(self):
+        chosen = app.choose_engine(self.prepared, "normal", self.requested, time.time() + 300, waves=2)
+        self.assertEqual(chosen, self.requested)
+
+    def test_falls_back_to_best_engine_that_fits(self):
+        chosen = app.choose_engine(self.prepared, "normal", self.requested, time.time() + 100, waves=2)
+        self.assertEqual(chosen, app.generation_settings_from_preset("mini_high"))
+
+        chosen = app.choose_engine(self.prepared, "normal", self.requested, time.time() + 10, waves=2)
+        self.assertEqual(chosen, self.fast)
+
+    def test_cached_result_for_requested_engine_is_kept(self):
+        self.cached.return_value = True
+        chosen = app.choose_engine(self.prepared, "normal", self.requested, time.time() + 10, waves=2)
+        self.assertEqual(chosen, self.requested)
+
+    def test_no_deadline_keeps_requested_engine(self):
+        chosen = app.choose_engine(self.prepared, "normal", self.requested, None, waves=20)
+        self.assertEqual(chosen, self.requested)
+
+    def test_batch_reports_engine_per_page(self):
+        engines = {}
+        prepared = [app.prepare_image_variants(jpeg_bytes(color=(n * 70, 0, 0)), f"{n}.jpg") for n in range(2)]
+
+        with mock.patch.object(app, "OPENAI_SCHEDULER", app.OpenAIScheduler(max_in_flight=2)), mock.patch.object(
+            app, "generate_coloring_bytes", side_effect=fake_generate
+        ) as generate:
+            app.generate_coloring_batch_parallel(
+                prepared,
+                "normal",
+                self.requested,
+                on_engine=lambda idx, used: engines.setdefault(idx, used),
+                deadline=time.time() + 40,
+            )
+
+        self.assertEqual(engines, {0: self.fast, 1: self.fast})
+        self.assertEqual({call.args[2] for call in generate.call_args_list}, {self.fast})
+
+
+class HedgingTests(unittest.TestCase):
+    def setUp(self):
+        self.settings = app.generation_settings_from_preset("mini_medium")
+        self.prepared = app.prepare_image_variants(jpeg_bytes(color=(1, 2, 3)), "a.jpg")
+        tracker = app.EngineLatencyTracker(min_samples=1)
+        tracker.record(self.settings, 0.1)
+        for name, value in (
+            ("OPENAI_HEDGE", "on"),
+            ("ENGINE_LATENCY", tracker),
+            ("OPENAI_SCHEDULER", app.OpenAIScheduler(max_in_flight=4)),
+        ):
+            patcher = mock.patch.object(app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.release_primary = threading.Event()
+        self.addCleanup(self.release_primary.set)
+        self.calls = 0
+
+    def call(self, prepared, detail, settings):
+        self.calls += 1
+        if self.calls == 1:
+            self.release_primary.wait(5)
+            return b"primary"
+        return b"hedge"
+
+    def run_call(self, stats):
+        with mock.patch.object(app, "HEDGE_STATS", stats), mock.patch.object(
+            app, "_call_openai_coloring", side_effect=self.call
+        ):
+            return app._call_openai_with_retries(self.prepared, "normal", self.settings, app.ScheduleHint())
+
+    def test_slow_call_is_hedged_and_hedge_wins(self):
+        stats = app.HedgeStats(max_fraction=1.0)
+
+        self.assertEqual(self.run_call(stats), b"hedge")
+        self.assertEqual(stats.snapshot(), {"calls": 1, "hedges": 1, "hedge_wins": 1, "primary_wins": 0})
+
+    def test_hedge_rate_cap_is_respected(self):
+        stats = app.HedgeStats(max_fraction=0.0)
+        threading.Timer(0.5, self.release_primary.set).start()
+
+        self.assertEqual(self.run_call(stats), b"primary")
+        self.assertEqual(stats.snapshot()["hedges"], 0)
+        self.assertEqual(self.calls, 1)
+
+
+class TransportTests(unittest.TestCase):
+    def test_read_timeout_follows_engine(self):
+        mini = app.openai_timeout(app.generation_settings_from_preset("mini_medium"))
+        standard = app.openai_timeout(app.generation_settings_from_preset("standard_high"))
+
+        self.assertEqual(mini.connect, app.OPENAI_CONNECT_TIMEOUT_SECONDS)
+        self.assertLess(mini.read, standard.read)
+
+    def test_edit_call_uses_engine_timeout(self):
+        settings = app.generation_settings_from_preset("standard_high")
+        prepared = app.prepare_image_variants(jpeg_bytes(color=(7, 7, 70)), "a.jpg")
+        result = mock.Mock(data=[mock.Mock(b64_json="Y29sb3Jpbmc=")], usage=None)
+
+        with mock.patch.object(app.client.images, "edit", return_value=result) as edit, mock.patch.object(
+            app, "set_cached_coloring"
+        ):
+            self.assertEqual(app._call_openai_coloring(prepared, "normal", settings), b"coloring")
+
+        self.assertEqual(edit.call_args.kwargs["timeout"], app.openai_timeout(settings))
+
+    def test_warm_up_opens_one_connection_per_slot(self):
+        with mock.patch.object(app.client.models, "retrieve") as retrieve:
+            app.warm_openai_connections()
+
+        self.assertEqual(retrieve.call_count, app.MAX_PARALLEL_WORKERS)
+
+    def test_keepalive_only_pings_idle_slots(self):
+        scheduler = app.OpenAIScheduler(max_in_flight=app.MAX_PARALLEL_WORKERS + 2)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        running = scheduler.submit(release.wait, 5)
+        while not running.running():
+            time.sleep(0.01)
+
+        with mock.patch.object(app, "OPENAI_SCHEDULER", scheduler), mock.patch.object(
+            app.client.models, "retrieve"
+        ) as retrieve, mock.patch.object(app.time, "sleep", side_effect=StopIteration):
+            with self.assertRaises(StopIteration):
+                app._keep_openai_connections_warm(60)
+            self.assertEqual(retrieve.call_count, app.MAX_PARALLEL_WORKERS + 1)
+
+            for _ in range(app.MAX_PARALLEL_WORKERS + 1):
+                scheduler.submit(release.wait, 5)
+            with self.assertRaises(StopIteration):
+                app._keep_openai_connections_warm(60)
+            self.assertEqual(retrieve.call_count, app.MAX_PARALLEL_WORKERS + 1)
+
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        self.store = use_temp_store(self)
+
+    def test_concurrent_callers_share_one_openai_call(self):
+        settings = app.generation_settings_from_preset("standard_high")
+        prepared = app.prepare_image_variants(jpeg_bytes(color=(12, 34, 56)), "a.jpg")
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_call(prepared, detail, settings):
+            started.set()
+            release.wait(5)
+            return b"coloring"
+
+        with mock.patch.object(app, "get_cached_coloring", return_value=None), mock.patch.object(
+            app, "_call_openai_coloring", side_effect=slow_call
+        ) as call:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                leader = executor.submit(app.generate_coloring_bytes, prepared, "normal", settings)
+                started.wait(5)
+                followers = [executor.submit(app.generate_coloring_bytes, prepared, "normal", settings) for _ in range(2)]
+                time.sleep(0.1)
+                release.set()
+                results = [leader.result(5)] + [f.result(5) for f in followers]
+
+        self.assertEqual(call.call_count, 1)
+        self.assertEqual(results, [b"coloring"] * 3)
+        self.assertEqual(app.INFLIGHT_GENERATIONS, {})
+
+    def test_call_waits_if_its_lease_ran_out_in_the_queue(self):
+        scheduler = app.OpenAIScheduler(max_in_flight=1)
+        release = threading.Event()
+        scheduler.submit(lambda: release.wait(5))
+        prepared = app.prepare_image_variants(jpeg_bytes(color=(12, 34, 56)), "a.jpg")
+        settings = app.generation_settings_from_preset("standard_high")
+
+        with mock.patch.object(app, "OPENAI_SCHEDULER", scheduler), mock.patch.object(
+            app, "GENERATION_LEASE_SECONDS", 0.1
+        ), mock.patch.object(app, "_call_openai_coloring") as call:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                waiting = executor.submit(app._generate_with_lease, "key", prepared, "normal", settings)
+                time.sleep(0.3)
+                # Our lease expired while the call was queued; another worker takes over.
+                self.assertTrue(self.store.acquire_lease("key", "worker-2", 60))
+                release.set()
+                time.sleep(0.2)
+                app.COLORING_CACHE.put("key", b"from worker-2")
+                result = waiting.result(5)
+
+        self.assertEqual(result, b"from worker-2")
+        call.assert_not_called()
+
+
+class CacheAccountingTests(unittest.TestCase):
+    def test_generated_miss_is_counted_once(self):
+        use_temp_store(self)
+        prepared = app.prepare_image_variants(jpeg_bytes(color=(3, 90, 200)), "a.jpg")
+        settings = app.generation_settings_from_preset("standard_high")
+
+        with mock.patch.object(app, "PERCEPTUAL_CACHE", "off"), mock.patch.object(
+            app, "_call_openai_coloring", return_value=b"coloring"
+        ):
+            self.assertEqual(app.generate_coloring_bytes(prepared, "normal", settings), b"coloring")
+
+        self.assertEqual(app.COLORING_CACHE.stats()["misses"], 1)
+
+
+class OpenAISchedulerTests(unittest.TestCase):
+    def test_in_flight_calls_never_exceed_limit(self):
+        scheduler = app.OpenAIScheduler(max_in_flight=2)
+        lock = threading.Lock()
+        state = {"running": 0, "peak": 0}
+
+        def call(n):
+            with lock:
+                state["running"] += 1
+                state["peak"] = max(state["peak"], state["running"])
+            time.sleep(0.02)
+            with lock:
+                state["running"] -= 1
+            return n
+
+        futures = [scheduler.submit(call, n) for n in range(8)]
+
+        self.assertEqual([f.result(5) for f in futures], list(range(8)))
+        self.assertEqual(state["peak"], 2)
+
+    def test_lowered_limit_holds_back_queue(self):
+        scheduler = app.OpenAIScheduler(max_in_flight=2)
+        scheduler.set_limit(1)
+        release = threading.Event()
+
+        first = scheduler.submit(lambda: release.wait(5))
+        second = scheduler.submit(lambda: "second")
+        time.sleep(0.1)
+
+        self.assertFalse(second.done())
+        self.assertEqual(scheduler.stats(), {"queued": 1, "in_flight": 1, "limit": 1, "paused": 0.0})
+        release.set()
+        self.assertTrue(first.result(5))
+        self.assertEqual(second.result(5), "second")
+
+    def run_in_order(self, submissions):
+        scheduler = app.OpenAIScheduler(max_in_flight=1)
+        release = threading.Event()
+        order = []
+        scheduler.submit(lambda: release.wait(5), hint=app.ScheduleHint("blocker"))
+        futures = [
+            scheduler.submit(order.append, name, hint=app.ScheduleHint(client, priority))
+            for name, client, priority in submissions
+        ]
+        release.set()
+        for future in futures:
+            future.result(5)
+        return order
+
+    def test_single_image_jumps_ahead_of_queued_booklet_pages(self):
+        bulk = [(f"booklet-{n}", "a", app.PRIORITY_BULK) for n in range(5)]
+        order = self.run_in_order(bulk + [("single", "b", app.PRIORITY_INTERACTIVE)])
+
+        self.assertEqual(order[0], "single")
+
+    def test_clients_with_equal_priority_take_turns(self):
+        submissions = [(f"a{n}", "a", app.PRIORITY_BULK) for n in range(3)]
+        submissions += [(f"b{n}", "b", app.PRIORITY_BULK) for n in range(3)]
+
+        self.assertEqual(self.run_in_order(submissions), ["a0", "b0", "a1", "b1", "a2", "b2"])
+
+    def test_batch_gives_first_pages_interactive_priority(self):
+        prepared = [app.prepare_image_variants(jpeg_bytes(color=(n * 40, 0, 0)), f"{n}.jpg") for n in range(4)]
+        hints = []
+
+        def record(prepared, detail, settings, on_stage=None, hint=None):
+            hints.append((prepared.original_filename, hint))
+            return b"x"
+
+        with mock.patch.object(app, "BOOKLET_PRIORITY_PAGES", 2), mock.patch.object(
+            app, "generate_coloring_bytes", side_effect=record
+        ):
+            app.generate_coloring_batch_parallel(
+                prepared, "normal", app.generation_settings_from_preset("mini_medium"), client_id="1.2.3.4"
+            )
+
+        priorities = {name: hint.priority for name, hint in hints}
+        self.assertEqual(
+            priorities,
+            {
+                "0.jpg": app.PRIORITY_INTERACTIVE,
+                "1.jpg": app.PRIORITY_INTERACTIVE,
+                "2.jpg": app.PRIORITY_BULK,
+                "3.jpg": app.PRIORITY_BULK,
+            },
+        )
+        self.assertEqual({hint.client_id for _name, hint in hints}, {"1.2.3.4"})
+
+    def test_cancelled_calls_are_skipped(self):
+        scheduler = app.OpenAIScheduler(max_in_flight=1)
+        release = threading.Event()
+        calls = []
+
+        scheduler.submit(lambda: release.wait(5))
+        skipped = scheduler.submit(lambda: calls.append("skipped"))
+        skipped.cancel()
+        release.set()
+        scheduler.submit(lambda: None).result(5)
+
+        self.assertEqual(calls, [])
+
+
+def rate_limit_error(message: str, headers: dict) -> RateLimitError:
+    request = httpx.Request("POST", "https://api.openai.com/v1/images/edits")
+    response = httpx.Response(429, headers=headers, request=request)
+    return RateLimitError(message, response=response, body=None)
+
+
+class RetryTests(unittest.TestCase):
+    def setUp(self):
+        self.settings = app.generation_settings_from_preset("mini_medium")
+        self.prepared = app.prepare_image_variants(jpeg_bytes(color=(90, 10, 10)), "a.jpg")
+        patcher = mock.patch.object(app, "OPENAI_SCHEDULER", app.OpenAIScheduler(max_in_flight=8))
+        self.scheduler = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retry_after_headers(self):
+        self.assertEqual(app.retry_after_seconds(httpx.Headers({"retry-after": "3"})), 3.0)
+        self.assertEqual(app.retry_after_seconds(httpx.Headers({"retry-after-ms": "250"})), 0.25)
+        exhausted = httpx.Headers({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "6m0s"})
+        self.assertEqual(app.retry_after_seconds(exhausted), 360.0)
+        self.assertIsNone(app.retry_after_seconds(httpx.Headers({"x-ratelimit-reset-requests": "20ms"})))
+
+    def test_transient_failure_is_retried(self):
+        outcomes = [app.TransientOpenAIError("rate limit", 0.0), b"coloring"]
+
+        with mock.patch.object(app, "_call_openai_coloring", side_effect=outcomes) as call, mock.patch.object(
+            app, "_backoff_seconds", return_value=0
+        ):
+            result = app._call_openai_with_retries(self.prepared, "normal", self.settings, app.ScheduleHint())
+
+        self.assertEqual(result, b"coloring")
+        self.assertEqual(call.call_count, 2)
+
+    def test_gives_up_when_backoff_would_pass_deadline(self):
+        hint = app.ScheduleHint(deadline=time.time() + 1)
+
+        with mock.patch.object(
+            app, "_call_openai_coloring", side_effect=app.TransientOpenAIError("Prøv igjen om litt.", 5.0)
+        ) as call:
+            with self.assertRaisesRegex(ValueError, "Prøv igjen om litt."):
+                app._call_openai_with_retries(self.prepared, "normal", self.settings, hint)
+
+        self.assertEqual(call.call_count, 1)
+
+    def test_retry_budget_is_counted_from_each_calls_start(self):
+        hint = app.ScheduleHint(deadline=time.time() + 600)
+        outcomes = [app.TransientOpenAIError("rate limit", 0.0), b"coloring"]
+
+        with mock.patch.object(app, "OPENAI_RETRY_BUDGET_SECONDS", 2), mock.patch.object(
+            app, "_backoff_seconds", return_value=1.5
+        ), mock.patch.object(app, "_sleep_unless_cancelled"), mock.patch.object(
+            app, "_call_openai_coloring", side_effect=outcomes
+        ):
+            # A page queued long after the batch started still gets its own budget...
+            self.assertEqual(app._call_openai_with_retries(self.prepared, "normal", self.settings, hint), b"coloring")
+
+        with mock.patch.object(app, "OPENAI_RETRY_BUDGET_SECONDS", 1), mock.patch.object(
+            app, "_call_openai_coloring", side_effect=app.TransientOpenAIError("Prøv igjen om litt.", 5.0)
+        ) as call:
+            # ...but no more than that budget, even with the request deadline far away.
+            with self.assertRaisesRegex(ValueError, "Prøv igjen om litt."):
+                app._call_openai_with_retries(self.prepared, "normal", self.settings, hint)
+        self.assertEqual(call.call_count, 1)
+
+    def test_rate_limit_lowers_limit_and_pauses_queue(self):
+        error = rate_limit_error("Rate limit reached", {"retry-after": "2"})
+
+        with mock.patch.object(app.client.images, "edit", side_effect=error):
+            with self.assertRaises(app.TransientOpenAIError) as raised:
+                app._call_openai_coloring(self.prepared, "normal", self.settings)
+
+        self.assertEqual(raised.exception.retry_after, 2.0)
+        self.assertEqual(self.scheduler.limit, 4)
+        self.assertGreater(self.scheduler.stats()["paused"], 1)
+
+    def test_other_openai_errors_fail_only_this_image(self):
+        request = httpx.Request("POST", "https://api.openai.com/v1/images/edits")
+        rejected = BadRequestError("Invalid image", response=httpx.Response(400, request=request), body=None)
+
+        for error in (rejected, OpenAIError("unparseable response")):
+            with mock.patch.object(app.client.images, "edit", side_effect=error):
+                with self.assertRaises(ValueError):
+                    app._call_openai_coloring(self.prepared, "normal", self.settings)
+
+    def test_exhausted_quota_is_not_retried(self):
+        error = rate_limit_error("You exceeded your current quota: insufficient_quota", {})
+
+        with mock.patch.object(app.client.images, "edit", side_effect=error):
+            with self.assertRaisesRegex(ValueError, "kvote"):
+                app._call_openai_coloring(self.prepared, "normal", self.settings)
+
+    def test_limit_recovers_additively(self):
+        self.scheduler.record_rate_limited()
+        self.scheduler.record_rate_limited()
+        self.assertEqual(self.scheduler.limit, 4)
+
+        for _ in range(4):
+            self.scheduler.record_success()
+        self.assertEqual(self.scheduler.limit, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
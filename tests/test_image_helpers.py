@@ -1,6 +1,8 @@
+import hashlib
 import io
 import os
 import unittest
+from unittest import mock
 
 os.environ.setdefault("OPENAI_API_KEY", "test-key")
 
@@ -27,6 +29,127 @@ class ImageHelperTests(unittest.TestCase):
         self.assertEqual(loaded.size, (10, 10))
         loaded.close()
 
+    def test_large_jpeg_is_decoded_at_reduced_scale(self):
+        buf = io.BytesIO()
+        Image.new("RGB", (4000, 3000), (200, 120, 40)).save(buf, format="JPEG")
+
+        loaded = app.pil_image_from_bytes(buf.getvalue(), max_dim=1000)
+
+        self.assertGreaterEqual(max(loaded.size), 1000)
+        self.assertLess(max(loaded.size), 2000)
+        self.assertEqual(loaded.mode, "RGB")
+        loaded.close()
+
+    def test_reduced_decode_still_applies_exif_rotation(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        buf = io.BytesIO()
+        Image.new("RGB", (4000, 2000), (10, 10, 10)).save(buf, format="JPEG", exif=exif.tobytes())
+
+        loaded = app.pil_image_from_bytes(buf.getvalue(), max_dim=1000)
+
+        self.assertGreater(loaded.height, loaded.width)
+        self.assertGreaterEqual(loaded.height, 1000)
+        loaded.close()
+
+    def test_renditions_are_fitted_and_never_upscaled(self):
+        base = Image.new("RGB", (3000, 2000), (255, 255, 255))
+        specs = (("big", 1800, 1800, 90), ("small", 600, 600, 88), ("huge", 4000, 4000, 90))
+
+        renditions = app.derive_renditions(base, specs)
+
+        self.assertEqual(renditions["big"].size, (1800, 1200))
+        self.assertEqual(renditions["small"].size, (600, 400))
+        self.assertIs(renditions["huge"], base)
+
+    def test_prepare_image_variants_builds_every_rendition(self):
+        buf = io.BytesIO()
+        Image.new("RGB", (3000, 4000), (90, 160, 220)).save(buf, format="JPEG")
+
+        prepared = app.prepare_image_variants(buf.getvalue(), "foto.jpg")
+
+        with Image.open(io.BytesIO(prepared.pdf_bytes)) as pdf_img:
+            self.assertEqual(max(pdf_img.size), app.PDF_IMAGE_MAX_DIM)
+        with Image.open(io.BytesIO(prepared.openai_input_bytes)) as openai_img:
+            self.assertEqual(max(openai_img.size), app.OPENAI_INPUT_MAX_DIM)
+        with Image.open(io.BytesIO(prepared.combo_bytes)) as combo_img:
+            self.assertLessEqual(combo_img.width, app.SIDE_WIDTH)
+            self.assertLessEqual(combo_img.height, app.SIDE_HEIGHT)
+
+    def test_booklet_pages_skip_the_combo_rendition(self):
+        buf = io.BytesIO()
+        Image.new("RGB", (1200, 900), (90, 160, 220)).save(buf, format="JPEG")
+        upload = app.spool_upload(io.BytesIO(buf.getvalue()), "foto.jpg")
+
+        prepared = app.prepare_images_async([upload])[0].result()
+
+        self.assertIsNone(prepared.combo_bytes)
+        self.assertTrue(prepared.pdf_bytes)
+
+    def test_pdf_rendition_fits_the_page_box(self):
+        buf = io.BytesIO()
+        Image.new("RGB", (3000, 2000), (90, 160, 220)).save(buf, format="JPEG")
+        a5_combo = app.BookletPdfBuilder("combo", "A5").image_pixels
+        a4_album = app.BookletPdfBuilder("album", "A4").image_pixels
+
+        small = app.prepare_image_variants(buf.getvalue(), "foto.jpg", a5_combo)
+        large = app.prepare_image_variants(buf.getvalue(), "foto.jpg", a4_album)
+
+        # 55 mm wide half page at 300 DPI.
+        self.assertEqual(a5_combo[0], 650)
+        with Image.open(io.BytesIO(small.pdf_bytes)) as pdf_img:
+            self.assertEqual(pdf_img.size, (650, 433))
+        with Image.open(io.BytesIO(large.pdf_bytes)) as pdf_img:
+            self.assertEqual(max(pdf_img.size), app.PDF_IMAGE_MAX_DIM)
+        self.assertEqual(small.openai_input_bytes, large.openai_input_bytes)
+
+    def test_parallel_preprocessing_keeps_order_and_names_bad_file(self):
+        def jpeg(size):
+            buf = io.BytesIO()
+            Image.new("RGB", size, (0, 0, 0)).save(buf, format="JPEG")
+            return buf.getvalue()
+
+        def spool(name, data):
+            return app.spool_upload(io.BytesIO(data), name)
+
+        prepared = app.prepare_images_parallel([spool("a.jpg", jpeg((40, 20))), spool("b.jpg", jpeg((20, 40)))])
+        self.assertEqual([p.original_filename for p in prepared], ["a.jpg", "b.jpg"])
+
+        with self.assertRaisesRegex(ValueError, "^b.jpg: "):
+            app.prepare_images_parallel([spool("a.jpg", jpeg((40, 20))), spool("b.jpg", b"not an image")])
+
+    def test_spool_upload_hashes_the_stream_in_place(self):
+        data = b"x" * (app.UPLOAD_CHUNK_SIZE * 3 + 5)
+        stream = io.BytesIO(data)
+
+        upload = app.spool_upload(stream, "fil.jpg")
+
+        self.assertIs(upload.file, stream)
+        self.assertEqual(upload.size, len(data))
+        self.assertEqual(upload.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(upload.file.read(), data)
+        upload.close()
+        self.assertIsNone(app.spool_upload(io.BytesIO(b""), "tom.jpg"))
+
+    def test_detached_upload_outlives_the_request_stream(self):
+        data = b"y" * (app.UPLOAD_CHUNK_SIZE + 7)
+        stream = io.BytesIO(data)
+
+        upload = app.spool_upload(stream, "fil.jpg", detach=True)
+        stream.close()
+
+        self.assertEqual(upload.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(upload.file.read(), data)
+        upload.close()
+
+    def test_memory_log_labels_the_process_peak_and_shows_the_change(self):
+        with mock.patch.object(app, "memory_usage_mb", return_value=(180.0, 900.0)), mock.patch(
+            "builtins.print"
+        ) as printed:
+            self.assertEqual(app.log_memory_usage("etter PDF", since_rss=150.0), 180.0)
+
+        self.assertEqual(printed.call_args[0][0], "Minne etter PDF: rss=180MB, endring=+30MB, prosess-topp=900MB")
+
 
 if __name__ == "__main__":
     unittest.main()
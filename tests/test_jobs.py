@@ -0,0 +1,210 @@
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+from openai import OpenAIError
+from PIL import Image
+
+import app
+from helpers import jpeg_bytes, use_temp_store
+
+
+def coloring_png(prepared, detail, settings, on_stage=None, hint=None) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 96), "white").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class AsyncJobTests(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        root = Path(self._tmp.name)
+        (root / "previews").mkdir()
+        use_temp_store(self)
+        patcher = mock.patch.object(app, "PREVIEW_DIR", root / "previews")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def wait_for(self, status_url: str) -> dict:
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            job = self.client.get(status_url).get_json()
+            if job["state"] in ("done", "failed"):
+                return job
+            time.sleep(0.05)
+        self.fail("job did not finish")
+
+    def test_single_job_reports_preview(self):
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=coloring_png):
+            response = self.client.post(
+                "/process",
+                data={"mode": "single", "async": "1", "images": (io.BytesIO(jpeg_bytes()), "katt.jpg")},
+            )
+            self.assertEqual(response.status_code, 202)
+            job = self.wait_for(response.get_json()["status_url"])
+
+        self.assertEqual(job["state"], "done")
+        self.assertEqual(job["result"]["filename"], "katt-combo.png")
+        preview = self.client.get(job["result"]["preview_url"])
+        self.assertEqual(preview.mimetype, "image/png")
+
+    def test_failed_job_reports_user_message(self):
+        def blocked(prepared, detail, settings, on_stage=None, hint=None):
+            raise ValueError("moderation_blocked")
+
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=blocked):
+            response = self.client.post(
+                "/process",
+                data={"mode": "single", "async": "1", "images": (io.BytesIO(jpeg_bytes()), "katt.jpg")},
+            )
+            job = self.wait_for(response.get_json()["status_url"])
+
+        self.assertEqual(job["state"], "failed")
+        self.assertIn("sikkerhetssystemet", job["error"])
+
+    def test_booklet_events_stream_progress_until_done(self):
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=coloring_png):
+            response = self.client.post(
+                "/process",
+                data={
+                    "mode": "booklet",
+                    "async": "1",
+                    "layout": "combo",
+                    "booklet_images": [
+                        (io.BytesIO(jpeg_bytes(color=(255, 0, 0))), "a.jpg"),
+                        (io.BytesIO(jpeg_bytes(color=(0, 0, 255))), "b.jpg"),
+                    ],
+                },
+            )
+            events_url = response.get_json()["events_url"]
+            stream = self.client.get(events_url)
+            body = stream.get_data(as_text=True)
+
+        self.assertEqual(stream.mimetype, "text/event-stream")
+        progress = [
+            json.loads(block.split("data: ", 1)[1])
+            for block in body.split("\n\n")
+            if block.startswith("id: ")
+        ]
+        for image in (1, 2):
+            stages = [event["stage"] for event in progress if event["image"] == image]
+            self.assertEqual(stages[0], "preprocessed")
+            self.assertIn("done", stages)
+            self.assertEqual(stages[-1], "page_written")
+        final = json.loads(body.rstrip().rsplit("event: state\ndata: ", 1)[1])
+        self.assertEqual(final["state"], "done")
+
+    def test_partial_booklet_lists_dropped_images(self):
+        def generate(prepared, detail, settings, on_stage=None, hint=None):
+            if prepared.original_filename == "b.jpg":
+                raise ValueError("moderation_blocked")
+            return coloring_png(prepared, detail, settings)
+
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=generate):
+            response = self.client.post(
+                "/process",
+                data={
+                    "mode": "booklet",
+                    "async": "1",
+                    "allow_partial": "1",
+                    "booklet_images": [
+                        (io.BytesIO(jpeg_bytes(color=(255, 0, 0))), "a.jpg"),
+                        (io.BytesIO(jpeg_bytes(color=(0, 0, 255))), "b.jpg"),
+                        (io.BytesIO(jpeg_bytes(color=(0, 255, 0))), "c.jpg"),
+                    ],
+                },
+            )
+            job = self.wait_for(response.get_json()["status_url"])
+
+        self.assertEqual(job["state"], "done")
+        self.assertEqual(
+            job["result"]["dropped"],
+            [{"image": 2, "filename": "b.jpg", "reason": "Stoppet av sikkerhetssystemet til OpenAI."}],
+        )
+
+    def test_partial_booklet_below_the_minimum_fails(self):
+        def generate(prepared, detail, settings, on_stage=None, hint=None):
+            if prepared.original_filename != "a.jpg":
+                raise ValueError("moderation_blocked")
+            return coloring_png(prepared, detail, settings)
+
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=generate):
+            response = self.client.post(
+                "/process",
+                data={
+                    "mode": "booklet",
+                    "async": "1",
+                    "allow_partial": "1",
+                    "booklet_images": [
+                        (io.BytesIO(jpeg_bytes(color=(255, 0, 0))), "a.jpg"),
+                        (io.BytesIO(jpeg_bytes(color=(0, 0, 255))), "b.jpg"),
+                        (io.BytesIO(jpeg_bytes(color=(0, 255, 0))), "c.jpg"),
+                    ],
+                },
+            )
+            job = self.wait_for(response.get_json()["status_url"])
+
+        self.assertEqual(job["state"], "failed")
+        self.assertIn("et hefte trenger minst 2", job["error"])
+
+    def test_partial_booklets_are_opt_in(self):
+        page = self.client.get("/").get_data(as_text=True)
+
+        self.assertRegex(page, r'<input type="checkbox" name="allow_partial" id="allowPartial" value="1">')
+
+    def test_sync_request_turns_unexpected_openai_errors_into_a_message(self):
+        with mock.patch.object(app, "generate_coloring_bytes", side_effect=OpenAIError("boom")):
+            response = self.client.post(
+                "/process", data={"mode": "single", "images": (io.BytesIO(jpeg_bytes()), "katt.jpg")}
+            )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Prøv igjen", response.get_data(as_text=True))
+
+    def test_deadline_counts_from_request_arrival_and_jobs_have_none(self):
+        preprocessed_at = []
+        prepare = app.prepare_image_variants
+
+        def timed_prepare(*args, **kwargs):
+            preprocessed_at.append(time.time())
+            return prepare(*args, **kwargs)
+
+        with mock.patch.object(app, "prepare_image_variants", side_effect=timed_prepare), mock.patch.object(
+            app, "choose_engine", side_effect=lambda prepared, detail, settings, deadline, waves=1: settings
+        ) as choose, mock.patch.object(app, "generate_coloring_bytes", side_effect=coloring_png):
+            sent_at = time.time()
+            self.client.post("/process", data={"mode": "single", "images": (io.BytesIO(jpeg_bytes()), "katt.jpg")})
+            response = self.client.post(
+                "/process",
+                data={"mode": "single", "async": "1", "images": (io.BytesIO(jpeg_bytes()), "katt.jpg")},
+            )
+            self.wait_for(response.get_json()["status_url"])
+
+        sync_deadline, job_deadline = (call.args[3] for call in choose.call_args_list)
+        self.assertLessEqual(sent_at, sync_deadline - app.REQUEST_DEADLINE_SECONDS)
+        self.assertLess(sync_deadline - app.REQUEST_DEADLINE_SECONDS, preprocessed_at[0])
+        self.assertIsNone(job_deadline)
+
+    def test_validation_errors_are_returned_before_queuing(self):
+        response = self.client.post("/process", data={"mode": "booklet", "async": "1"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_and_stale_jobs(self):
+        self.assertEqual(self.client.get("/jobs/" + "0" * 32).status_code, 404)
+
+        app.STORE.create_job("a" * 32, time.time() - app.JOB_TIMEOUT_SECONDS - 1)
+        job = self.client.get("/jobs/" + "a" * 32).get_json()
+        self.assertEqual(job["state"], "failed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,245 @@
+import concurrent.futures
+import io
+import os
+import re
+import subprocess
+import sys
+import unittest
+import zlib
+from pathlib import Path
+from unittest import mock
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+from PIL import Image, ImageDraw
+import reportlab
+
+import app
+import pdf_encoding
+from helpers import image_bytes
+
+
+def page_count(pdf_bytes: bytes) -> int:
+    return len(re.findall(rb"/Type /Page\b", pdf_bytes))
+
+
+class PdfBuilderTests(unittest.TestCase):
+    def setUp(self):
+        self.originals = [image_bytes((300, 200), (i * 60, 80, 40)) for i in range(3)]
+        self.colorings = [image_bytes((102, 153), (255, 255, 255 - i), fmt="PNG") for i in range(3)]
+
+    def test_album_has_two_pages_per_pair(self):
+        pdf = app.build_pdf_album_from_pairs(self.originals, self.colorings, "A4")
+
+        self.assertTrue(pdf.startswith(b"%PDF"))
+        self.assertEqual(page_count(pdf), 6)
+
+    def test_combo_has_one_page_per_pair(self):
+        pdf = app.build_pdf_combo_direct_from_pairs(self.originals, self.colorings, "A5")
+
+        self.assertEqual(page_count(pdf), 3)
+
+    def test_cewe_pads_to_minimum_page_count(self):
+        pdf = app.build_pdf_cewe_a4_content(self.originals, self.colorings)
+
+        self.assertEqual(page_count(pdf), app.CEWE_CONTENT_MIN_PAGES)
+
+    def test_builder_accepts_pairs_out_of_order(self):
+        builder = app.BookletPdfBuilder("album", "A4")
+        for idx in (2, 0, 1):
+            builder.add_pair(idx, self.originals[idx], self.colorings[idx])
+
+        pdf = builder.finish()
+
+        self.assertEqual(page_count(pdf), 6)
+
+    def test_encoded_stream_matches_image_size(self):
+        stream = pdf_encoding.encode_pdf_image(self.originals[0])
+
+        self.assertEqual((stream.width, stream.height), (300, 200))
+        self.assertEqual(stream.filters, ("FlateDecode",))
+
+    def test_jpeg_original_is_embedded_unchanged(self):
+        stream = pdf_encoding.encode_pdf_jpeg(self.originals[0])
+
+        self.assertEqual(stream.filters, ("DCTDecode",))
+        self.assertEqual((stream.width, stream.height, stream.color_space), (300, 200, "DeviceRGB"))
+        self.assertEqual(stream.data, self.originals[0])
+
+        pdf = app.build_pdf_album_from_pairs(self.originals[:1], self.colorings[:1], "A4")
+        self.assertIn(b"/DCTDecode", pdf)
+        self.assertIn(self.originals[0], pdf)
+
+    def test_oversized_jpeg_is_resampled_to_the_box(self):
+        stream = pdf_encoding.encode_pdf_jpeg(image_bytes((1800, 1200), (10, 120, 200)), (650, 2162))
+
+        self.assertEqual(stream.filters, ("DCTDecode",))
+        self.assertEqual((stream.width, stream.height), (650, 433))
+
+    def test_non_jpeg_and_rotated_originals_are_reencoded(self):
+        rotated = io.BytesIO()
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        Image.new("RGB", (300, 200), "red").save(rotated, format="JPEG", exif=exif)
+
+        for data in (image_bytes((300, 200), (1, 2, 3), fmt="PNG"), rotated.getvalue()):
+            stream = pdf_encoding.encode_pdf_jpeg(data)
+            self.assertEqual(stream.filters, ("FlateDecode",))
+        self.assertEqual((stream.width, stream.height), (200, 300))
+
+
+class ProcessPoolEncodingTests(unittest.TestCase):
+    def tearDown(self):
+        if app.PDF_ENCODE_POOL is not None:
+            app.PDF_ENCODE_POOL.shutdown()
+            app.PDF_ENCODE_POOL = None
+
+    def test_pages_encoded_in_worker_processes_match_threaded_build(self):
+        originals = [image_bytes((300, 200), (i * 60, 80, 40)) for i in range(3)]
+        colorings = [image_bytes((102, 153), (255, 255, 255 - i), fmt="PNG") for i in range(3)]
+        threaded = pdf_encoding.encode_pdf_pair(originals[0], colorings[0])
+
+        with mock.patch.object(app, "PDF_ENCODE_WORKERS", 1):
+            pooled = app.submit_pdf_encoding(originals[0], colorings[0]).result()
+            pdf = app.build_pdf_album_from_pairs(originals, colorings, "A4")
+
+        self.assertIsInstance(app.PDF_ENCODE_POOL, concurrent.futures.ProcessPoolExecutor)
+        self.assertEqual(pooled[:2], threaded[:2])
+        self.assertEqual(page_count(pdf), 6)
+
+    def test_encoding_module_does_not_import_the_app(self):
+        code = "import sys, pdf_encoding; print(sorted({'app', 'openai', 'flask'} & set(sys.modules)))"
+        root = Path(__file__).resolve().parent.parent
+
+        output = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+
+        self.assertEqual(output.stdout.strip(), "[]")
+
+    def test_dead_worker_process_is_replaced(self):
+        original, coloring = image_bytes((300, 200), (200, 80, 40)), image_bytes((102, 153), (255, 255, 255), fmt="PNG")
+
+        with mock.patch.object(app, "PDF_ENCODE_WORKERS", 1):
+            first = app.submit_pdf_encoding(original, coloring)
+            first.result()
+            dead_pool = app.PDF_ENCODE_POOL
+            # Kills the only worker, so the queued pair fails with BrokenProcessPool and is retried.
+            dead_pool.submit(os._exit, 1)
+            pooled = app.submit_pdf_encoding(original, coloring).result(60)
+            after = app.submit_pdf_encoding(original, coloring).result(60)
+
+        self.assertIsNot(app.PDF_ENCODE_POOL, dead_pool)
+        self.assertEqual(pooled[:2], first.result()[:2])
+        self.assertEqual(after[:2], first.result()[:2])
+
+
+class ReportLabPinTests(unittest.TestCase):
+    def test_installed_reportlab_matches_the_pin(self):
+        # _draw_image_stream relies on canvas internals, so a new ReportLab must be re-checked before the pin moves.
+        requirements = (Path(__file__).resolve().parent.parent / "requirements.txt").read_text()
+        pinned = re.search(r"^reportlab==(\S+)$", requirements, re.M)
+
+        self.assertIsNotNone(pinned, "reportlab must be pinned to an exact version")
+        self.assertEqual(reportlab.Version, pinned.group(1))
+
+    def test_canvas_internals_used_for_prebuilt_streams_exist(self):
+        buf = io.BytesIO()
+        c = app.pdfcanvas.Canvas(buf)
+
+        for name in ("_doc", "_code", "_formsinuse", "_setXObjects"):
+            self.assertTrue(hasattr(c, name), name)
+        self.assertTrue(hasattr(app.pdfdoc.PDFImageXObject("x"), "streamContent"))
+
+
+class LineArtTests(unittest.TestCase):
+    def setUp(self):
+        img = Image.new("RGB", (200, 300), "white")
+        draw = ImageDraw.Draw(img)
+        draw.ellipse((20, 20, 180, 280), outline="black", width=4)
+        draw.rectangle((60, 100, 140, 160), fill="black")
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        self.coloring = buf.getvalue()
+
+    def test_coloring_page_is_bilevel_and_smaller_than_rgb(self):
+        lineart = pdf_encoding.encode_pdf_lineart(self.coloring)
+        rgb = pdf_encoding.encode_pdf_image(self.coloring)
+
+        self.assertEqual((lineart.color_space, lineart.bits_per_component), ("DeviceGray", 1))
+        self.assertEqual((lineart.width, lineart.height), (200 * pdf_encoding.LINEART_UPSCALE, 300 * pdf_encoding.LINEART_UPSCALE))
+        self.assertLess(len(lineart.data), len(rgb.data))
+
+    def test_line_art_is_fitted_to_the_box_at_double_resolution(self):
+        stream = pdf_encoding.encode_pdf_lineart(self.coloring, (50, 300))
+
+        self.assertEqual((stream.width, stream.height), (100, 150))
+
+    def test_flate_fallback_keeps_white_background(self):
+        with mock.patch.object(pdf_encoding, "_ccitt_g4", return_value=None):
+            stream = pdf_encoding.encode_pdf_lineart(self.coloring)
+
+        self.assertEqual(stream.filters, ("FlateDecode",))
+        width, height = stream.width, stream.height
+        bilevel = Image.frombytes("1", (width, height), zlib.decompress(stream.data))
+        self.assertEqual(bilevel.getpixel((0, 0)), 255)
+        self.assertEqual(bilevel.getpixel((width // 2, height // 2)), 0)
+
+    def test_builders_embed_ccitt_coloring_pages(self):
+        originals = [image_bytes((300, 200), (200, 80, 40))]
+
+        pdf = app.build_pdf_combo_direct_from_pairs(originals, [self.coloring], "A4")
+
+        self.assertIn(b"/CCITTFaxDecode", pdf)
+        self.assertIn(b"/DecodeParms", pdf)
+        self.assertIn(b"/K -1", pdf)
+
+
+class TraceTests(unittest.TestCase):
+    def setUp(self):
+        img = Image.new("RGB", (400, 600), "white")
+        draw = ImageDraw.Draw(img)
+        draw.ellipse((40, 60, 360, 540), outline="black", width=12)
+        draw.rectangle((150, 250, 250, 350), fill="black")
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        self.coloring = buf.getvalue()
+        self.original = image_bytes((300, 200), (200, 80, 40))
+
+    def test_traces_ring_and_hole_as_closed_outlines(self):
+        page = pdf_encoding.trace_coloring(self.coloring)
+
+        self.assertEqual((page.width, page.height), (400, 600))
+        self.assertEqual(page.paths, 3)
+        self.assertGreater(page.fidelity, 0.97)
+        self.assertEqual(page.code.count(" m"), 3)
+        self.assertTrue(page.code.endswith("\nf"))
+
+    def test_blank_page_has_no_paths(self):
+        buf = io.BytesIO()
+        Image.new("RGB", (100, 100), "white").save(buf, format="PNG")
+
+        page = pdf_encoding.trace_coloring(buf.getvalue())
+
+        self.assertEqual((page.paths, page.code, page.fidelity), (0, "", 1.0))
+
+    def test_vector_booklet_draws_paths_and_reports_each_page(self):
+        builder = app.BookletPdfBuilder("album", "A4", vector=True)
+        builder.add_pair(0, self.original, self.coloring)
+        pdf = builder.finish()
+
+        self.assertNotIn(b"/CCITTFaxDecode", pdf)
+        report = builder.traces[0]
+        self.assertEqual((report["image"], report["vector"], report["paths"]), (1, True, 3))
+        self.assertGreater(report["bytes"], 0)
+
+    def test_low_fidelity_falls_back_to_raster_line_art(self):
+        with mock.patch.object(pdf_encoding, "TRACE_MIN_FIDELITY", 100):
+            builder = app.BookletPdfBuilder("album", "A4", vector=True)
+            builder.add_pair(0, self.original, self.coloring)
+            pdf = builder.finish()
+
+        self.assertIn(b"/CCITTFaxDecode", pdf)
+        self.assertFalse(builder.traces[0]["vector"])
+
+
+if __name__ == "__main__":
+    unittest.main()